@@ -0,0 +1,193 @@
+"""
+Measures the rerun latency of the streamlit apps, driven headlessly with AppTest on synthetic cohorts.
+Every click (or widget change) reruns the whole script, the time of each rerun is recorded
+per kind of interaction.
+
+    python -m benchmarks.apps --nr_students 100 --steps 20 --output bench_apps.json
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import utils.misc as um
+from benchmarks.cohort import generate_cohort
+from benchmarks.plagiarism import git_commit
+
+APPS = ('grader', 'plagiarism')
+
+GRADER_SCRIPT = """
+from utils.graders import GraderStreamlit
+
+GraderStreamlit(path={path!r}, grades_db={grades_db!r}, grader='benchmark').grade()
+"""
+
+PLAGIARISM_SCRIPT = """
+from utils.plagiarism_detector import PlagiarismDetectorStreamlit
+
+PlagiarismDetectorStreamlit(path={path!r}, tol_level={tol_level!r}).detect()
+"""
+
+
+class Session:
+    """
+    AppTest of one app whose reruns are timed per interaction.
+
+    :param str script: source of the app script
+    :param float timeout: seconds a rerun is allowed to take
+    """
+
+    def __init__(self, script, timeout=600):
+        from streamlit.testing.v1 import AppTest
+
+        self.app = AppTest.from_string(script, default_timeout=timeout)
+        self.latencies = {}
+
+    def run(self, interaction, element=None):
+        """
+        Reruns the app, after the given widget interaction if any.
+
+        :param str interaction: name the latency is recorded under, e.g. 'display'
+        :param element: the widget after its click() / set_value(...), None for a plain rerun
+        """
+        start = time.perf_counter()
+        (element or self.app).run()
+        self.latencies.setdefault(interaction, []).append(time.perf_counter() - start)
+        if self.app.exception:
+            raise RuntimeError(f'{interaction}: {self.app.exception[0].message}')
+
+    def button(self, label):
+        """The first button with the given label, None if there is none."""
+        return next((button for button in self.app.button if button.label == label), None)
+
+    def toggle_output(self):
+        """Expands the first collapsed output, if any."""
+        if len(self.app.toggle):
+            self.run('toggle_output', self.app.toggle[0].set_value(True))
+
+
+def drive_grader(session, steps):
+    """Display, expand an output, grade and move on, steps times."""
+    session.run('load')
+    for step in range(steps):
+        session.run('display', session.button('Display').click())
+        session.toggle_output()
+        session.run('grade', session.app.number_input[0].set_value(float(50 + step % 50)))
+        next_button = session.button('Next')
+        if next_button is None:
+            break
+        session.run('next', next_button.click())
+
+
+def drive_plagiarism(session, steps):
+    """Display the pair, then penalize or skip it, steps times."""
+    session.run('load')
+    for step in range(steps):
+        display = session.button('Display')
+        if display is None:
+            # no candidates
+            break
+        session.run('display', display.click())
+        session.toggle_output()
+        if step % 2 == 0:
+            session.run('penalize', session.app.button(key='penalize').click())
+        else:
+            session.run('skip', session.app.button(key='skip').click())
+
+
+def summarize_latencies(latencies, percentiles=(50, 90, 99)):
+    """
+    :param dict[str, list[float]] latencies: rerun seconds per interaction
+    :returns: number of reruns, percentiles and maximum per interaction
+    :rtype: dict
+    """
+    summary = {}
+    for interaction, values in latencies.items():
+        values = np.asarray(values)
+        summary[interaction] = dict({'count': len(values), 'max': float(values.max())},
+                                    **{f'p{q}': float(np.percentile(values, q)) for q in percentiles})
+    return summary
+
+
+def run_app(app, nr_students, nr_problems=5, copy_rate=0.2, image_kb=64, steps=20, tol_level=0.9, seed=0):
+    """
+    Generates a cohort and drives one app on it.
+
+    :param str app: 'grader' or 'plagiarism'
+    :returns: latency summary and peak memory
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as output_dir:
+        generate_cohort(path, nr_students=nr_students, nr_problems=nr_problems,
+                        copy_rate=copy_rate, image_kb=image_kb, seed=seed)
+        if app == 'grader':
+            session = Session(GRADER_SCRIPT.format(path=path, grades_db=f'{output_dir}/grades.sqlite'))
+            drive_grader(session, steps)
+        else:
+            session = Session(PLAGIARISM_SCRIPT.format(path=path, tol_level=tol_level))
+            drive_plagiarism(session, steps)
+
+    return {
+        'app': app,
+        'nr_students': nr_students,
+        'nr_problems': nr_problems,
+        'image_kb': image_kb,
+        'latencies': summarize_latencies(session.latencies),
+        'peak_rss_mb': um.peak_rss_mb(),
+    }
+
+
+def print_result(result):
+    print(f"\n{result['app']}, {result['nr_students']} students, peak rss {result['peak_rss_mb']:.1f} MB")
+    for interaction, summary in result['latencies'].items():
+        print(f"  {interaction:<14} n={summary['count']:<4} p50 {summary['p50'] * 1e3:8.1f}ms  "
+              f"p90 {summary['p90'] * 1e3:8.1f}ms  p99 {summary['p99'] * 1e3:8.1f}ms  "
+              f"max {summary['max'] * 1e3:8.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rerun latency benchmark of the streamlit apps.")
+
+    parser.add_argument('--apps', nargs='+', choices=APPS, default=list(APPS),
+                        help="Apps to benchmark.")
+    parser.add_argument('--nr_students', type=int, default=100,
+                        help="Cohort size.")
+    parser.add_argument('--nr_problems', type=int, default=5,
+                        help="Number of functions per notebook.")
+    parser.add_argument('--copy_rate', type=float, default=0.2,
+                        help="Fraction of students that copied.")
+    parser.add_argument('--image_kb', type=int, default=64,
+                        help="Size of a png output attached to every code cell.")
+    parser.add_argument('--steps', type=int, default=20,
+                        help="Number of submissions (or candidate pairs) to go through.")
+    parser.add_argument('--plagiarism_tol_level', type=float, default=0.9,
+                        help="Float between 0 and 1 for the plagiarism tolerance level.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_apps.json',
+                        help="Where to write the JSON results.")
+
+    args = parser.parse_args()
+
+    results = []
+    for app in args.apps:
+        # a fresh process per app, so that neither the memory nor the caches are shared
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = pool.submit(run_app, app, args.nr_students, args.nr_problems, args.copy_rate,
+                                 args.image_kb, args.steps, args.plagiarism_tol_level, args.seed).result()
+        print_result(result)
+        results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results,
+        }, f, indent=2)
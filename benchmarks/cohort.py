@@ -0,0 +1,233 @@
+import os
+import ast
+import json
+import zlib
+import base64
+import random
+import struct
+
+
+MUTATIONS = ('rename', 'reorder', 'dead_code', 'print')
+
+OPERATORS = ('+', '-', '*', '//', '%')
+COMPARATORS = ('<', '>', '==', '<=', '!=')
+
+
+class RandomSolution:
+    """
+    Generates structurally different solutions, so that independent students are not similar
+    after the names and the constants are normalized away.
+
+    :param random.Random rng: source of randomness
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def expr(self, names, depth=0):
+        if depth > 1 or self.rng.random() < 0.4:
+            if names and self.rng.random() < 0.7:
+                return self.rng.choice(names)
+            return str(self.rng.randint(0, 9))
+        return '({} {} {})'.format(self.expr(names, depth + 1),
+                                   self.rng.choice(OPERATORS),
+                                   self.expr(names, depth + 1))
+
+    def block(self, names, indent, depth=0):
+        lines = []
+        for _ in range(self.rng.randint(1, 4)):
+            kind = self.rng.choice(('assign', 'assign', 'for', 'if', 'while', 'list', 'call'))
+            if depth > 1:
+                kind = 'assign'
+            var = 'v{}'.format(len(names))
+            if kind == 'assign':
+                lines.append(f'{indent}{var} = {self.expr(names)}')
+                names.append(var)
+            elif kind == 'for':
+                lines.append(f'{indent}for {var} in range({self.expr(names)}):')
+                lines.extend(self.block(names + [var], indent + '    ', depth + 1))
+            elif kind == 'if':
+                lines.append(f'{indent}if {self.expr(names)} {self.rng.choice(COMPARATORS)} {self.expr(names)}:')
+                lines.extend(self.block(list(names), indent + '    ', depth + 1))
+                if self.rng.random() < 0.5:
+                    lines.append(f'{indent}else:')
+                    lines.extend(self.block(list(names), indent + '    ', depth + 1))
+            elif kind == 'while':
+                lines.append(f'{indent}{var} = {self.expr(names)}')
+                lines.append(f'{indent}while {var} > 0:')
+                lines.append(f'{indent}    {var} = {var} - 1')
+                names.append(var)
+            elif kind == 'list':
+                lines.append(f'{indent}{var} = [{self.expr(names)} for i in range({self.expr(names)})]')
+                lines.append(f'{indent}{var} = sum({var})')
+                names.append(var)
+            else:
+                lines.append(f'{indent}{var} = {self.rng.choice(("abs", "int", "max", "min"))}({self.expr(names)})')
+                names.append(var)
+        return lines
+
+    def function(self, name):
+        args = ['a{}'.format(i) for i in range(self.rng.randint(1, 3))]
+        names = list(args)
+        lines = [f'def {name}({", ".join(args)}):']
+        lines.extend(self.block(names, '    '))
+        lines.append(f'    return {self.expr(names)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Renamer(ast.NodeTransformer):
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def visit_Name(self, node):
+        node.id = self.mapping.get(node.id, node.id)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self.mapping.get(node.arg, node.arg)
+        return node
+
+    def visit_FunctionDef(self, node):
+        node.name = self.mapping.get(node.name, node.name)
+        self.generic_visit(node)
+        return node
+
+
+def mutate(functions, mutations, rng):
+    """
+    Applies the controlled mutations to a copied solution.
+
+    :param list[str] functions: source code of the functions, one per problem
+    :param list[str] mutations: subset of MUTATIONS
+    :param random.Random rng: source of randomness
+    :returns: mutated source code of the functions
+    :rtype: list[str]
+    """
+    trees = [ast.parse(code) for code in functions]
+
+    if 'rename' in mutations:
+        names = {n.id for tree in trees for n in ast.walk(tree) if isinstance(n, ast.Name)}
+        names |= {n.arg for tree in trees for n in ast.walk(tree) if isinstance(n, ast.arg)}
+        names -= {'range', 'sum', 'abs', 'int', 'max', 'min', 'print'}
+        mapping = {name: 'x{}_{}'.format(rng.randint(0, 10 ** 6), i) for i, name in enumerate(sorted(names))}
+        trees = [Renamer(mapping).visit(tree) for tree in trees]
+
+    for tree in trees:
+        body = tree.body[0].body
+        if 'dead_code' in mutations:
+            position = rng.randint(0, len(body) - 1)
+            body.insert(position, ast.parse('if False:\n    unused = 0').body[0])
+        if 'print' in mutations:
+            position = rng.randint(0, len(body) - 1)
+            body.insert(position, ast.parse(f'print({rng.randint(0, 9)})').body[0])
+
+    functions = [ast.unparse(ast.fix_missing_locations(tree)) + '\n' for tree in trees]
+
+    if 'reorder' in mutations:
+        rng.shuffle(functions)
+    return functions
+
+
+def png_bytes(rng, nr_bytes):
+    """
+    Encodes a random noise RGB image of roughly the requested size as a valid png.
+    """
+    side = max(1, int((nr_bytes / 3) ** 0.5))
+    rows = b''.join(b'\x00' + rng.randbytes(side * 3) for _ in range(side))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    header = struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def to_notebook(functions, outputs=None):
+    """
+    Builds a notebook dict with a markdown header and a code cell per problem.
+
+    :param list[str] functions: source code of the functions
+    :param list[list[dict]] outputs: optional outputs of every code cell
+    :rtype: dict
+    """
+    cells = []
+    for num, code in enumerate(functions):
+        cells.append({'cell_type': 'markdown', 'metadata': {},
+                      'source': [f'### Problem {num + 1}']})
+        cells.append({'cell_type': 'code', 'execution_count': num + 1, 'metadata': {},
+                      'outputs': outputs[num] if outputs else [],
+                      'source': code.splitlines(True)})
+    return {'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5}
+
+
+def generate_cohort(path, nr_students=50, nr_problems=5, copy_rate=0.2, group_size=2,
+                    mutations=MUTATIONS, image_kb=0, seed=0):
+    """
+    Generates a synthetic cohort of submissions in the layout expected by utils.misc.get_files
+    (path/<student>_<n>/<file>.ipynb) and records which students copied from whom.
+
+    :param str path: directory where the submission folders are created
+    :param int nr_students: size of the cohort
+    :param int nr_problems: number of functions per notebook
+    :param float copy_rate: fraction of students that copied their solution
+    :param int group_size: maximal number of copiers of one original solution
+    :param tuple[str] mutations: mutations that copiers randomly apply
+    :param int image_kb: size of a png output attached to every code cell, 0 for none
+    :param int seed: random seed
+    :returns: ground truth with copy groups as lists of student names
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    generator = RandomSolution(rng)
+    students = ['student{:04d}'.format(i) for i in range(nr_students)]
+
+    nr_copiers = int(nr_students * copy_rate)
+    copiers = set(rng.sample(students, nr_copiers))
+    originals = [s for s in students if s not in copiers]
+
+    solutions, outputs, applied = {}, {}, {}
+    for student in originals:
+        solutions[student] = [generator.function(f'problem{p + 1}') for p in range(nr_problems)]
+        outputs[student] = [[{'name': 'stdout', 'output_type': 'stream',
+                              'text': [f'{rng.random()}\n']}] for _ in range(nr_problems)]
+        if image_kb:
+            for cell_outputs in outputs[student]:
+                data = base64.b64encode(png_bytes(rng, image_kb * 1024)).decode()
+                cell_outputs.append({'data': {'image/png': data, 'text/plain': ['<Figure>']},
+                                     'metadata': {}, 'output_type': 'display_data'})
+
+    groups = {}
+    for student in sorted(copiers):
+        candidates = [s for s in originals if len(groups.get(s, [])) < group_size]
+        source = rng.choice(candidates or originals)
+        groups.setdefault(source, []).append(student)
+        applied[student] = sorted(rng.sample(mutations, rng.randint(1, len(mutations)))) if mutations else []
+        solutions[student] = mutate(solutions[source], applied[student], rng)
+        outputs[student] = outputs[source]
+
+    for num, student in enumerate(students):
+        folder = os.path.join(path, f'{student}_{num}')
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'homework.ipynb'), 'w', encoding='utf8') as f:
+            json.dump(to_notebook(solutions[student], outputs[student]), f)
+
+    return {
+        'students': students,
+        'groups': [[source] + members for source, members in sorted(groups.items())],
+        'mutations': applied,
+    }
+
+
+def true_pairs(truth):
+    """
+    All unordered student pairs that share the same original solution.
+
+    :param dict truth: output of generate_cohort
+    :rtype: set[frozenset[str]]
+    """
+    pairs = set()
+    for group in truth['groups']:
+        for i, a in enumerate(group):
+            for b in group[i + 1:]:
+                pairs.add(frozenset((a, b)))
+    return pairs
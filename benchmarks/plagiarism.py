@@ -0,0 +1,191 @@
+"""
+Times every stage of the plagiarism detection pipeline on synthetic cohorts
+and checks the detection quality against the known copy groups.
+
+    python -m benchmarks.plagiarism --sizes 50 200 --output bench.json
+    python -m benchmarks.plagiarism --sizes 50 200 --compare old_bench.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import utils.misc as um
+import utils.metrics as umt
+import utils.ingest as ui
+import utils.score_stats as uss
+from utils.plagiarism_detector import PlagiarismDetectorStreamlit
+from utils.code_similarity import fingerprint, compare, summarize
+from benchmarks.cohort import generate_cohort, true_pairs, MUTATIONS
+
+STAGE_TIMERS = {
+    'generate': 'benchmark.generate',
+    'load': 'benchmark.load',
+    'parse': 'similarity.parse',
+    'normalize': 'similarity.normalize',
+    'dump': 'similarity.dump',
+    'diff': 'similarity.diff',
+    'summarize': 'similarity.summarize',
+}
+
+
+def load_codes(path):
+    student2file = ui.get_submissions(path=path, file_type='ipynb')
+    return {submission.student: submission.code
+            for submission in ui.ingest(student2file, skip_commands=PlagiarismDetectorStreamlit.skip_commands)}
+
+
+def run_size(nr_students, nr_problems=5, copy_rate=0.2, image_kb=0, tol_level=0.9, seed=0):
+    """
+    Generates one cohort and runs the whole pipeline on it.
+
+    :returns: timings, counts, detection quality and peak memory
+    :rtype: dict
+    """
+    umt.reset()
+    with tempfile.TemporaryDirectory() as path:
+        with umt.timer('benchmark.generate'):
+            truth = generate_cohort(path, nr_students=nr_students, nr_problems=nr_problems,
+                                    copy_rate=copy_rate, image_kb=image_kb, seed=seed)
+        with umt.timer('benchmark.load'):
+            codes = load_codes(path)
+
+    token_ids = {}
+    names = list(codes)
+    func_infos = [fingerprint(codes[name], token_ids, keep_prints=True, module_level=True) for name in names]
+
+    flagged = set()
+    scores = {}
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            score, _, _ = summarize(compare(func_infos[i], func_infos[j]))
+            scores[frozenset((names[i], names[j]))] = score
+            if score > tol_level:
+                flagged.add(frozenset((names[i], names[j])))
+
+    timings = {stage: umt.get_time(name) for stage, name in STAGE_TIMERS.items()}
+    expected = true_pairs(truth)
+    hits = len(flagged & expected)
+    precision = hits / len(flagged) if flagged else 1.
+    recall = hits / len(expected) if expected else 1.
+
+    sketch = uss.ScoreSketch()
+    sketch.update(list(scores.values()))
+    thresholds = {}
+    for method in uss.THRESHOLDS[1:]:
+        threshold = sketch.threshold(method)
+        method_flagged = {pair for pair, score in scores.items() if score > threshold}
+        method_hits = len(method_flagged & expected)
+        thresholds[method] = {
+            'threshold': threshold,
+            'flagged': len(method_flagged),
+            'precision': method_hits / len(method_flagged) if method_flagged else 1.,
+            'recall': method_hits / len(expected) if expected else 1.,
+        }
+    return {
+        'nr_students': nr_students,
+        'nr_problems': nr_problems,
+        'nr_pairs': len(scores),
+        'nr_tokens': len(token_ids),
+        'timings': timings,
+        'total': sum(v for k, v in timings.items() if k != 'generate'),
+        'counters': umt.get_metrics()['counters'],
+        'peak_rss_mb': um.peak_rss_mb(),
+        'tol_level': tol_level,
+        'flagged': len(flagged),
+        'expected': len(expected),
+        'precision': precision,
+        'recall': recall,
+        'thresholds': thresholds,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """
+    Prints the per stage speedup of the new results relative to the old ones.
+    """
+    old_sizes = {r['nr_students']: r for r in old['results']}
+    for result in new['results']:
+        before = old_sizes.get(result['nr_students'])
+        if before is None:
+            continue
+        print(f"\n{result['nr_students']} students: {old.get('commit')} -> {new.get('commit')}")
+        for stage in tuple(STAGE_TIMERS) + ('total',):
+            a = before['timings'].get(stage, 0.) if stage != 'total' else before['total']
+            b = result['timings'].get(stage, 0.) if stage != 'total' else result['total']
+            ratio = a / b if b else float('nan')
+            print(f'  {stage:<10} {a:9.3f}s {b:9.3f}s  x{ratio:.2f}')
+        for key in ('peak_rss_mb', 'precision', 'recall'):
+            print(f'  {key:<10} {before[key]:9.3f}  {result[key]:9.3f}')
+
+
+def print_result(result):
+    print(f"\n{result['nr_students']} students, {result['nr_pairs']} pairs")
+    for stage, seconds in result['timings'].items():
+        print(f'  {stage:<10} {seconds:9.3f}s')
+    print(f"  {'total':<10} {result['total']:9.3f}s")
+    print(f"  peak rss {result['peak_rss_mb']:.1f} MB, precision {result['precision']:.3f}, "
+          f"recall {result['recall']:.3f} ({result['flagged']} flagged, {result['expected']} expected)")
+    for method, stats in result.get('thresholds', {}).items():
+        print(f"  {method} threshold {stats['threshold']:.3f}: precision {stats['precision']:.3f}, "
+              f"recall {stats['recall']:.3f} ({stats['flagged']} flagged)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plagiarism detection benchmark.")
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200],
+                        help="Cohort sizes to benchmark, e.g. 50 200 1000.")
+    parser.add_argument('--nr_problems', type=int, default=5,
+                        help="Number of functions per notebook.")
+    parser.add_argument('--copy_rate', type=float, default=0.2,
+                        help="Fraction of students that copied.")
+    parser.add_argument('--image_kb', type=int, default=0,
+                        help="Size of a png output attached to every code cell.")
+    parser.add_argument('--plagiarism_tol_level', type=float, default=0.9,
+                        help="Float between 0 and 1 for the plagiarism tolerance level.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_plagiarism.json',
+                        help="Where to write the JSON results.")
+    parser.add_argument('--compare', default=None,
+                        help="JSON results of a previous run to compare with.")
+
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        # a fresh process per size, so that the peak memory is not inherited from the previous size
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = pool.submit(run_size, size, args.nr_problems, args.copy_rate, args.image_kb,
+                                 args.plagiarism_tol_level, args.seed).result()
+        print_result(result)
+        results.append(result)
+
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'mutations': list(MUTATIONS),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            compare_results(json.load(f), output)
@@ -8,12 +8,39 @@ parser.add_argument('--path', default='sample_homeworks/with_assertions',
                     help="The path to the jupyter notebook files.")
 parser.add_argument('--plagiarism_tol_level', type=float, default=0.9,
                     help="Float between 0 and 1 for the plagiarism tolerance level.")
+parser.add_argument('--output_weight', type=float, default=0.5,
+                    help="Weight of the shared cell outputs (texts, plots) added to the code similarity, 0 to ignore them.")
+parser.add_argument('--threshold', choices=['fixed', 'top', 'zscore'], default='fixed',
+                    help="'fixed' uses the tolerance level, 'top' and 'zscore' derive it from the cohort's scores.")
+parser.add_argument('--top_share', type=float, default=0.01,
+                    help="Share of the highest scoring pairs flagged by the 'top' threshold.")
+parser.add_argument('--z_score', type=float, default=3.,
+                    help="Standard deviations above the mean score of the 'zscore' threshold.")
+parser.add_argument('--max_candidates', type=int, default=1000,
+                    help="Number of the highest scoring pairs kept for the review.")
+parser.add_argument('--decisions_db', default=None,
+                    help="SQLite file the review decisions are written into, defaults to grades.sqlite next to the submissions.")
+parser.add_argument('--reviewer', default=None,
+                    help="Name recorded with the review decisions, defaults to the user name.")
+parser.add_argument('--metrics_file', default=None,
+                    help="Optional .json file to write the timers and counters into.")
+parser.add_argument('--profile', action='store_true',
+                    help="Capture a cProfile of the run and show it in the sidebar.")
 
 args = parser.parse_args()
 
 if __name__ == "__main__":
     plagiarism_detector = PlagiarismDetectorStreamlit(path=args.path,
-                                                      tol_level=args.plagiarism_tol_level
+                                                      tol_level=args.plagiarism_tol_level,
+                                                      metrics_file=args.metrics_file,
+                                                      profile=args.profile,
+                                                      output_weight=args.output_weight,
+                                                      threshold=args.threshold,
+                                                      top_share=args.top_share,
+                                                      z_score=args.z_score,
+                                                      max_candidates=args.max_candidates,
+                                                      decisions_db=args.decisions_db,
+                                                      reviewer=args.reviewer,
                                                       )
 
     plagiarism_detector.detect()
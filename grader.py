@@ -6,10 +6,40 @@ parser = argparse.ArgumentParser(description="Homework checking.")
 
 parser.add_argument('--path', default='sample_homeworks/with_assertions',
                     help="The path to the jupyter notebook files.")
+parser.add_argument('--assertions', default=None,
+                    help="Notebook or .py file with the instructor assertion cells to autograde with.")
+parser.add_argument('--timeout', type=float, default=60,
+                    help="Seconds each submission is allowed to run when autograding.")
+parser.add_argument('--memory_mb', type=int, default=None,
+                    help="Memory limit of each submission when autograding.")
+parser.add_argument('--data_dir', default=None,
+                    help="Directory with the data files the submissions read.")
+parser.add_argument('--cache_dir', default=None,
+                    help="Directory of the execution cache, re-grading executes only what changed.")
+parser.add_argument('--grades_db', default=None,
+                    help="SQLite file the grades are written into, defaults to grades.sqlite next to the submissions.")
+parser.add_argument('--grader', default=None,
+                    help="Name recorded with the entered grades, defaults to the user name.")
+parser.add_argument('--workers', type=int, default=None,
+                    help="Number of submissions processed in parallel, defaults to the number of cores.")
+parser.add_argument('--metrics_file', default=None,
+                    help="Optional .json file to write the timers and counters into.")
+parser.add_argument('--profile', action='store_true',
+                    help="Capture a cProfile of the run and show it in the sidebar.")
 
 args = parser.parse_args()
 
 if __name__ == "__main__":
-    plagiarism_detector = GraderStreamlit(path=args.path)
+    plagiarism_detector = GraderStreamlit(path=args.path,
+                                         metrics_file=args.metrics_file,
+                                         profile=args.profile,
+                                         workers=args.workers,
+                                         assertions=args.assertions,
+                                         timeout=args.timeout,
+                                         memory_mb=args.memory_mb,
+                                         data_dir=args.data_dir,
+                                         cache_dir=args.cache_dir,
+                                         grades_db=args.grades_db,
+                                         grader=args.grader)
 
     plagiarism_detector.grade()
@@ -0,0 +1,368 @@
+import os
+import ast
+import sys
+import json
+import time
+import hashlib
+import secrets
+import tempfile
+import threading
+import subprocess
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import utils.notebook as un
+import utils.metrics as umt
+import utils.datasets as ud
+
+AssertionCell = namedtuple('AssertionCell', ['name', 'source'])
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_worker.py')
+
+
+def has_assertion(source):
+    """Checks if the code contains an assert statement."""
+    try:
+        return any(isinstance(node, ast.Assert) for node in ast.walk(ast.parse(clean_code(source))))
+    except SyntaxError:
+        return 'assert ' in source
+
+
+def clean_code(source):
+    """
+    Removes the notebook-only lines (shell commands, magics) that are not valid python.
+
+    :param str source: code cell source
+    :rtype: str
+    """
+    return ''.join(line for line in source.splitlines(True)
+                   if not line.lstrip().startswith(('!', '%', 'get_ipython()')))
+
+
+def load_assertions(file_name):
+    """
+    Reads the instructor assertion cells, i.e. the code cells of a notebook
+    (or the whole .py file) that contain assert statements.
+    A cell is named after its first comment line, e.g. '# Problem 1'.
+
+    :param str file_name: .ipynb or .py file with the assertions
+    :returns: assertion cells
+    :rtype: list[AssertionCell]
+    """
+    if file_name.endswith('.py'):
+        with open(file_name, encoding='utf8') as f:
+            sources = [f.read()]
+    else:
+        sources = un.LazyNotebook(file_name).code_cells()
+
+    assertions = []
+    for source in sources:
+        if not has_assertion(source):
+            continue
+        first_line = source.strip().splitlines()[0]
+        name = first_line.lstrip('# ').strip() if first_line.startswith('#') else f'assertion {len(assertions) + 1}'
+        assertions.append(AssertionCell(name, clean_code(source)))
+    return assertions
+
+
+def normalize_source(source):
+    """
+    Normalizes a cell for the cache keys, so that comments and formatting do not matter.
+
+    :param str source: code cell source
+    :rtype: str
+    """
+    source = clean_code(source)
+    try:
+        return ast.dump(ast.parse(source))
+    except SyntaxError:
+        return '\n'.join(line.rstrip() for line in source.splitlines() if line.strip())
+
+
+def _sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ExecutionCache:
+    """
+    Content-addressed cache of the execution results.
+
+    Every code cell is keyed by the hash of its normalized source chained with the key of the
+    previous cell, the chain starts from the hash of the data files, so a key changes only if the
+    cell, one of the cells before it or the data changed. Cell results, assertion results (keyed by
+    the key of the last cell and the assertion source) and, after slow cells, the pickled namespace
+    are stored under these keys, so reruns execute only the cells that changed. The assertions
+    may depend on each other, they all run again when one of them is not cached.
+
+    :param str cache_dir: directory of the cache
+    """
+
+    def __init__(self, cache_dir):
+        # the workers run inside their temporary working directories
+        self.cache_dir = os.path.abspath(cache_dir)
+        self._data_keys = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def data_key(self, data_dir):
+        """
+        :param str data_dir: directory with the data files, None for no data
+        :returns: hash of the names and contents of the files
+        :rtype: str
+        """
+        if not data_dir:
+            return _sha256('')
+        files = []
+        for root, _, names in os.walk(data_dir, followlinks=True):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((os.path.relpath(path, data_dir), stat.st_size, stat.st_mtime_ns, path))
+        files.sort()
+        state = tuple(file[:3] for file in files)
+        with self._lock:
+            if self._data_keys.get(data_dir, (None,))[0] == state:
+                return self._data_keys[data_dir][1]
+        parts = []
+        for name, _, _, path in files:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    digest.update(block)
+            parts.extend([name, digest.hexdigest()])
+        key = _sha256(*parts)
+        with self._lock:
+            self._data_keys[data_dir] = (state, key)
+        return key
+
+    @staticmethod
+    def chain_keys(cells, data_key):
+        """
+        :param list[str] cells: code cell sources
+        :param str data_key: output of data_key
+        :returns: key of every cell
+        :rtype: list[str]
+        """
+        keys = []
+        key = data_key
+        for source in cells:
+            key = _sha256(key, normalize_source(source))
+            keys.append(key)
+        return keys
+
+    @staticmethod
+    def assertion_key(last_key, assertion):
+        return _sha256(last_key, 'assertion', normalize_source(assertion.source))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                umt.count('autograder.cache_hits')
+                return json.load(f)
+        except (OSError, ValueError):
+            umt.count('autograder.cache_misses')
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+
+def _link_data(data_dir, work_dir):
+    for entry in os.listdir(data_dir):
+        target = os.path.join(work_dir, entry)
+        try:
+            os.symlink(os.path.abspath(os.path.join(data_dir, entry)), target)
+        except OSError:
+            import shutil
+
+            copy = shutil.copytree if os.path.isdir(os.path.join(data_dir, entry)) else shutil.copy
+            copy(os.path.join(data_dir, entry), target)
+
+
+def _run_worker(job, data_dir, timeout):
+    """
+    Runs the worker in a new temporary working directory.
+
+    :returns: the results written by the worker, None if it did not finish cleanly, and the process
+    :rtype: tuple
+    :raises subprocess.TimeoutExpired: if the worker runs longer than timeout
+    """
+    env = dict(os.environ, MPLBACKEND='Agg')
+
+    # the results come through an anonymous file inherited by the worker, not its stdout
+    with tempfile.TemporaryDirectory(prefix='autograder_') as work_dir, tempfile.TemporaryFile() as result_file:
+        if data_dir:
+            _link_data(data_dir, work_dir)
+        job = dict(job, result_fd=result_file.fileno(), token=secrets.token_hex(16))
+        process = subprocess.run([sys.executable, '-I', WORKER], input=json.dumps(job),
+                                 capture_output=True, text=True, timeout=timeout,
+                                 cwd=work_dir, env=env, pass_fds=(result_file.fileno(),))
+        result_file.seek(0)
+        output = result_file.read()
+
+    try:
+        result = json.loads(output) if process.returncode == 0 else None
+    except ValueError:
+        result = None
+    if result is None or result.pop('token', None) != job['token']:
+        return None, process
+    return result, process
+
+
+def run_submission(cells, assertions, timeout=60, memory_mb=None, data_dir=None,
+                   cache=None, data_key=None, snapshot_after=1., datasets=None):
+    """
+    Executes the code cells and then the assertion cells in a separate interpreter
+    inside a temporary working directory.
+
+    :param list[str] cells: code cell sources of the submission
+    :param list[AssertionCell] assertions: instructor assertion cells
+    :param float timeout: seconds the whole notebook is allowed to run
+    :param int memory_mb: address space limit of the interpreter, None for no limit
+    :param str data_dir: directory (or zip archive, extracted once) whose files are made available
+        in the working directory
+    :param ExecutionCache cache: optional cache of the results, only the changed cells are executed
+    :param str data_key: hash of the data files, computed from data_dir if not provided
+    :param float snapshot_after: seconds of execution after which the namespace is cached
+    :param dict datasets: the converted CSV files of the data archive, see utils.datasets.dataset_dirs,
+        computed from data_dir if not provided
+    :returns: per cell errors, per assertion results and the status of the run
+    :rtype: dict
+    """
+    if datasets is None:
+        datasets = ud.dataset_dirs(data_dir)
+    data_dir = ud.resolve_data_dir(data_dir)
+    keys, cached = None, {}
+    if cache is not None:
+        if data_key is None:
+            data_key = cache.data_key(data_dir)
+        keys = cache.chain_keys(cells, data_key)
+        last_key = keys[-1] if keys else data_key
+        for num, assertion in enumerate(assertions):
+            result = cache.get(cache.assertion_key(last_key, assertion))
+            if result is None:
+                break
+            cached[num] = dict(result, name=assertion.name)
+        else:
+            return {'cells': [dict(cache.get(key) or {}, cached=True) for key in keys],
+                    'assertions': [cached[num] for num in range(len(assertions))],
+                    'status': 'cached'}
+
+    job = {
+        'cells': [clean_code(source) for source in cells],
+        'assertions': [assertion._asdict() for assertion in assertions],
+        'memory_mb': memory_mb,
+        'timeout': timeout,
+        'keys': keys,
+        'cache_dir': cache.cache_dir if cache is not None else None,
+        'snapshot_after': snapshot_after,
+        'datasets': datasets,
+    }
+    start = time.perf_counter()
+    try:
+        with umt.timer('autograder.run'):
+            result, process = _run_worker(job, data_dir, timeout)
+            if result is not None and result.get('rerun'):
+                # an assertion failed after a restored snapshot, confirmed by a run from the first cell
+                # within what is left of the timeout
+                umt.count('autograder.cold_reruns')
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(WORKER, timeout)
+                result, process = _run_worker(dict(job, restore=False, timeout=remaining), data_dir, remaining)
+    except subprocess.TimeoutExpired:
+        umt.count('autograder.timeouts')
+        return failed_result(assertions, status='timeout')
+
+    if result is None:
+        umt.count('autograder.crashes')
+        error = process.stderr.strip().splitlines()[-1:] or [f'exit code {process.returncode}']
+        return failed_result(assertions, status='crashed', error=error[0])
+    result['status'] = 'finished'
+
+    if cache is not None:
+        for num, (key, cell) in enumerate(zip(keys, result['cells'])):
+            if cell.get('cached'):
+                result['cells'][num] = dict(cache.get(key) or {}, cached=True)
+            else:
+                cache.put(key, cell)
+        for assertion, assertion_result in zip(assertions, result['assertions']):
+            cache.put(cache.assertion_key(last_key, assertion), assertion_result)
+    return result
+
+
+def failed_result(assertions, status, error=None):
+    return {
+        'cells': [],
+        'assertions': [{'name': assertion.name, 'passed': False, 'error': error or status, 'time': None}
+                       for assertion in assertions],
+        'status': status,
+    }
+
+
+def score(result):
+    """
+    :param dict result: output of run_submission
+    :returns: fraction of the passed assertions
+    :rtype: float
+    """
+    assertions = result['assertions']
+    if not assertions:
+        return 0.
+    return sum(assertion['passed'] for assertion in assertions) / len(assertions)
+
+
+def autograde(student2file, assertions, workers=None, timeout=60, memory_mb=None, data_dir=None,
+              cache_dir=None, snapshot_after=1.):
+    """
+    Runs every submission in its own interpreter, as many at a time as there are workers.
+    Submissions with identical code cells share one execution.
+
+    :param dict student2file: student name to notebook file (see utils.ingest.get_submissions)
+    :param list[AssertionCell] assertions: instructor assertion cells
+    :param int workers: number of submissions executed in parallel, defaults to the number of cores
+    :param float timeout: seconds each notebook is allowed to run
+    :param int memory_mb: address space limit of each interpreter
+    :param str data_dir: directory (or zip archive, extracted once) whose files are made available
+        to the submissions, the CSV files of an archive are read from the column store of utils.datasets
+    :param str cache_dir: optional directory of the ExecutionCache, reruns execute only what changed
+    :param float snapshot_after: seconds of execution after which the namespace is cached
+    :returns: generator of (student, result) pairs in the order they finish
+    :rtype: collections.abc.Iterator[tuple[str, dict]]
+    """
+    datasets = ud.dataset_dirs(data_dir)
+    data_dir = ud.resolve_data_dir(data_dir)
+    cache = ExecutionCache(cache_dir) if cache_dir else None
+    data_key = cache.data_key(data_dir) if cache is not None else None
+
+    groups = {}
+    for student in student2file:
+        cells = un.LazyNotebook(student2file[student]).code_cells()
+        group_key = _sha256(*(normalize_source(source) for source in cells))
+        groups.setdefault(group_key, (cells, []))[1].append(student)
+    umt.count('autograder.shared_executions', len(student2file) - len(groups))
+
+    def grade_group(cells):
+        return run_submission(cells, assertions, timeout=timeout, memory_mb=memory_mb, data_dir=data_dir,
+                              cache=cache, data_key=data_key, snapshot_after=snapshot_after, datasets=datasets)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(grade_group, cells): students for cells, students in groups.values()}
+        for future in as_completed(futures):
+            result = future.result()
+            for student in futures[future]:
+                umt.count('autograder.submissions')
+                yield student, result
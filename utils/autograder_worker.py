@@ -0,0 +1,307 @@
+"""
+Executes the code cells of one submission followed by the instructor assertion cells.
+
+Started by utils.autograder in a separate isolated interpreter (python -I) inside a temporary
+working directory, reads the job as json from stdin and writes the results as json into the
+result file descriptor inherited from utils.autograder, together with the token of the job.
+The standard output of the submission is not read, so printing a result cannot forge one.
+With a cache directory, the namespace is pickled after slow cells under the chain key of the
+cell and restored instead of re-executing the unchanged cells.
+Only the standard library is imported here, numpy and pandas only to serve the converted datasets.
+"""
+import os
+import ast
+import sys
+import json
+import time
+import types
+import pickle
+import functools
+import importlib
+import traceback
+
+
+def limit_resources(memory_mb=None, cpu_seconds=None):
+    try:
+        import resource
+    except ImportError:
+        return
+    if memory_mb:
+        limit = int(memory_mb) * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if cpu_seconds:
+        limit = int(cpu_seconds) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, limit))
+
+
+def run_cell(source, namespace):
+    """
+    :returns: the error message, None if the cell succeeded, and the duration
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    try:
+        exec(compile(source, '<cell>', 'exec'), namespace)
+        error = None
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:  # SystemExit of exit() calls included
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+    return error, time.perf_counter() - start
+
+
+def snapshot_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + '.pkl')
+
+
+def definitions(sources):
+    """Top level functions and classes of the cells, in order."""
+    nodes = []
+    for source in sources:
+        try:
+            body = ast.parse(source).body
+        except SyntaxError:
+            continue
+        nodes.extend(node for node in body
+                     if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)))
+    return nodes
+
+
+def work_files(data_entries, max_bytes=64 * 2 ** 20):
+    """
+    Files written by the cells into the working directory, the data files linked into it excluded.
+
+    :returns: relative path to content, None if they are more than max_bytes
+    :rtype: dict[str, bytes] or None
+    """
+    files, size = {}, 0
+    for entry in os.listdir('.'):
+        if entry in data_entries:
+            continue
+        paths = [entry] if not os.path.isdir(entry) else [
+            os.path.join(root, name) for root, _, names in os.walk(entry) for name in names]
+        for path in paths:
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            size += os.path.getsize(path)
+            if size > max_bytes:
+                return None
+            with open(path, 'rb') as f:
+                files[path] = f.read()
+    return files
+
+
+def clean_work_dir(data_entries):
+    """Removes what the cells wrote into the working directory."""
+    import shutil
+
+    for entry in os.listdir('.'):
+        if entry not in data_entries:
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.remove(entry)
+
+
+def random_states():
+    """States of the random generators of random and numpy, numpy only if the cells imported it."""
+    import random
+
+    states = {'random': random.getstate()}
+    if 'numpy' in sys.modules:
+        states['numpy'] = sys.modules['numpy'].random.get_state()
+    return states
+
+
+def set_random_states(states):
+    import random
+
+    random.setstate(states['random'])
+    if 'numpy' in states:
+        importlib.import_module('numpy').random.set_state(states['numpy'])
+
+
+def save_snapshot(path, namespace, sources, data_entries):
+    """
+    Pickles the namespace after the given cells with the files written into the working directory
+    and the states of the random generators. Modules are stored by name and the functions and
+    classes defined in the cells are re-executed on restore. If anything else cannot be pickled
+    (e.g. instances of classes defined in the cells) or the files are too large no snapshot is saved.
+    The state of the imported modules (e.g. options set on them) is not saved, see main.
+
+    :returns: whether the snapshot was saved
+    :rtype: bool
+    """
+    defined = {node.name for node in definitions(sources)}
+    values, modules = {}, {}
+    for name, value in namespace.items():
+        if name.startswith('__'):
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            if name in defined and getattr(value, '__module__', None) == '__main__':
+                continue
+            return False
+        values[name] = value
+    files = work_files(data_entries)
+    if files is None:
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'values': values, 'modules': modules, 'files': files, 'random': random_states()}, f)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def restore_snapshot(path, namespace, sources):
+    """
+    :returns: whether the namespace was restored
+    :rtype: bool
+    """
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        for name, module in snapshot['modules'].items():
+            namespace[name] = importlib.import_module(module)
+        namespace.update(snapshot['values'])
+        nodes = [node for node in definitions(sources) if node.name not in snapshot['values']]
+        exec(compile(ast.Module(body=nodes, type_ignores=[]), '<cell>', 'exec'), namespace)
+        for file_name, content in snapshot['files'].items():
+            if os.path.dirname(file_name):
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, 'wb') as f:
+                f.write(content)
+        set_random_states(snapshot['random'])
+    except Exception:
+        return False
+    return True
+
+
+def run_cells(sources, namespace, start, keys, cache_dir, snapshot_after, data_entries):
+    """
+    Runs the cells from start on, the namespace is saved after every snapshot_after seconds of execution.
+
+    :returns: the error and the duration of every cell
+    :rtype: list[dict]
+    """
+    cells = [{'cached': True}] * start
+    since_snapshot = 0.
+    for idx in range(start, len(sources)):
+        error, duration = run_cell(sources[idx], namespace)
+        cells.append({'error': error, 'time': duration})
+        since_snapshot += duration
+        if cache_dir and keys and since_snapshot >= snapshot_after:
+            if save_snapshot(snapshot_path(cache_dir, keys[idx]), namespace, sources[:idx + 1], data_entries):
+                since_snapshot = 0.
+    return cells
+
+
+def run_assertions(assertions, namespace):
+    results = []
+    for assertion in assertions:
+        error, duration = run_cell(assertion['source'], namespace)
+        results.append({'name': assertion['name'], 'passed': error is None, 'error': error, 'time': duration})
+    return results
+
+
+def load_columns(dataset_dir):
+    """
+    utils.datasets.load_columns for the submissions: the numeric columns are mapped copy-on-write, so they
+    are shared by the workers but can be changed, and the text columns are strings like read_csv returns them.
+    """
+    import numpy as np
+    import pandas as pd
+
+    with open(os.path.join(dataset_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {}
+    for column in meta['columns']:
+        # a plain array view of the mapping, like the arrays read_csv returns
+        values = np.load(os.path.join(dataset_dir, column['file']), mmap_mode='c', allow_pickle=False).view(np.ndarray)
+        if column['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=column['categories'],
+                                               validate=False).to_numpy(dtype=object)
+        columns[column['name']] = values
+    return pd.DataFrame(columns, index=pd.RangeIndex(meta['nrows']), copy=False)
+
+
+def serve_datasets(datasets):
+    """
+    Makes pandas.read_csv of a converted data file (without other arguments) return its columns from
+    the column store instead of parsing it, see utils.datasets.dataset_dirs.
+
+    :param dict[str, str] datasets: path relative to the working directory to the dataset directory
+    """
+    import pandas as pd
+
+    read_csv = pd.read_csv
+    paths = {os.path.abspath(member): dataset_dir for member, dataset_dir in datasets.items()}
+
+    @functools.wraps(read_csv)
+    def read_dataset(filepath_or_buffer, *args, **kwargs):
+        if not args and not kwargs and isinstance(filepath_or_buffer, (str, os.PathLike)):
+            dataset_dir = paths.get(os.path.abspath(filepath_or_buffer))
+            if dataset_dir is not None:
+                return load_columns(dataset_dir)
+        return read_csv(filepath_or_buffer, *args, **kwargs)
+
+    pd.read_csv = read_dataset
+
+
+def write_result(fd, result):
+    data = json.dumps(result).encode('utf8')
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def main():
+    job = json.load(sys.stdin)
+    # kept out of the namespace of the executed code and out of its subprocesses
+    result_fd, token = job.pop('result_fd'), job.pop('token')
+    os.set_inheritable(result_fd, False)
+    limit_resources(job.get('memory_mb'), job.get('timeout'))
+
+    sources = job['cells']
+    keys = job.get('keys')
+    cache_dir = job.get('cache_dir')
+    snapshot_after = job.get('snapshot_after', 1.)
+
+    namespace = {'__name__': '__main__'}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    data_entries = set(os.listdir('.'))
+    if job.get('datasets'):
+        serve_datasets(job['datasets'])
+    # -I leaves the working directory out of the path, the helper modules of the data are imported from it
+    sys.path.insert(0, os.getcwd())
+
+    # resume after the longest prefix of the cells whose state is cached
+    start = 0
+    if cache_dir and keys and job.get('restore', True):
+        for idx in reversed(range(len(keys))):
+            path = snapshot_path(cache_dir, keys[idx])
+            if os.path.exists(path):
+                if restore_snapshot(path, namespace, sources[:idx + 1]):
+                    start = idx + 1
+                    break
+                namespace = {'__name__': '__main__'}
+                clean_work_dir(data_entries)
+
+    cells = run_cells(sources, namespace, start, keys, cache_dir, snapshot_after, data_entries)
+    assertions = run_assertions(job['assertions'], namespace)
+    if start and not all(assertion['passed'] for assertion in assertions):
+        # a restored namespace misses what was not saved (e.g. the state of the imported modules),
+        # the failures count only if a run from the first cell in a new interpreter confirms them
+        write_result(result_fd, {'token': token, 'rerun': True})
+        return
+
+    sys.stdout = stdout
+    write_result(result_fd, {'token': token, 'cells': cells, 'assertions': assertions})
+
+
+if __name__ == '__main__':
+    main()
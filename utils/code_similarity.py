@@ -1,12 +1,18 @@
+import io
 import ast
 import difflib
+import keyword
 import operator
 import argparse
 import itertools
+import tokenize
 
+from array import array
 from collections import Counter
 from collections.abc import Sequence
 
+import utils.metrics as umt
+
 
 class BaseNodeNormalizer(ast.NodeTransformer):
     """
@@ -226,6 +232,13 @@ class FuncNodeCollector(BaseNodeNormalizer):
 
 class FuncInfo(object):
     """
+    Compact fingerprint of a function (or module) node.
+
+    The node is dumped once on construction, every dumped line is interned into an int
+    and only the token array, its hash, the name and the line span are kept, so that
+    neither the AST nor the source lines stay alive for the rest of the run.
+    The source can be re-sliced with get_func_code when it is needed for display.
+
     Part of the astor library for Python AST manipulation.
 
     License: 3-clause BSD
@@ -235,18 +248,30 @@ class FuncInfo(object):
 
     """
 
+    __slots__ = ('_func_name', '_tokens', '_hash', 'lineno', 'endlineno', 'col_offset')
+
     class NonExistent(object):
         pass
 
-    def __init__(self, func_node, code_lines):
+    def __init__(self, func_node, token_ids=None, func_name=None):
+        """
+        :param ast.FunctionDef or ast.Module func_node: normalized node
+        :param dict[str, int] token_ids: shared mapping of dumped lines to token ids,
+            pass the same dict to all the records that are compared with each other
+        :param str func_name: name already popped from the node, so that it is not dumped
+        """
         assert isinstance(func_node, (ast.FunctionDef, ast.Module))
-        self._func_node = func_node
-        self._code_lines = code_lines
-        self._func_name = func_node.__dict__.pop('name', '')
-        self._func_code = None
-        self._func_code_lines = None
-        self._func_ast = None
-        self._func_ast_lines = None
+        if token_ids is None:
+            token_ids = {}
+        if func_name is None:
+            func_name = func_node.__dict__.pop('name', '')
+        self._func_name = func_name
+        self.lineno = getattr(func_node, 'lineno', 0)
+        self.endlineno = getattr(func_node, 'endlineno', -1)
+        self.col_offset = getattr(func_node, 'col_offset', 0)
+        self._tokens = array('l', [token_ids.setdefault(line, len(token_ids))
+                                   for line in self._dump(func_node).splitlines(True)])
+        self._hash = hash(self._tokens.tobytes())
 
     def __str__(self):
         return '<' + type(self).__name__ + ': ' + self.func_name + '>'
@@ -256,37 +281,26 @@ class FuncInfo(object):
         return self._func_name
 
     @property
-    def func_node(self):
-        return self._func_node
-
-    @property
-    def func_code(self):
-        if self._func_code is None:
-            self._func_code = ''.join(self.func_code_lines)
-        return self._func_code
+    def func_tokens(self):
+        return self._tokens
 
     @property
-    def func_code_lines(self):
-        if self._func_code_lines is None:
-            self._func_code_lines = self._retrieve_func_code_lines(self._func_node, self._code_lines)
-        return self._func_code_lines
+    def func_hash(self):
+        return self._hash
 
-    @property
-    def func_ast(self):
-        if self._func_ast is None:
-            self._func_ast = self._dump(self._func_node)
-        return self._func_ast
+    def get_func_code(self, code):
+        """
+        Re-slices the function source from the code it was parsed from.
 
-    @property
-    def func_ast_lines(self):
-        if self._func_ast_lines is None:
-            self._func_ast_lines = self.func_ast.splitlines(True)
-        return self._func_ast_lines
+        :param str or list[str] code: the whole source, e.g. re-read from disk
+        :return: str
+        """
+        if isinstance(code, str):
+            code = code.splitlines(True)
+        return ''.join(self._retrieve_func_code_lines(self, code))
 
     @staticmethod
     def _retrieve_func_code_lines(func_node, code_lines):
-        if not isinstance(func_node, (ast.FunctionDef, ast.Module)):
-            return []
         if not isinstance(code_lines, Sequence) or isinstance(code_lines, str):
             return []
         if getattr(func_node, 'endlineno', -1) < getattr(func_node, 'lineno', 0):
@@ -380,10 +394,13 @@ class FuncDiffInfo(object):
     An object stores the result of candidate python code compared to referenced python code.
     """
 
-    info_ref = None
-    info_candidate = None
-    plagiarism_count = 0
-    total_count = 0
+    __slots__ = ('info_ref', 'info_candidate', 'plagiarism_count', 'total_count')
+
+    def __init__(self, info_ref=None, info_candidate=None, plagiarism_count=0, total_count=0):
+        self.info_ref = info_ref
+        self.info_candidate = info_candidate
+        self.plagiarism_count = plagiarism_count
+        self.total_count = total_count
 
     @property
     def plagiarism_percent(self):
@@ -393,11 +410,11 @@ class FuncDiffInfo(object):
         if isinstance(self.info_ref, FuncInfo) and isinstance(self.info_candidate, FuncInfo):
             return '{:<4.2}: ref {}, candidate {}'.format(self.plagiarism_percent,
                                                           self.info_ref.func_name + '<' + str(
-                                                              self.info_ref.func_node.lineno) + ':' + str(
-                                                              self.info_ref.func_node.col_offset) + '>',
+                                                              self.info_ref.lineno) + ':' + str(
+                                                              self.info_ref.col_offset) + '>',
                                                           self.info_candidate.func_name + '<' + str(
-                                                              self.info_candidate.func_node.lineno) + ':' + str(
-                                                              self.info_candidate.func_node.col_offset) + '>')
+                                                              self.info_candidate.lineno) + ':' + str(
+                                                              self.info_candidate.col_offset) + '>')
         return '{:<4.2}: ref {}, candidate {}'.format(0, None, None)
 
 
@@ -413,8 +430,10 @@ class UnifiedDiff(object):
         """
         assert a is not None
         assert b is not None
-        a = a.func_ast_lines
-        b = b.func_ast_lines
+        if a.func_hash == b.func_hash and a.func_tokens == b.func_tokens:
+            return 0
+        a = a.func_tokens
+        b = b.func_tokens
 
         def _gen():
             for group in difflib.SequenceMatcher(None, a, b).get_grouped_opcodes(0):
@@ -435,7 +454,7 @@ class UnifiedDiff(object):
     @staticmethod
     def total(a, b):
         assert a is not None  # b may be None
-        return len(a.func_ast_lines)
+        return len(a.func_tokens)
 
 
 class NoFuncException(Exception):
@@ -444,26 +463,156 @@ class NoFuncException(Exception):
         self.source = source
 
 
-def detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False):
-    if len(pycode_string_list) < 2:
-        return []
-
-    func_info_list = []
-    for index, code_str in enumerate(pycode_string_list):
-        root_node = ast.parse(code_str)
+def fingerprint(code_str, token_ids=None, keep_prints=False, module_level=False):
+    """
+    Parses the code and turns every function (and optionally the module level code)
+    into a compact FuncInfo record, the parsed trees are released right after.
+
+    :param str code_str: python source
+    :param dict[str, int] token_ids: shared mapping of dumped lines to token ids
+    :param bool keep_prints: specifies whether to keep the print calls
+    :param bool module_level: specifies whether to add a record for the module level code
+    :returns: function records
+    :rtype: list[FuncInfo]
+    """
+    if token_ids is None:
+        token_ids = {}
+    try:
+        with umt.timer('similarity.parse'):
+            root_node = ast.parse(code_str)
+    except SyntaxError:
+        umt.count('similarity.parse_failures')
+        raise
+    with umt.timer('similarity.normalize'):
         collector = FuncNodeCollector(keep_prints=keep_prints)
         collector.visit(root_node)
-        code_utf8_lines = code_str.splitlines(True)
-        func_info = [FuncInfo(n, code_utf8_lines) for n in collector.get_function_nodes()]
-        if module_level:
+        func_nodes = collector.get_function_nodes()
+        # names of nested functions should not end up in the dump of the enclosing one
+        func_names = [n.__dict__.pop('name', '') for n in func_nodes]
+    with umt.timer('similarity.dump'):
+        func_info = [FuncInfo(n, token_ids, func_name=name) for n, name in zip(func_nodes, func_names)]
+    if module_level:
+        with umt.timer('similarity.parse'):
             root_node = ast.parse(code_str)
+        with umt.timer('similarity.normalize'):
             collector = ModuleNodeCollector(keep_prints=keep_prints)
             collector.visit(root_node)
             module_node = collector.get_module_node()
-            module_node.endlineno = len(code_utf8_lines)
-            module_info = FuncInfo(module_node, code_utf8_lines)
-            func_info.append(module_info)
-        func_info_list.append((index, func_info))
+            module_node.endlineno = len(code_str.splitlines())
+        with umt.timer('similarity.dump'):
+            func_info.append(FuncInfo(module_node, token_ids))
+    return func_info
+
+
+# tokens that carry no structure, and the f-string parts of python 3.12+
+_SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER, tokenize.ERRORTOKEN,
+                   getattr(tokenize, 'FSTRING_MIDDLE', None), getattr(tokenize, 'FSTRING_END', None)}
+_TOKEN_NAMES = {tokenize.NUMBER: 'CONST', tokenize.STRING: 'STR', tokenize.NEWLINE: 'NEWLINE',
+                tokenize.INDENT: 'INDENT', tokenize.DEDENT: 'DEDENT',
+                getattr(tokenize, 'FSTRING_START', None): 'STR'}
+
+
+def _logical_lines(code_str):
+    """
+    Tokens of the code grouped by logical line, as far as the code can be tokenized.
+
+    :rtype: collections.abc.Iterator[list[tokenize.TokenInfo]]
+    """
+    line = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code_str).readline):
+            if token.type in _SKIPPED_TOKENS:
+                continue
+            line.append(token)
+            if token.type in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT):
+                yield line
+                line = []
+    except (tokenize.TokenError, SyntaxError):
+        # e.g. an unclosed bracket or a wrong indentation, the rest of the code is lost
+        umt.count('similarity.tokenize_failures')
+    if line:
+        yield line
+
+
+def normalize_tokens(code_str, keep_prints=False):
+    """
+    Token stream of the code normalized like BaseNodeNormalizer does it with the AST: the names
+    and the literals are erased, the imports, the docstrings (string statements) and optionally
+    the print statements are removed. The parentheses are dropped too, the AST does not keep the
+    redundant ones. Works on code that ast.parse rejects.
+
+    :param str code_str: python source, not necessarily valid
+    :param bool keep_prints: specifies whether to keep the print calls
+    :returns: the normalized tokens
+    :rtype: list[str]
+    """
+    tokens = []
+    for line in _logical_lines(code_str):
+        first = line[0]
+        statement = [token for token in line if token.type != tokenize.NEWLINE]
+        if first.type == tokenize.NAME and first.string in ('import', 'from'):
+            continue
+        if statement and all(token.type == tokenize.STRING for token in statement):
+            continue
+        if (not keep_prints and first.string == 'print' and len(statement) > 1 and statement[1].string == '('
+                and statement[-1].string == ')'):
+            continue
+        for token in line:
+            if token.string in ('(', ')') and token.type == tokenize.OP:
+                continue
+            if token.type == tokenize.NAME:
+                tokens.append(token.string if keyword.iskeyword(token.string) else 'NAME')
+            else:
+                tokens.append(_TOKEN_NAMES.get(token.type, token.string))
+    return tokens
+
+
+@umt.timed('similarity.tokenize')
+def token_fingerprint(code_str, k=8, window=4, keep_prints=False):
+    """
+    Winnowed k-gram fingerprint of the normalized tokens (see normalize_tokens): the hashes of all
+    the k token long sequences are taken and the minimum of every window of them is kept, so that
+    every common sequence of at least window + k - 1 tokens shares a hash.
+
+    :param str code_str: python source, not necessarily valid
+    :param int k: number of tokens per k-gram
+    :param int window: number of consecutive k-grams a hash is selected from
+    :param bool keep_prints: specifies whether to keep the print calls
+    :returns: the selected hashes, comparable within the process like the token ids of FuncInfo
+    :rtype: frozenset[int]
+    """
+    tokens = normalize_tokens(code_str, keep_prints=keep_prints)
+    if not tokens:
+        return frozenset()
+    hashes = [hash(tuple(tokens[i:i + k])) for i in range(max(len(tokens) - k + 1, 1))]
+    if len(hashes) <= window:
+        return frozenset([min(hashes)])
+    return frozenset(min(hashes[i:i + window]) for i in range(len(hashes) - window + 1))
+
+
+def token_similarity(fingerprint_ref, fingerprint_candidate):
+    """
+    :param frozenset[int] fingerprint_ref: token_fingerprint of the reference code
+    :param frozenset[int] fingerprint_candidate: token_fingerprint of the candidate code
+    :returns: the share of the hashes of the smaller fingerprint found in the other one
+    :rtype: float
+    """
+    smaller = min(len(fingerprint_ref), len(fingerprint_candidate))
+    if smaller == 0:
+        return 0.
+    umt.count('similarity.token_pairs_evaluated')
+    return len(fingerprint_ref & fingerprint_candidate) / smaller
+
+
+def detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False):
+    if len(pycode_string_list) < 2:
+        return []
+
+    token_ids = {}
+    func_info_list = []
+    for index, code_str in enumerate(pycode_string_list):
+        func_info_list.append((index, fingerprint(code_str, token_ids=token_ids,
+                                                  keep_prints=keep_prints, module_level=module_level)))
 
     ast_diff_result = []
     index_ref, func_info_ref = func_info_list[0]
@@ -471,31 +620,55 @@ def detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, modul
         raise NoFuncException(index_ref)
 
     for index_candidate, func_info_candidate in func_info_list[1:]:
-        func_ast_diff_list = []
+        ast_diff_result.append((index_candidate, compare(func_info_ref, func_info_candidate, diff_method)))
+
+    return ast_diff_result
+
+
+def compare(func_info_ref, func_info_candidate, diff_method=UnifiedDiff):
+    """
+    Matches every reference function with the most similar candidate function.
 
+    :param list[FuncInfo] func_info_ref: records of the reference code
+    :param list[FuncInfo] func_info_candidate: records of the candidate code
+    :param diff_method: class with diff and total static methods
+    :returns: diff infos sorted by plagiarism percent, highest first
+    :rtype: list[FuncDiffInfo]
+    """
+    func_ast_diff_list = []
+    nr_evaluated = nr_pruned = nr_identical = 0
+
+    with umt.timer('similarity.diff'):
         for fi1 in func_info_ref:
             min_diff_value = int((1 << 31) - 1)
             min_diff_func_info = None
-            for fi2 in func_info_candidate:
+            for num, fi2 in enumerate(func_info_candidate):
                 dv = diff_method.diff(fi1, fi2)
+                nr_evaluated += 1
                 if dv < min_diff_value:
                     min_diff_value = dv
                     min_diff_func_info = fi2
                 if dv == 0:  # entire function structure is plagiarized by candidate
+                    nr_identical += fi1.func_hash == fi2.func_hash
+                    nr_pruned += len(func_info_candidate) - num - 1
                     break
 
-            func_diff_info = FuncDiffInfo()
-            func_diff_info.info_ref = fi1
-            func_diff_info.info_candidate = min_diff_func_info
-            func_diff_info.total_count = diff_method.total(fi1, min_diff_func_info)
-            func_diff_info.plagiarism_count = func_diff_info.total_count - min_diff_value if min_diff_func_info else 0
+            total_count = diff_method.total(fi1, min_diff_func_info)
+            func_diff_info = FuncDiffInfo(info_ref=fi1,
+                                          info_candidate=min_diff_func_info,
+                                          total_count=total_count,
+                                          plagiarism_count=total_count - min_diff_value if min_diff_func_info else 0)
             func_ast_diff_list.append(func_diff_info)
         func_ast_diff_list.sort(key=operator.attrgetter('plagiarism_percent'), reverse=True)
-        ast_diff_result.append((index_candidate, func_ast_diff_list))
 
-    return ast_diff_result
+    umt.count('similarity.pairs_evaluated')
+    umt.count('similarity.func_pairs_evaluated', nr_evaluated)
+    umt.count('similarity.func_pairs_pruned', nr_pruned)
+    umt.count('similarity.hash_hits', nr_identical)
+    return func_ast_diff_list
 
 
+@umt.timed('similarity.summarize')
 def summarize(func_ast_diff_list):
     sum_total_count = sum(func_diff_info.total_count for func_diff_info in func_ast_diff_list)
     sum_plagiarism_count = sum(func_diff_info.plagiarism_count for func_diff_info in func_ast_diff_list)
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dasa1doom', 'datasets')
+
+DATA_TYPES = ('.csv', '.xlsx')
+
+
+class DataRegistry:
+    """
+    Converts the CSV/XLSX members of the assignment archives (e.g. files/instacart_100k.zip)
+    once into a column store and hands out memory-mapped data frames.
+
+    Every column is saved as a .npy file, text columns as categorical codes plus their categories,
+    so loading maps the files instead of parsing them and all the processes that load the same
+    dataset share one copy of the data through the page cache. The loaded columns are read-only.
+    A member is converted again only if its CRC in the archive changes.
+
+    :param str cache_dir: directory of the converted datasets
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def members(archive):
+        """
+        :param str archive: path to the .zip file
+        :returns: the data files of the archive
+        :rtype: list[str]
+        """
+        with zipfile.ZipFile(archive) as f:
+            return [info.filename for info in f.infolist()
+                    if info.filename.lower().endswith(DATA_TYPES) and not info.filename.startswith('__MACOSX')]
+
+    def _dataset_dir(self, archive, member, crc, sheet=None):
+        stem = os.path.splitext(os.path.basename(archive))[0]
+        name = os.path.splitext(member)[0].replace('/', '__')
+        if sheet is not None:
+            name = f'{name}__{sheet}'
+        return os.path.join(self.cache_dir, stem, f'{name}-{crc:08x}')
+
+    def _read(self, archive, member):
+        """
+        :returns: sheet name to data frame mapping, a single None key for CSV files
+        :rtype: dict
+        """
+        with zipfile.ZipFile(archive) as f, f.open(member) as data:
+            if member.lower().endswith('.csv'):
+                return {None: pd.read_csv(data)}
+            return pd.read_excel(data, sheet_name=None)
+
+    @staticmethod
+    def _save(frame, dataset_dir, meta):
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(dataset_dir))
+        columns = []
+        for num, (name, column) in enumerate(frame.items()):
+            file_name = f'c{num}.npy'
+            values = column.to_numpy()
+            if values.dtype == object or isinstance(column.dtype, pd.CategoricalDtype):
+                categorical = pd.Categorical(column)
+                np.save(os.path.join(tmp_dir, file_name), categorical.codes)
+                columns.append({'name': name, 'file': file_name, 'kind': 'category',
+                                'categories': categorical.categories.tolist()})
+            else:
+                np.save(os.path.join(tmp_dir, file_name), values)
+                columns.append({'name': name, 'file': file_name, 'kind': 'array'})
+        meta = dict(meta, nrows=len(frame), columns=columns)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, default=str)
+        try:
+            os.rename(tmp_dir, dataset_dir)
+        except OSError:
+            # converted by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def convert(self, archive, member):
+        """
+        Converts the member (every sheet of an XLSX file) if it is not converted yet.
+
+        :param str archive: path to the .zip file
+        :param str member: data file inside the archive
+        :returns: directories of the converted datasets
+        :rtype: list[str]
+        """
+        with zipfile.ZipFile(archive) as f:
+            crc = f.getinfo(member).CRC
+        sheets = self._sheets(archive, member, crc)
+        if sheets is not None:
+            return [self._dataset_dir(archive, member, crc, sheet) for sheet in sheets]
+
+        dataset_dirs = []
+        for sheet, frame in self._read(archive, member).items():
+            dataset_dir = self._dataset_dir(archive, member, crc, sheet)
+            os.makedirs(os.path.dirname(dataset_dir), exist_ok=True)
+            if not os.path.exists(dataset_dir):
+                self._save(frame, dataset_dir, {'archive': os.path.abspath(archive), 'member': member,
+                                                'sheet': sheet, 'crc': crc})
+            dataset_dirs.append(dataset_dir)
+        if member.lower().endswith('.xlsx'):
+            with open(self._dataset_dir(archive, member, crc) + '.sheets.json', 'w') as f:
+                json.dump(list(self._read_sheets(dataset_dirs)), f)
+        return dataset_dirs
+
+    def _sheets(self, archive, member, crc):
+        """Names of the already converted sheets, None if the member is not converted yet."""
+        if member.lower().endswith('.csv'):
+            return [None] if os.path.exists(self._dataset_dir(archive, member, crc)) else None
+        try:
+            with open(self._dataset_dir(archive, member, crc) + '.sheets.json') as f:
+                return json.load(f)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_sheets(dataset_dirs):
+        for dataset_dir in dataset_dirs:
+            with open(os.path.join(dataset_dir, 'meta.json')) as f:
+                yield json.load(f)['sheet']
+
+    def convert_all(self, archives, workers=None):
+        """
+        Converts all the data files of the archives in a process pool.
+
+        :param list[str] archives: paths to the .zip files
+        :param int workers: number of processes, defaults to the number of cores
+        :returns: directories of the converted datasets
+        :rtype: list[str]
+        """
+        jobs = [(archive, member) for archive in archives for member in self.members(archive)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(self.convert, *zip(*jobs)) if jobs else []
+            return [dataset_dir for dataset_dirs in results for dataset_dir in dataset_dirs]
+
+    def load(self, archive, member=None, sheet=None):
+        """
+        Memory-maps a converted dataset, converting it first if needed.
+
+        :param str archive: path to the .zip file
+        :param str member: data file inside the archive, may be omitted if the archive has only one
+        :param str sheet: sheet of an XLSX file, defaults to the first one
+        :returns: data frame with read-only memory-mapped columns
+        :rtype: pandas.DataFrame
+        """
+        if member is None:
+            members = self.members(archive)
+            if len(members) != 1:
+                raise ValueError(f'{archive} contains {len(members)} data files, specify the member: {members}')
+            member = members[0]
+        dataset_dirs = self.convert(archive, member)
+        if sheet is not None:
+            dataset_dirs = [d for d, s in zip(dataset_dirs, self._read_sheets(dataset_dirs)) if s == sheet]
+            if not dataset_dirs:
+                raise KeyError(sheet)
+        return load_columns(dataset_dirs[0])
+
+    def extract(self, archive):
+        """
+        Extracts the archive once, e.g. to be used as the data directory of the autograder.
+
+        :param str archive: path to the .zip file
+        :returns: directory with the extracted files
+        :rtype: str
+        """
+        with zipfile.ZipFile(archive) as f:
+            crc = 0
+            for info in f.infolist():
+                crc = (crc * 31 + info.CRC + info.file_size) % 2 ** 32
+            stem = os.path.splitext(os.path.basename(archive))[0]
+            target = os.path.join(self.cache_dir, stem, f'raw-{crc:08x}')
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(target))
+                f.extractall(tmp_dir)
+                try:
+                    os.rename(tmp_dir, target)
+                except OSError:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        return target
+
+
+def load_columns(dataset_dir):
+    """
+    :param str dataset_dir: directory of a converted dataset
+    :returns: data frame with read-only memory-mapped columns
+    :rtype: pandas.DataFrame
+    """
+    with open(os.path.join(dataset_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {}
+    for column in meta['columns']:
+        values = np.load(os.path.join(dataset_dir, column['file']), mmap_mode='r', allow_pickle=False)
+        if column['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=column['categories'], validate=False)
+        columns[column['name']] = values
+    return pd.DataFrame(columns, index=pd.RangeIndex(meta['nrows']), copy=False)
+
+
+def resolve_data_dir(data_dir, cache_dir=DEFAULT_CACHE_DIR):
+    """Returns the data directory, zip archives are extracted once into the cache."""
+    if data_dir and os.path.isfile(data_dir) and zipfile.is_zipfile(data_dir):
+        return DataRegistry(cache_dir).extract(data_dir)
+    return data_dir
+
+
+def dataset_dirs(data_dir, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Converts the CSV files of a zip data directory of the autograder, so that the submissions read
+    their memory-mapped columns instead of parsing them (see utils.autograder_worker.serve_datasets).
+
+    :param str data_dir: data directory of the autograder
+    :returns: path of the file inside the archive to its converted dataset, empty if data_dir is not a zip archive
+    :rtype: dict[str, str]
+    """
+    if not (data_dir and os.path.isfile(data_dir) and zipfile.is_zipfile(data_dir)):
+        return {}
+    registry = DataRegistry(cache_dir)
+    return {member: registry.convert(data_dir, member)[0]
+            for member in registry.members(data_dir) if member.lower().endswith('.csv')}
+
+
+def load_dataset(archive, member=None, sheet=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Shortcut of DataRegistry(cache_dir).load(...), e.g. load_dataset('files/instacart_100k.zip').
+    """
+    return DataRegistry(cache_dir).load(archive, member=member, sheet=sheet)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts the assignment datasets into the column store.")
+
+    parser.add_argument('archives', nargs='+',
+                        help="The .zip files with the CSV/XLSX datasets.")
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR,
+                        help="Directory of the converted datasets.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of processes, defaults to the number of cores.")
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for dataset_dir in DataRegistry(args.cache_dir).convert_all(args.archives, workers=args.workers):
+        print(dataset_dir)
+    print(f'{time.perf_counter() - start:.2f}s')
@@ -0,0 +1,199 @@
+import os
+import time
+import sqlite3
+
+from contextlib import closing
+
+import pandas as pd
+
+import utils.misc as um
+import utils.metrics as umt
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS grades (
+    assignment TEXT NOT NULL,
+    student TEXT NOT NULL,
+    grade REAL,
+    grader TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (assignment, student)
+)
+"""
+
+DECISIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS decisions (
+    assignment TEXT NOT NULL,
+    name1 TEXT NOT NULL,
+    name2 TEXT NOT NULL,
+    decision TEXT NOT NULL,
+    reviewer TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (assignment, name1, name2)
+)
+"""
+
+PENALIZE = 'penalize'
+SKIP = 'skip'
+
+
+def connect(db_path, timeout=30.):
+    # a connection per operation, the streamlit sessions run in different threads
+    connection = sqlite3.connect(db_path, timeout=timeout)
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class GradeStore:
+    """
+    Grades kept in an SQLite database, every grade is written when it is entered.
+
+    The database is in WAL mode, so several grader sessions (e.g. two TAs grading the same cohort)
+    read and write concurrently, each grade entry being its own short transaction.
+    A later entry for the same student replaces the earlier one and records who entered it.
+
+    :param str db_path: .sqlite file, created if missing
+    :param str assignment: name of the graded assignment, one database may hold several
+    :param float timeout: seconds to wait for the lock of another writer
+    """
+
+    def __init__(self, db_path, assignment='', timeout=30.):
+        self.db_path = db_path
+        self.assignment = assignment
+        self.timeout = timeout
+        with closing(self._connect()) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+
+    def _connect(self):
+        return connect(self.db_path, self.timeout)
+
+    def set(self, student, grade, grader=None):
+        """
+        :param str student: student name
+        :param float grade: the grade
+        :param str grader: who entered the grade
+        """
+        self.set_many({student: grade}, grader=grader)
+
+    def set_many(self, grades, grader=None, overwrite=True):
+        """
+        Writes the grades in one transaction.
+
+        :param dict[str, float] grades: student name to grade mapping
+        :param str grader: who entered the grades
+        :param bool overwrite: whether to replace the grades that are already stored
+        """
+        conflict = ('DO UPDATE SET grade = excluded.grade, grader = excluded.grader, '
+                    'updated_at = excluded.updated_at') if overwrite else 'DO NOTHING'
+        now = time.time()
+        with umt.timer('grade_store.write'), closing(self._connect()) as connection, connection:
+            connection.executemany(
+                'INSERT INTO grades (assignment, student, grade, grader, updated_at) VALUES (?, ?, ?, ?, ?) '
+                f'ON CONFLICT (assignment, student) {conflict}',
+                [(self.assignment, student, grade, grader, now) for student, grade in grades.items()])
+
+    def get(self, student, default=None):
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT grade FROM grades WHERE assignment = ? AND student = ?',
+                                     (self.assignment, student)).fetchone()
+        return default if row is None else row[0]
+
+    def grades(self):
+        """
+        :returns: name to grade mapping, like utils.misc.grades2dict
+        :rtype: dict
+        """
+        with closing(self._connect()) as connection:
+            return dict(connection.execute('SELECT student, grade FROM grades WHERE assignment = ? ORDER BY student',
+                                           (self.assignment,)))
+
+    def to_frame(self, all_assignments=False):
+        """
+        :param bool all_assignments: whether to include the grades of the other assignments
+        :returns: assignment, student, grade, grader and updated_at columns
+        :rtype: pandas.DataFrame
+        """
+        query, params = 'SELECT * FROM grades', ()
+        if not all_assignments:
+            query, params = query + ' WHERE assignment = ?', (self.assignment,)
+        with closing(self._connect()) as connection:
+            return pd.read_sql_query(query + ' ORDER BY assignment, student', connection, params=params)
+
+    def export(self, file_name, all_assignments=False):
+        """
+        Writes the grades into a .csv or .parquet file.
+
+        :param str file_name: output file name
+        :param bool all_assignments: whether to include the grades of the other assignments
+        """
+        frame = self.to_frame(all_assignments)
+        if file_name.endswith('.parquet'):
+            frame.to_parquet(file_name, index=False)
+        else:
+            frame.to_csv(file_name, index=False)
+
+    def import_results(self, path, file_name='results.txt', grader=None):
+        """
+        Stores the grades of a results.txt file (see utils.misc.grades2dict).
+
+        :param str path: directory of the txt file
+        :param str file_name: name of the txt file
+        :param str grader: who entered the grades
+        """
+        self.set_many(um.grades2dict(path, file_name), grader=grader)
+
+
+class DecisionStore:
+    """
+    Plagiarism review decisions kept next to the grades, written when they are made,
+    so that the decisions of all the reviewers of a cohort end up in one place.
+    A later decision on the same pair replaces the earlier one and records who made it.
+
+    :param str db_path: .sqlite file, created if missing
+    :param str assignment: name of the reviewed assignment, one database may hold several
+    :param float timeout: seconds to wait for the lock of another writer
+    """
+
+    def __init__(self, db_path, assignment='', timeout=30.):
+        self.db_path = db_path
+        self.assignment = assignment
+        self.timeout = timeout
+        with closing(connect(db_path, timeout)) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(DECISIONS_SCHEMA)
+
+    def set(self, name1, name2, decision, reviewer=None):
+        """
+        :param str name1: student name
+        :param str name2: student name
+        :param str decision: PENALIZE or SKIP
+        :param str reviewer: who made the decision
+        """
+        with umt.timer('grade_store.write'), closing(connect(self.db_path, self.timeout)) as connection, connection:
+            connection.execute(
+                'INSERT INTO decisions (assignment, name1, name2, decision, reviewer, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (assignment, name1, name2) DO UPDATE SET '
+                'decision = excluded.decision, reviewer = excluded.reviewer, updated_at = excluded.updated_at',
+                (self.assignment, name1, name2, decision, reviewer, time.time()))
+
+    def decisions(self):
+        """
+        :returns: (name1, name2) to decision mapping
+        :rtype: dict[tuple[str, str], str]
+        """
+        with closing(connect(self.db_path, self.timeout)) as connection:
+            rows = connection.execute('SELECT name1, name2, decision FROM decisions WHERE assignment = ?',
+                                      (self.assignment,))
+            return {(name1, name2): decision for name1, name2, decision in rows}
+
+    def cheaters(self):
+        """
+        :returns: the penalized pairs of all the reviewers, like cheaters.txt
+        :rtype: list[list[str]]
+        """
+        return [list(pair) for pair, decision in sorted(self.decisions().items()) if decision == PENALIZE]
+
+
+def default_db_path(output_dir):
+    """The grade database next to the other outputs of a cohort."""
+    return os.path.join(output_dir, 'grades.sqlite')
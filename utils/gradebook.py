@@ -0,0 +1,351 @@
+"""
+End-of-term gradebook: the homework grades, the Kahoot answers and the plagiarism penalties
+of a course in one student x component table.
+
+    python -m utils.gradebook course1.json course2.json
+
+A course file lists where the artifacts of the course are:
+
+    {
+        "students": "students.csv",
+        "weights": {"homework": 40, "kahoot": 10, "midterm": 50},
+        "assignments": [
+            {"name": "hw1", "path": "submissions/hw1", "group": "homework"},
+            {"name": "midterm", "path": "submissions/midterm.zip", "max_grade": 50}
+        ],
+        "kahoot": "kahoot_reports",
+        "plagiarism_penalty": 1.0,
+        "output": "gradebook.csv"
+    }
+"""
+import os
+import ast
+import json
+import glob
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import utils.misc as um
+import utils.roster as ur
+import utils.ingest as ui
+import utils.metrics as umt
+import utils.grade_store as ugs
+
+KAHOOT_GROUP = 'kahoot'
+
+
+def read_literal(file_name):
+    """
+    Reads the python literal written by the apps, e.g. cheaters.txt or the str(dict) dumped into grades.json.
+
+    :param str file_name: .txt or .json file
+    :returns: the literal
+    """
+    with open(file_name, encoding='utf8') as f:
+        content = f.read()
+    if file_name.endswith('.json'):
+        content = json.loads(content)
+    return ast.literal_eval(content) if isinstance(content, str) else content
+
+
+def load_cheaters(file_name):
+    """
+    :param str file_name: cheaters.txt of utils.plagiarism_detector.PlagiarismDetectorStreamlit
+    :returns: the names of the penalized students
+    :rtype: set[str]
+    """
+    return {name for pair in read_literal(file_name) for name in pair}
+
+
+def load_assignment_grades(path, assignment='', file_names=('grades.json', 'results.txt')):
+    """
+    Reads the grades of an assignment from the grade database next to the submissions
+    (see utils.grade_store.GradeStore), or else from the first of file_names that exists.
+
+    :param str path: directory or zip export of the submissions
+    :param str assignment: name of the assignment in the grade database
+    :param tuple[str] file_names: grades.json of utils.graders.GraderStreamlit or a results.txt
+        of utils.misc.grades2dict
+    :returns: name to grade mapping
+    :rtype: dict
+    """
+    output_dir = ui.output_dir(path)
+    db_path = ugs.default_db_path(output_dir)
+    if os.path.exists(db_path):
+        # the apps store the grades of their cohort without an assignment name
+        for name in dict.fromkeys((assignment, '')):
+            grades = ugs.GradeStore(db_path, assignment=name).grades()
+            if grades:
+                return grades
+    for file_name in file_names:
+        if not os.path.exists(os.path.join(output_dir, file_name)):
+            continue
+        if file_name.endswith('.json'):
+            return read_literal(os.path.join(output_dir, file_name))
+        return um.grades2dict(output_dir, file_name)
+    raise FileNotFoundError(f'No grades next to {path}')
+
+
+def read_kahoot_csvs(path):
+    """
+    Reads the csv files written by utils.kahoot.KahootParser.
+
+    A report whose path has spaces may have both the csv with the names (process_kahoot_xlsxs) and the
+    csv with the ids (replace_names_with_ids, the same path without the spaces), only the ids are read.
+
+    :param str path: directory of the csv files (searched recursively)
+    :returns: kahoot, student and correct columns, the student being the name or the id
+    :rtype: pandas.DataFrame
+    """
+    versions = {}
+    for file in sorted(glob.glob(os.path.join(path, '**', '*.csv'), recursive=True)):
+        versions.setdefault(os.path.relpath(file, path).replace(' ', ''), []).append(file)
+    frames = []
+    for kahoot_files in versions.values():
+        file = min(kahoot_files, key=lambda file_name: ' ' in os.path.relpath(file_name, path))
+        frame = pd.read_csv(file)
+        if 'correct' not in frame.columns:
+            # e.g. unresolved_names.csv or the per question reports
+            continue
+        student = frame['student_id'] if 'student_id' in frame.columns else frame['student']
+        # the players replace_names_with_ids could not map to an id, not a student
+        unresolved = student.isna()
+        umt.count('gradebook.kahoot_unresolved', int(unresolved.sum()))
+        frame, student = frame[~unresolved], student[~unresolved]
+        if student.dtype.kind == 'f':
+            # ids read back as floats because of the missing ones
+            student = student.astype(np.int64)
+        frames.append(pd.DataFrame({'kahoot': os.path.splitext(os.path.relpath(file, path))[0],
+                                    'student': student.astype(str), 'correct': frame['correct']}))
+    if not frames:
+        return pd.DataFrame({'kahoot': [], 'student': [], 'correct': []})
+    return pd.concat(frames, ignore_index=True)
+
+
+class Gradebook:
+    """
+    Student x component table of grades, one column per assignment or Kahoot, with the
+    plagiarism penalties of every column in a table of the same shape.
+
+    The total is the sum of the weighted columns, which are kept: when a component or its
+    penalties change only its column is recomputed and the total updated by the difference.
+
+    :param dict or str students: name to id roster (see utils.misc.get_student_info), the names
+        of the other artifacts are matched to it (see utils.roster.Roster.resolve), None to keep them
+    :param dict weights: group to weight, normalized with utils.misc.normalize_dict, the weight of a
+        group is split equally among its components, equal weights if None
+    :param float plagiarism_penalty: the share of the grade a penalized student loses
+    """
+
+    def __init__(self, students=None, weights=None, plagiarism_penalty=1.):
+        self.student_ids = um.get_student_info(students) if students is not None else {}
+        self.roster = ur.Roster(self.student_ids) if self.student_ids else None
+        self.weights = weights
+        self.plagiarism_penalty = plagiarism_penalty
+        self.unresolved = {}
+        self.ungraded = []
+        self.grades = pd.DataFrame(index=pd.Index(list(self.student_ids), name='student'), dtype=np.float64)
+        self.penalties = self.grades.copy()
+        self.max_grades = pd.Series(dtype=np.float64)
+        self.groups = pd.Series(dtype=object)
+        self._contributions = self.grades.copy()
+        self._weights = pd.Series(dtype=np.float64)
+        self._dirty = set()
+
+    def _align(self, names):
+        """Roster names of the given names, the unresolved ones are kept as they are."""
+        if self.roster is None:
+            return list(names)
+        ids = {str(student_id): name for name, student_id in self.student_ids.items()}
+        queries = [name for name in dict.fromkeys(names) if name not in self.student_ids and name not in ids]
+        resolved, unresolved = self.roster.resolve(queries)
+        self.unresolved.update(unresolved)
+        return [name if name in self.student_ids else ids.get(name) or resolved.get(name, name) for name in names]
+
+    def _reindex(self, students):
+        new = pd.Index(students).difference(self.grades.index)
+        if len(new):
+            index = self.grades.index.append(new).rename('student')
+            self.grades = self.grades.reindex(index)
+            self.penalties = self.penalties.reindex(index, fill_value=0.)
+            self._contributions = self._contributions.reindex(index, fill_value=0.)
+
+    def add_component(self, name, grades, max_grade=100., group=None):
+        """
+        Adds or replaces a column.
+
+        :param str name: component name, e.g. 'hw1'
+        :param dict or pandas.Series grades: student name (or id) to grade mapping
+        :param float max_grade: the grade of a full score
+        :param str group: the weight group of the component, its name by default
+        """
+        grades = pd.Series(grades, dtype=np.float64)
+        # -1 marks a missing submission in results.txt
+        grades = grades.where(grades >= 0)
+        grades.index = self._align(grades.index.astype(str))
+        # a student resolved from two names keeps the best grade
+        grades = grades.groupby(level=0).max()
+        self._reindex(grades.index)
+        self.grades[name] = grades.reindex(self.grades.index)
+        if name not in self.penalties.columns:
+            self.penalties[name] = 0.
+        self.max_grades[name] = max_grade
+        if self.groups.get(name) != (group or name):
+            self.groups[name] = group or name
+            self._weights = pd.Series(dtype=np.float64)
+        self._dirty.add(name)
+
+    def add_penalties(self, name, students, penalty=None):
+        """
+        Penalizes students in a component, e.g. the names of cheaters.txt.
+
+        :param str name: component name
+        :param collections.abc.Iterable[str] students: penalized student names
+        :param float penalty: the share of the grade lost, plagiarism_penalty by default
+        """
+        students = self._align([str(student) for student in students])
+        self._reindex(students)
+        penalties = np.zeros(len(self.grades.index))
+        penalties[self.grades.index.get_indexer(students)] = self.plagiarism_penalty if penalty is None else penalty
+        self.penalties[name] = penalties
+        self._dirty.add(name)
+
+    def add_assignment(self, name, path, max_grade=100., group=None, penalties=True):
+        """
+        Adds the grades of an assignment and the penalties of its cheaters.txt, if any.
+        An assignment without grades yet is an empty column, listed in self.ungraded.
+
+        :param str name: component name, also the assignment name in the grade database
+        :param str path: directory or zip export of the submissions
+        """
+        try:
+            grades = load_assignment_grades(path, assignment=name)
+        except FileNotFoundError:
+            umt.count('gradebook.ungraded')
+            self.ungraded.append(name)
+            grades = {}
+        self.add_component(name, grades, max_grade=max_grade, group=group)
+        cheaters = os.path.join(ui.output_dir(path), 'cheaters.txt')
+        if penalties and os.path.exists(cheaters):
+            self.add_penalties(name, load_cheaters(cheaters))
+
+    def add_kahoots(self, answers, group=KAHOOT_GROUP):
+        """
+        Adds every Kahoot as a component of the group, graded by the share of correct answers,
+        so a missed Kahoot counts as 0.
+
+        :param pandas.DataFrame answers: kahoot, student and correct columns, e.g. of read_kahoot_csvs
+            or utils.kahoot.KahootParser.semester
+        """
+        accuracy = (answers.assign(correct=answers['correct'].astype(np.float64))
+                    .groupby(['student', 'kahoot'], observed=True)['correct'].mean().unstack())
+        for kahoot in accuracy.columns:
+            self.add_component(str(kahoot), accuracy[kahoot].dropna(), max_grade=1., group=group)
+        self.grades[accuracy.columns.astype(str)] = self.grades[accuracy.columns.astype(str)].fillna(0.)
+
+    def component_weights(self):
+        """
+        :returns: the weight of every component, summing up to 100
+        :rtype: pandas.Series
+        """
+        groups = self.groups.reindex(self.grades.columns)
+        weights = self.weights or dict.fromkeys(groups.unique(), 1)
+        weights = pd.Series(um.normalize_dict({group: weights.get(group, 0) for group in groups.unique()}))
+        return (weights.reindex(groups.values).fillna(0.).values / groups.map(groups.value_counts())).astype(np.float64)
+
+    def set_weights(self, weights):
+        self.weights = weights
+        self._weights = pd.Series(dtype=np.float64)
+
+    def totals(self):
+        """
+        :returns: the weighted total out of 100 of every student
+        :rtype: pandas.Series
+        """
+        with umt.timer('gradebook.totals'):
+            if not self._weights.index.equals(self.grades.columns):
+                # the weights changed, every column is recomputed
+                self._weights = self.component_weights()
+                self._dirty.update(self.grades.columns)
+            dirty = [name for name in self.grades.columns if name in self._dirty]
+            if dirty:
+                scores = (self.grades[dirty].fillna(0.).values / self.max_grades[dirty].values
+                          * (1 - self.penalties[dirty].values))
+                self._contributions[dirty] = scores * self._weights[dirty].values
+                umt.count('gradebook.columns_computed', len(dirty))
+            self._dirty.clear()
+            return self._contributions[self.grades.columns].sum(axis=1).rename('total')
+
+    def to_frame(self):
+        """
+        :returns: the grades, the penalties applied and the total of every student
+        :rtype: pandas.DataFrame
+        """
+        total = self.totals()
+        frame = self.grades.copy()
+        penalized = self.penalties[self.grades.columns].gt(0)
+        frame['penalized'] = penalized.dot(penalized.columns + ',').str.rstrip(',')
+        frame['total'] = total
+        if self.student_ids:
+            frame.insert(0, 'id', frame.index.map(self.student_ids))
+        return frame
+
+    @classmethod
+    def from_config(cls, config, root='.'):
+        """
+        :param dict config: course description, see the module docstring
+        :param str root: directory the paths of the config are relative to
+        :rtype: Gradebook
+        """
+        students = config.get('students')
+        if isinstance(students, str):
+            students = os.path.join(root, students)
+        gradebook = cls(students, weights=config.get('weights'),
+                        plagiarism_penalty=config.get('plagiarism_penalty', 1.))
+        for assignment in config.get('assignments', []):
+            gradebook.add_assignment(assignment['name'], os.path.join(root, assignment['path']),
+                                     max_grade=assignment.get('max_grade', 100.), group=assignment.get('group'),
+                                     penalties=assignment.get('penalties', True))
+        if config.get('kahoot'):
+            gradebook.add_kahoots(read_kahoot_csvs(os.path.join(root, config['kahoot'])))
+        return gradebook
+
+
+def run_course(config_file):
+    """
+    Builds the gradebook of a course file and writes it into its output csv.
+
+    :param str config_file: .json course file
+    :returns: output file name, number of students, unresolved names and the assignments not graded yet
+    :rtype: tuple
+    """
+    with open(config_file, encoding='utf8') as f:
+        config = json.load(f)
+    root = os.path.dirname(os.path.abspath(config_file))
+    gradebook = Gradebook.from_config(config, root=root)
+    output = os.path.join(root, config.get('output', 'gradebook.csv'))
+    gradebook.to_frame().to_csv(output)
+    return output, len(gradebook.grades), sorted(gradebook.unresolved), list(gradebook.ungraded)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the gradebooks of several courses at once.")
+
+    parser.add_argument('courses', nargs='+',
+                        help="Course .json files, see utils/gradebook.py.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of courses built in parallel, defaults to the number of cores.")
+
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for output, nr_students, unresolved, ungraded in pool.map(run_course, args.courses):
+            print(f'{output}: {nr_students} students')
+            if unresolved:
+                print(f'  not in the roster: {", ".join(unresolved)}')
+            if ungraded:
+                print(f'  not graded yet: {", ".join(ungraded)}')
@@ -1,61 +1,182 @@
 import streamlit as st
+import getpass
 import json
 import os
+import types
 
 import utils.notebook as un
-import utils.misc as um
+import utils.metrics as umt
+import utils.ingest as ui
+import utils.autograder as ua
+import utils.grade_store as ugs
+import utils.shared as ush
+import utils.submissions as us
 
 
 class GraderStreamlit:
-    def __init__(self, path):
+    """
+    :param str path: defines the directory where the notebooks are, or a zip export of them
+    :param str metrics_file: optional .json file to write the timers and counters into
+    :param bool profile: specifies whether to capture a cProfile of the notebook loading
+    :param int workers: number of threads decoding the notebooks and of notebooks executed
+        in parallel, defaults to the number of cores
+    :param str assertions: optional .ipynb or .py file with the instructor assertion cells,
+        if provided the submissions are executed, graded by the fraction of passed assertions
+        and only the ones with failures are left for review
+    :param float timeout: seconds each submission is allowed to run
+    :param int memory_mb: memory limit of each submission
+    :param str data_dir: directory with the data files the submissions read
+    :param float max_grade: grade of a submission that passes all the assertions
+    :param str cache_dir: optional directory of the execution cache, re-grading executes only the cells
+        and assertions that changed
+    :param str grades_db: .sqlite file the grades are written into as they are entered,
+        defaults to grades.sqlite next to the submissions, shared by all the grader sessions
+    :param str grader: name recorded with the entered grades, defaults to the user name
+    """
+
+    def __init__(self, path, metrics_file=None, profile=False, workers=None,
+                 assertions=None, timeout=60, memory_mb=None, data_dir=None, max_grade=100,
+                 cache_dir=None, grades_db=None, grader=None):
         self.path = path
+        self.metrics_file = metrics_file
+        self.profile = profile
+        self.workers = workers
+        self.assertions = assertions
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.data_dir = data_dir
+        self.max_grade = max_grade
+        self.cache_dir = cache_dir
+        self.store = ugs.GradeStore(grades_db or ugs.default_db_path(ui.output_dir(path)))
+        self.grader = grader or getpass.getuser()
 
     def grade(self):
-        student2file = um.get_files(path=self.path, file_type='ipynb')
-        self.run(student2file)
+        self.run()
 
-    def run(self, student2file):
+    def run(self, corpus=None):
+        """
+        The notebooks and the autograder results are shared by all the sessions,
+        only the position of the grader is kept per session, the grades are in the store.
+
+        :param utils.ingest.Corpus corpus: the submissions, loaded from path if None (see utils.shared.corpus)
+        """
         st.set_page_config(layout="wide", page_icon="", page_title="Grader", )
 
         st.title("Homework Grader")
 
-        all_notebooks = [self.get_notebook(file) for file in student2file.values()]
-        students = list(student2file.keys())
+        # the metrics are shared by the sessions of the server, reset only from the Metrics panel
+        umt.enable_profiling(self.profile)
+
+        if corpus is None:
+            with umt.profile('grader.load'), umt.timer('grader.load'):
+                corpus = ush.corpus(self.path, workers=self.workers)
+        all_notebooks = list(corpus.notebooks)
+        students = list(corpus.students)
+
+        results = self.autograde(corpus) if self.assertions else {}
+        if results:
+            # humans review only the submissions with failed assertions
+            to_review = [num for num, student in enumerate(students) if ua.score(results[student]) < 1]
+            all_notebooks = [all_notebooks[num] for num in to_review]
+            students = [students[num] for num in to_review]
 
         nr_notebooks = len(all_notebooks)
 
         if 'idx' not in st.session_state:
-            st.session_state.idx = 0
-            st.session_state.grades = {}
+            # the autograder grades do not replace the ones entered by hand
+            self.store.set_many({student: self.max_grade * ua.score(result) for student, result in results.items()},
+                                grader='autograder', overwrite=False)
+            # resume from the first submission without a grade, e.g. after a browser refresh
+            graded = self.store.grades()
+            st.session_state.idx = next((num for num, student in enumerate(students) if student not in graded),
+                                        max(len(students) - 1, 0))
+        # includes the grades entered in the other sessions
+        st.session_state.grades = self.store.grades()
+
+        if nr_notebooks == 0:
+            st.success('All the submissions passed the assertions.')
+            self.save_grades()
+            st.stop()
 
         hw = all_notebooks[st.session_state.idx]
 
         if st.button('Display'):
+            # kept displayed on the reruns of the output toggles, cleared when moving on
+            st.session_state.displayed = st.session_state.idx
+
+        if st.session_state.get('displayed') == st.session_state.idx:
             st.info(students[st.session_state.idx])
 
-            for cell in hw:
-                un.display_notebook_cell(cell)
+            for assertion in results.get(students[st.session_state.idx], {}).get('assertions', []):
+                if not assertion['passed']:
+                    st.error(f"{assertion['name']}: {assertion['error']}")
+
+            with umt.timer('grader.display'):
+                for num, cell in enumerate(hw):
+                    un.display_notebook_cell(cell, key=f'{students[st.session_state.idx]}-{num}')
+            umt.count('grader.cells_displayed', len(hw))
 
-        grade = st.number_input("Insert a grade")
+        umt.display_metrics()
+        if self.metrics_file:
+            umt.dump(self.metrics_file)
 
-        if grade:
-            st.session_state.grades[students[st.session_state.idx]] = grade
+        student = students[st.session_state.idx]
+        # keyed by the student, so that the value of the previous student is not carried over,
+        # empty until a grade is entered, so that a grade of 0 is told apart from no grade
+        stored = st.session_state.grades.get(student)
+        grade = st.number_input("Insert a grade", value=None if stored is None else float(stored),
+                                key=f'grade-{student}')
+
+        if grade is not None and grade != stored:
+            st.session_state.grades[student] = grade
+            self.store.set(student, grade, grader=self.grader)
 
         if st.session_state.idx == nr_notebooks - 1:
 
-            if st.button("Finish", key="finish"):
+            if st.button("Finish", key="finish", on_click=self.hide_notebook):
                 st.success('The job is completed.')
-                st.code(str(st.session_state.grades))
-                json.dump(str(st.session_state.grades), open(os.path.join(self.path, 'grades.json'), 'w'))
+                self.save_grades()
                 st.stop()
 
-        if st.button("Next", key="next"):
+        if st.button("Next", key="next", on_click=self.hide_notebook):
 
             if st.session_state.idx < nr_notebooks - 1:
                 st.session_state.idx += 1
 
+    def autograde(self, corpus):
+        """
+        Executes all the submissions once per process, the results are shared by the sessions.
+
+        :returns: student to autograder result mapping
+        :rtype: types.MappingProxyType
+        """
+        key = (corpus.key, us.file_hash(self.assertions), self.timeout, self.memory_mb, self.data_dir, self.cache_dir)
+        return ush.result('autograde', key, lambda: self._autograde(dict(zip(corpus.students, corpus.files))))
+
+    def _autograde(self, student2file):
+        assertions = ua.load_assertions(self.assertions)
+        with st.spinner(f'Running {len(assertions)} assertions on {len(student2file)} submissions'):
+            with umt.timer('grader.autograde'):
+                return types.MappingProxyType(dict(ua.autograde(student2file, assertions,
+                                                                workers=self.workers,
+                                                                timeout=self.timeout,
+                                                                memory_mb=self.memory_mb,
+                                                                data_dir=self.data_dir,
+                                                                cache_dir=self.cache_dir)))
+
+    def save_grades(self):
+        st.session_state.grades = self.store.grades()
+        st.code(str(st.session_state.grades))
+        output_dir = ui.output_dir(self.path)
+        with open(os.path.join(output_dir, 'grades.json'), 'w') as f:
+            json.dump(str(st.session_state.grades), f)
+        self.store.export(os.path.join(output_dir, 'grades.csv'))
+
     @staticmethod
-    def get_notebook(file_name):
-        notebook = un.notebook_to_dict(file_name)
+    def hide_notebook():
+        st.session_state.displayed = None
 
-        return notebook['cells'].copy()
+    @staticmethod
+    def get_notebook(file_name):
+        # outputs are decoded only when the notebook is displayed
+        return un.LazyNotebook(file_name)
@@ -0,0 +1,186 @@
+import os
+import zipfile
+import functools
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import utils.misc as um
+import utils.notebook as un
+import utils.metrics as umt
+import utils.submissions as us
+
+Submission = namedtuple('Submission', ['student', 'code', 'notebook'])
+Corpus = namedtuple('Corpus', ['key', 'students', 'files', 'codes', 'notebooks'])
+
+_zip_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8)
+def _open_zip_version(zip_path, mtime_ns, size):
+    # the central directory is read once per process, reads of the members are thread safe
+    return zipfile.ZipFile(zip_path)
+
+
+def _open_zip(zip_path):
+    # an export replaced at the same path is opened again
+    stat = os.stat(zip_path)
+    return _open_zip_version(zip_path, stat.st_mtime_ns, stat.st_size)
+
+
+if hasattr(os, 'register_at_fork'):
+    # forked workers must not share the file offset of the parent's archive handles
+    os.register_at_fork(after_in_child=_open_zip_version.cache_clear)
+
+
+class ZipMember:
+    """
+    Handle of a file inside a zip archive, read without extracting it.
+
+    :param str zip_path: path to the .zip file
+    :param str member: name of the file inside the archive
+    """
+
+    __slots__ = ('zip_path', 'member')
+
+    def __init__(self, zip_path, member):
+        self.zip_path = zip_path
+        self.member = member
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.zip_path!r}, {self.member!r})'
+
+    def __eq__(self, other):
+        return isinstance(other, ZipMember) and (self.zip_path, self.member) == (other.zip_path, other.member)
+
+    def __hash__(self):
+        return hash((self.zip_path, self.member))
+
+    @property
+    def name(self):
+        return os.path.basename(self.member)
+
+    def read_bytes(self):
+        with _zip_lock:
+            archive = _open_zip(self.zip_path)
+        return archive.read(self.member)
+
+    def __getstate__(self):
+        return self.zip_path, self.member
+
+    def __setstate__(self, state):
+        self.zip_path, self.member = state
+
+
+def get_zip_files(zip_path, file_type='ipynb'):
+    """
+    Reads the paths of the files of given extension inside a zip export,
+    the student name is taken from the submission folder (or the file name) like in utils.misc.get_files.
+
+    :param str zip_path: path to the .zip file
+    :param str file_type: the type of files we want to get paths for
+    :returns: dictionary of student name and file handle pairs
+    :rtype: dict[str, ZipMember]
+    """
+    student2file = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        members = sorted(info.filename for info in archive.infolist() if not info.is_dir())
+    for member in members:
+        parts = member.split('/')
+        if not parts[-1].endswith(file_type) or parts[0] == '__MACOSX' or parts[-1].startswith('.'):
+            continue
+        student_name = (parts[-2] if len(parts) > 1 else parts[-1]).split('_')[0]
+        student2file.setdefault(student_name, ZipMember(zip_path, member))
+    return student2file
+
+
+def get_submissions(path, file_type='ipynb'):
+    """
+    Reads the submissions either from a directory of submission folders or from a zip export.
+
+    :param str path: directory of the submission folders or a .zip file
+    :param str file_type: the type of files we want to get paths for
+    :returns: dictionary of student name and file path (or ZipMember) pairs
+    :rtype: dict
+    """
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return get_zip_files(path, file_type=file_type)
+    return um.get_files(path=path, file_type=file_type)
+
+
+def submissions_key(path, file_type='ipynb'):
+    """
+    Key of the content of the submissions, changes whenever a submission is added, removed or replaced.
+
+    :param str path: directory of the submission folders or a .zip file
+    :param str file_type: the type of files
+    :rtype: tuple
+    """
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+    latest = us.scan(path, file_type=file_type).latest
+    return (os.path.abspath(path),) + tuple((student, version.sha256) for student, version in latest.items())
+
+
+def output_dir(path):
+    """Directory to write the results into, next to the zip export if the submissions are zipped."""
+    return path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+
+
+def load_submission(student, file_name, skip_commands=()):
+    """
+    :returns: the student name, the code and the lazily decoded notebook
+    :rtype: Submission
+    """
+    notebook = un.LazyNotebook(file_name)
+    return Submission(student, un.extract_code(notebook, skip_commands), notebook)
+
+
+def ingest(student2file, skip_commands=(), workers=None, executor='thread'):
+    """
+    Decodes the submissions in a pool and streams them in the order of student2file.
+
+    :param dict student2file: output of get_submissions
+    :param list[str] skip_commands: commands that invalidate the python code
+    :param int workers: size of the pool, defaults to the number of cores
+    :param str executor: 'thread' or 'process'
+    :returns: generator of the submissions
+    :rtype: collections.abc.Iterator[Submission]
+    """
+    pool_class = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor]
+    students = list(student2file)
+    with pool_class(max_workers=workers or os.cpu_count()) as pool:
+        records = pool.map(load_submission, students, [student2file[s] for s in students],
+                           [tuple(skip_commands)] * len(students))
+        for record in records:
+            umt.count('ingest.submissions')
+            yield record
+
+
+def corpus_key(path, file_type='ipynb', skip_commands=()):
+    """Key of a corpus (see load_corpus), changes with the submissions."""
+    return submissions_key(path, file_type) + (tuple(skip_commands),)
+
+
+def load_corpus(path, file_type='ipynb', skip_commands=(), workers=None, key=None):
+    """
+    Ingests all the submissions into immutable tuples, that can be shared by the sessions of the apps.
+
+    :param str path: directory of the submission folders or a .zip file
+    :param str file_type: the type of files
+    :param list[str] skip_commands: commands that invalidate the python code
+    :param int workers: size of the pool, defaults to the number of cores
+    :param tuple key: corpus_key of the submissions, if already computed
+    :rtype: Corpus
+    """
+    if key is None:
+        key = corpus_key(path, file_type, skip_commands)
+    student2file = get_submissions(path, file_type=file_type)
+    submissions = list(ingest(student2file, skip_commands=skip_commands, workers=workers))
+    return Corpus(key,
+                  tuple(submission.student for submission in submissions),
+                  tuple(student2file[submission.student] for submission in submissions),
+                  tuple(submission.code for submission in submissions),
+                  tuple(submission.notebook for submission in submissions))
@@ -1,6 +1,84 @@
+import os
+import glob
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 
 import utils.misc as um
+import utils.roster as ur
+import utils.metrics as umt
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dasa1doom', 'kahoot')
+
+REPORT_SHEET = 'RawReportData Data'
+
+# the columns of the report sheet that are used, and their names in the parsed frames
+REPORT_COLUMNS = {
+    'Question Number': 'question_id',
+    'Question': 'question',
+    'Answer 1': 'answer1',
+    'Answer 2': 'answer2',
+    'Answer 3': 'answer3',
+    'Answer 4': 'answer4',
+    'Time Allotted to Answer (seconds)': 'total_time',
+    'Player': 'student',
+    'Correct': 'correct',
+    'Answer Time (seconds)': 'time',
+}
+
+PER_STUDENT_COLUMNS = ['question_id', 'student', 'correct', 'time']
+PER_QUESTION_COLUMNS = ['question_id', 'question', 'answer1', 'answer2', 'answer3', 'answer4', 'total_time']
+
+
+def file_hash(file_name):
+    """sha256 of the file content."""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_report(file_name, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Reads the used columns of a kahoot report once, the result is cached as a Parquet file
+    keyed by the hash of the workbook, so an unchanged report is not parsed again.
+
+    :param str file_name: path to xlsx file
+    :param str cache_dir: directory of the cached reports, None to disable the cache
+    :returns: the report with the columns renamed as in REPORT_COLUMNS
+    :rtype: pandas.DataFrame
+    """
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, file_hash(file_name) + '.parquet')
+        if os.path.exists(cache_file):
+            umt.count('kahoot.cache_hits')
+            return pd.read_parquet(cache_file)
+
+    with umt.timer('kahoot.read_excel'):
+        data = pd.read_excel(file_name, sheet_name=REPORT_SHEET, usecols=lambda column: column in REPORT_COLUMNS)
+    # quizzes with 2 or 3 choices have no Answer 3 or Answer 4 column
+    data = data.reindex(columns=list(REPORT_COLUMNS)).rename(columns=REPORT_COLUMNS)
+    data.question_id = data.question_id.astype(str).str.replace(' Quiz', '').astype(int)
+    for column in ['question', 'answer1', 'answer2', 'answer3', 'answer4', 'student']:
+        # answers may be numbers, Parquet needs one type per column
+        data[column] = data[column].map(lambda value: value if pd.isna(value) else str(value))
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        try:
+            data.to_parquet(tmp_file, index=False)
+        except ImportError:
+            # neither pyarrow nor fastparquet is installed, the reports are parsed every time
+            umt.count('kahoot.cache_disabled')
+            return data
+        os.replace(tmp_file, cache_file)
+    return data
 
 
 class KahootParser:
@@ -8,12 +86,67 @@ class KahootParser:
     :param str path_to_folder: should contain xlsx files of Kahoot reports
     :param dict or str student_ids: either the final dict is provided, or path to the csv file
         that contains 0 (Ids), 1 (Names)
+    :param dict or str name_mapping: known player to student name corrections, either the dict or
+        the unresolved names report (see write_unresolved) with the resolved_name column filled in
+    :param str cache_dir: directory of the cached reports (see read_report), None to disable the cache
+    :param int workers: number of processes reading the reports, defaults to the number of cores
     """
 
-    def __init__(self, path_to_folder, student_ids):
+    def __init__(self, path_to_folder, student_ids, name_mapping=None, cache_dir=DEFAULT_CACHE_DIR, workers=None):
         self.student_ids = um.get_student_info(student_ids)
-        self.files = um.get_files(path=path_to_folder, file_type='xlsx')
+        self.path = path_to_folder
+        self.files = sorted(glob.glob(os.path.join(path_to_folder, '**', '*.xlsx'), recursive=True))
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.reports = {}
+        self._semester_parts = {}
+        self._semester = (None, None)
+        self._analytics = (None, None)
+        self.roster = ur.Roster(self.student_ids)
         self.correct_name_mapping = {}
+        self.unresolved = {}
+        if isinstance(name_mapping, str):
+            report = pd.read_csv(name_mapping, dtype=str).dropna(subset=['resolved_name'])
+            name_mapping = dict(zip(report.name, report.resolved_name))
+        self.correct_name_mapping.update(name_mapping or {})
+
+    def resolve_names(self, players):
+        """
+        Assigns student names to all the new player names at once,
+        the ones that cannot be resolved are collected in self.unresolved.
+
+        :param list[str] players: player names of a report
+        """
+        new_players = [k for k in players if k not in self.correct_name_mapping]
+        resolved, unresolved = self.roster.resolve(new_players)
+        self.correct_name_mapping.update(resolved)
+        self.unresolved.update(unresolved)
+
+    def write_unresolved(self, file_name):
+        """
+        Writes the player names that could not be assigned to a student, with the closest names,
+        to be filled in and passed back as name_mapping.
+
+        :param str file_name: .csv file name
+        """
+        ur.write_report(self.unresolved, file_name)
+
+    def read_reports(self, files=None):
+        """
+        Reads the reports that are not read yet in a process pool.
+
+        :param list[str] files: paths to xlsx files, defaults to all the reports of the folder
+        :returns: file to report mapping (see read_report)
+        :rtype: dict[str, pandas.DataFrame]
+        """
+        files = self.files if files is None else files
+        to_read = [file for file in dict.fromkeys(files) if file not in self.reports]
+        if len(to_read) > 1 and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                self.reports.update(zip(to_read, pool.map(read_report, to_read, [self.cache_dir] * len(to_read))))
+        else:
+            self.reports.update((file, read_report(file, self.cache_dir)) for file in to_read)
+        return {file: self.reports[file] for file in files}
 
     def parse_per_student(self, one_kahoot):
         """
@@ -23,30 +156,95 @@ class KahootParser:
         :returns:
         :rtype: pandas.DataFrame
         """
-        data = pd.read_excel(one_kahoot, sheet_name="RawReportData Data")
-        data = data[["Question Number", "Player",
-                     "Correct", "Answer Time (seconds)"]]
-        data.rename(columns={
-            'Question Number': 'question_id',
-            'Player': 'student',
-            'Correct': 'correct',
-            'Answer Time (seconds)': 'time',
-        }, inplace=True)
-        data.question_id = data.question_id.str.replace(' Quiz', '').astype(int)
-
-        for k in data.student.unique():
-            if k in self.correct_name_mapping:
-                continue
-
-            candidate_name = um.find_in_dict(some_dict=self.student_ids,
-                                             key=um.keep_letters(k))
-            if len(candidate_name) == 1:
-                self.correct_name_mapping[k] = candidate_name[0]
-            else:
-                self.correct_name_mapping[k] = input(f'Enter the id for {k}')
+        data = self.read_reports([one_kahoot])[one_kahoot][PER_STUDENT_COLUMNS].copy()
+        self.resolve_names(data.student.unique())
         data['student_id'] = data.student.map(self.correct_name_mapping)
         return data
 
+    def semester(self, files=None):
+        """
+        Concatenates the parsed reports into one frame with categorical kahoot and student keys,
+        the students that could not be resolved keep their player names.
+        Only the reports that were not included before are read and parsed.
+
+        :param list[str] files: paths to xlsx files, defaults to all the reports of the folder,
+            may include the reports of other folders (courses)
+        :returns: kahoot, question_id, student, correct, time columns
+        :rtype: pandas.DataFrame
+        """
+        files = list(dict.fromkeys(self.files if files is None else files))
+        if self._semester[0] == files:
+            return self._semester[1]
+
+        new_files = [file for file in files if file not in self._semester_parts]
+        self.read_reports(new_files)
+        for file in new_files:
+            data = self.parse_per_student(file)
+            self._semester_parts[file] = pd.DataFrame({
+                'kahoot': os.path.splitext(os.path.relpath(file, self.path))[0],
+                'question_id': data.question_id.to_numpy(),
+                'student': data.student_id.fillna(data.student).to_numpy(),
+                'correct': data.correct.to_numpy(dtype=float),
+                'time': data.time.to_numpy(dtype=float),
+            })
+        with umt.timer('kahoot.semester'):
+            frame = pd.concat([self._semester_parts[file] for file in files], ignore_index=True)
+            frame = frame.astype({'kahoot': 'category', 'student': 'category'})
+        self._semester = (files, frame)
+        return frame
+
+    def analytics(self, files=None, percentiles=(.25, .5, .9)):
+        """
+        Semester statistics of the students and the questions, computed by grouped operations over
+        the frame of semester (recomputed only when the reports change).
+
+        Per student: answered questions, accuracy, participation (fraction of the kahoots played)
+        and the answer time percentiles.
+        Per question: number of answers, difficulty (fraction of wrong answers) and discrimination,
+        the correlation of the answer with the student's score on the rest of the kahoot.
+
+        :param list[str] files: paths to xlsx files, see semester
+        :param tuple[float] percentiles: answer time percentiles
+        :returns: students and questions frames
+        :rtype: dict[str, pandas.DataFrame]
+        """
+        data = self.semester(files)
+        if self._analytics[0] is data:
+            return self._analytics[1]
+
+        with umt.timer('kahoot.analytics'):
+            per_student = data.groupby('student', observed=True)
+            students = pd.DataFrame({
+                'answered': per_student.correct.count(),
+                'accuracy': per_student.correct.mean(),
+                'participation': per_student.kahoot.nunique() / data.kahoot.nunique(),
+            })
+            times = per_student.time.quantile(list(percentiles)).unstack()
+            times.columns = [f'time_p{round(q * 100)}' for q in times.columns]
+            students = students.join(times)
+
+            # item statistics, the rest score excludes the question itself
+            total = data.groupby(['kahoot', 'student'], observed=True).correct.transform('sum')
+            x = data.correct.to_numpy()
+            y = (total - data.correct).to_numpy()
+            sums = pd.DataFrame({'kahoot': data.kahoot, 'question_id': data.question_id,
+                                 'n': 1, 'x': x, 'y': y, 'xy': x * y, 'xx': x * x, 'yy': y * y}
+                                ).groupby(['kahoot', 'question_id'], observed=True).sum()
+            means = sums[['x', 'y', 'xy', 'xx', 'yy']].div(sums.n, axis=0)
+            covariance = means.xy - means.x * means.y
+            variance = (means.xx - means.x ** 2) * (means.yy - means.y ** 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                discrimination = covariance / np.sqrt(variance.where(variance > 1e-12))
+            questions = pd.DataFrame({
+                'answers': sums.n,
+                'difficulty': 1 - means.x,
+                'discrimination': discrimination,
+            })
+
+        result = {'students': students, 'questions': questions}
+        self._analytics = (data, result)
+        return result
+
     def parse_one_csv(self, one_csv):
         """
         Parses one processed kahoot report and assigns ids to students.
@@ -55,48 +253,55 @@ class KahootParser:
         :returns:
         :rtype: pandas.DataFrame
         """
-        data = pd.read_csv(one_csv)
-        data = data[['question_id', 'student_id', 'correct', 'time']]
+        return self.names_to_ids(pd.read_csv(one_csv))
+
+    def names_to_ids(self, data):
+        """
+        :param pandas.DataFrame data: output of parse_per_student
+        :returns: the report with student ids instead of names
+        :rtype: pandas.DataFrame
+        """
+        data = data[['question_id', 'student_id', 'correct', 'time']].copy()
         data.student_id = data.student_id.map(self.student_ids)
         return data
 
     def process_kahoot_xlsxs(self, per_student=True):
         """
         Goes over all kahoot reports and generates csv files by leaving relevant information.
+        The player names that could not be assigned to a student are written into unresolved_names.csv.
         """
+        self.read_reports()
         for file in self.files:
             if per_student:
                 self.parse_per_student(file).to_csv(file.replace('xlsx', 'csv'), index=False)
             else:
                 # per question
-                self.parse_per_question(file).to_csv(file.replace('xlsx', 'csv'), index=False)
+                self.parse_per_question(file, self.reports[file]).to_csv(file.replace('xlsx', 'csv'), index=False)
+        if self.unresolved and self.files:
+            report = os.path.join(os.path.dirname(self.files[0]), 'unresolved_names.csv')
+            self.write_unresolved(report)
+            print(f'{len(self.unresolved)} names could not be resolved, see {report}')
 
     def replace_names_with_ids(self):
         """
-        Goes over all processed kahoot reports and generates csv files without student names in them.
+        Goes over all kahoot reports and generates csv files without student names in them.
         """
+        self.read_reports()
         for file in self.files:
             csv_name = file.replace('xlsx', 'csv')
-            self.parse_one_csv(csv_name).to_csv(csv_name.replace(' ', ''), index=False)
+            self.names_to_ids(self.parse_per_student(file)).to_csv(csv_name.replace(' ', ''), index=False)
 
     @staticmethod
-    def parse_per_question(one_kahoot):
-        data = pd.read_excel(one_kahoot, sheet_name="RawReportData Data")
-        data = data[["Question Number", "Question",
-                     "Answer 1", "Answer 2", "Answer 3", "Answer 4",
-                     "Time Allotted to Answer (seconds)"]]
-        data.rename(columns={
-            'Question Number': 'question_id',
-            "Question": 'question',
-            "Answer 1": 'answer1',
-            "Answer 2": 'answer2',
-            "Answer 3": 'answer3',
-            "Answer 4": 'answer4',
-            'Time Allotted to Answer (seconds)': 'total_time'
-        }, inplace=True)
-        data.question_id = data.question_id.str.replace(' Quiz', '').astype(int)
-        data.drop_duplicates(inplace=True)
-        return data
+    def parse_per_question(one_kahoot, report=None):
+        """
+        :param str one_kahoot: path to xlsx file
+        :param pandas.DataFrame report: the already read report (see read_report)
+        :returns: the questions of the report
+        :rtype: pandas.DataFrame
+        """
+        if report is None:
+            report = read_report(one_kahoot)
+        return report[PER_QUESTION_COLUMNS].drop_duplicates()
 
 
 if __name__ == '__main__':
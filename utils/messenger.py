@@ -1,10 +1,126 @@
+import os
+import re
+import time
+import queue
+import base64
+import hashlib
 import smtplib
+import tempfile
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
-from email import encoders
+from email import policy
+
+import utils.metrics as umt
+
+# 57 bytes are encoded into one 76 characters long base64 line
+LINE_BYTES = 57
+BLOCK_LINES = 1024
+
+
+class AttachmentCache:
+    """
+    Base64-encoded attachments, encoded once per file content and streamed from disk,
+    so the same file sent to the whole class is read and encoded only once.
+
+    :param str cache_dir: directory of the encoded files, a temporary directory by default
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            self._tmp_dir = tempfile.TemporaryDirectory(prefix='messenger_')
+            cache_dir = self._tmp_dir.name
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self._digests = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        """sha256 of the file, recomputed only if its size or modification time changes."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    sha.update(block)
+            digest = self._digests[key] = sha.hexdigest()
+        return digest
+
+    def encoded(self, path):
+        """
+        :param str path: attachment
+        :returns: path to the file with the base64 lines of the attachment
+        :rtype: str
+        """
+        digest = self.digest(path)
+        encoded_path = os.path.join(self.cache_dir, digest + '.b64')
+        with self._lock:
+            lock = self._locks.setdefault(digest, threading.Lock())
+        with lock:
+            if os.path.exists(encoded_path):
+                umt.count('messenger.attachment_cache_hits')
+                return encoded_path
+            with umt.timer('messenger.encode'), open(path, 'rb') as f, open(encoded_path + '.tmp', 'wb') as out:
+                for block in iter(lambda: f.read(LINE_BYTES * BLOCK_LINES), b''):
+                    out.write(b''.join(base64.b64encode(block[i:i + LINE_BYTES]) + b'\r\n'
+                                       for i in range(0, len(block), LINE_BYTES)))
+            os.replace(encoded_path + '.tmp', encoded_path)
+        return encoded_path
+
+    def stream(self, path, block_size=2 ** 16):
+        """Yields the encoded attachment in blocks."""
+        with open(self.encoded(path), 'rb') as f:
+            yield from iter(lambda: f.read(block_size), b'')
+
+
+def quote_data(data):
+    """Doubles the dots at the line starts, as required inside the SMTP DATA command."""
+    return re.sub(rb'(?m)^\.', b'..', data)
+
+
+class RateLimiter:
+    """
+    Spaces the calls of wait() from all the threads at least 1 / rate seconds apart.
+
+    :param float rate: calls per second, None for no limit
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def is_transient(error):
+    """
+    Whether sending may succeed if retried: dropped connections, socket errors
+    and the 4xx (temporary) replies of the server.
+
+    :param Exception error: error raised while sending
+    :rtype: bool
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
 
 
 class Messenger:
@@ -14,57 +130,262 @@ class Messenger:
     :param str server: server of the mailing system
     :param int port:
     :param bool use_tls:
+    :param str password: app password, asked for if not provided, empty to skip the login
+    :param int pool_size: number of connections kept open and of emails sent in parallel
+    :param float rate_limit: maximum number of emails sent per second, None for no limit
+    :param int retries: number of retries of the transient failures
+    :param float backoff: seconds before the first retry, doubled after every retry
+    :param float timeout: socket timeout in seconds
+    :param str cache_dir: directory of the encoded attachments, see AttachmentCache
     """
 
     def __init__(self, send_from, subject, send_from_name,
                  server='smtp.gmail.com', port=587,
-                 use_tls=True):
+                 use_tls=True, password=None, pool_size=4, rate_limit=None,
+                 retries=3, backoff=1., timeout=60, cache_dir=None):
         self.send_from = send_from
         self.send_from_name = send_from_name
         self.subject = subject
-        self.password = input('Enter the app password')
+        self.password = input('Enter the app password') if password is None else password
         self.server = server
         self.port = port
         self.use_tls = use_tls
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.attachments = AttachmentCache(cache_dir)
+        self._pool = queue.LifoQueue()
+        self._opened = threading.BoundedSemaphore(pool_size)
 
-    def __call__(self, send_to, message, files):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
         """
-        Sends an email with an attachment.
+        :returns: a new connection, logged in
+        :rtype: smtplib.SMTP
+        """
+        with umt.timer('messenger.connect'):
+            smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+            try:
+                if self.use_tls:
+                    smtp.starttls()
+                if self.password:
+                    smtp.login(self.send_from, self.password)
+            except BaseException:
+                smtp.close()
+                raise
+        return smtp
 
-        :param str or list[str] send_to: email address of the recipient
+    def _acquire(self):
+        """Takes an open connection from the pool, opens one if the pool is not full yet."""
+        while True:
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                pass
+            if self._opened.acquire(blocking=False):
+                try:
+                    return self.connect()
+                except BaseException:
+                    self._opened.release()
+                    raise
+            try:
+                return self._pool.get(timeout=.1)
+            except queue.Empty:
+                continue
+
+    def _release(self, smtp, broken=False):
+        if not broken:
+            self._pool.put(smtp)
+            return
+        try:
+            smtp.close()
+        finally:
+            self._opened.release()
+
+    def close(self):
+        """Closes the pooled connections."""
+        while True:
+            try:
+                smtp = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+            self._opened.release()
+
+    def message_chunks(self, send_to, message, files):
+        """
+        Generates the email in chunks, the attachments are streamed from the AttachmentCache
+        instead of being read, encoded and copied into the message for every recipient.
+
+        :param list[str] send_to: email addresses of the recipients
         :param str message: content of the email
-        :param str or list[str] files: list of attachments
+        :param list[str] files: attachments
+        :returns: generator of the CRLF-terminated chunks of the email, dot-quoted for DATA
+        :rtype: collections.abc.Iterator[bytes]
         """
-        msg = MIMEMultipart()
+        msg = MIMEMultipart(policy=policy.SMTP)
         msg['From'] = self.send_from_name
-        if isinstance(send_to, str):
-            send_to = [send_to]
-
-        if isinstance(files, str):
-            files = [files]
         msg['To'] = COMMASPACE.join(send_to)
         msg['Date'] = formatdate(localtime=True)
         msg['Subject'] = self.subject
 
-        msg.attach(MIMEText(message))
+        msg.attach(MIMEText(message, policy=policy.SMTP))
+
+        # the attachments are inserted before the closing boundary
+        head = msg.as_bytes()
+        boundary = msg.get_boundary().encode()
+        closing = b'--' + boundary + b'--'
+        yield quote_data(head[:head.rindex(closing)])
 
         for path in files:
-            part = MIMEBase('application', "octet-stream")
-            with open(path, 'rb') as file:
-                part.set_payload(file.read())
-            encoders.encode_base64(part)
+            part = MIMEBase('application', "octet-stream", policy=policy.SMTP)
+            part['Content-Transfer-Encoding'] = 'base64'
             part.add_header('Content-Disposition',
                             'attachment; filename={}'.format(Path(path).name))
-            msg.attach(part)
+            yield quote_data(b'--' + boundary + b'\r\n' + part.as_bytes())
+            # base64 lines never start with a dot
+            yield from self.attachments.stream(path)
+        yield closing + b'\r\n'
+
+    def _sendmail(self, smtp, send_to, msg):
+        """smtplib.SMTP.sendmail writing the message chunks to the socket as they are generated."""
+        smtp.ehlo_or_helo_if_needed()
+        code, response = smtp.mail(self.send_from)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, response, self.send_from)
+        refused = {}
+        for address in send_to:
+            code, response = smtp.rcpt(address)
+            if code not in (250, 251):
+                refused[address] = (code, response)
+        if len(refused) == len(send_to):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, response = smtp.docmd('data')
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in msg:
+            smtp.send(chunk)
+        code, response = smtp.docmd('.')
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def send(self, send_to, message, files=()):
+        """
+        Sends an email over a pooled connection, retrying the transient failures.
+
+        :param str or list[str] send_to: email address of the recipient
+        :param str message: content of the email
+        :param str or list[str] files: list of attachments
+        :returns: status ('sent', 'partial' when some recipients were refused or 'failed'), number of attempts,
+            the last error and the refused recipients with the code and the response of the server
+        :rtype: dict
+        """
+        if isinstance(send_to, str):
+            send_to = [send_to]
+        if isinstance(files, str):
+            files = [files]
 
-        smtp = smtplib.SMTP(self.server, self.port)
+        status = {'recipient': COMMASPACE.join(send_to), 'status': 'failed', 'attempts': 0, 'error': None,
+                  'refused': {}}
+        try:
+            for path in files:
+                self.attachments.encoded(path)
+        except OSError as e:
+            umt.count('messenger.failed')
+            status['error'] = repr(e)
+            return status
 
-        if self.use_tls:
-            smtp.starttls()
-        smtp.login(self.send_from, self.password)
+        delay = self.backoff
+        for attempt in range(1, self.retries + 2):
+            status['attempts'] = attempt
+            self.rate_limiter.wait()
+            smtp = None
+            try:
+                smtp = self._acquire()
+                with umt.timer('messenger.send'):
+                    refused = self._sendmail(smtp, send_to, self.message_chunks(send_to, message, files))
+            except (smtplib.SMTPException, OSError) as e:
+                status['error'] = repr(e)
+                transient = is_transient(e)
+                if smtp is not None:
+                    # a refused recipient leaves the connection usable
+                    broken = not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException))
+                    if not broken:
+                        try:
+                            smtp.rset()
+                        except (smtplib.SMTPException, OSError):
+                            broken = True
+                    self._release(smtp, broken=broken)
+                if not transient or attempt > self.retries:
+                    umt.count('messenger.failed')
+                    return status
+                umt.count('messenger.retries')
+                time.sleep(delay)
+                delay *= 2
+            except BaseException:
+                # the connection may be in the middle of a message
+                if smtp is not None:
+                    self._release(smtp, broken=True)
+                raise
+            else:
+                self._release(smtp)
+                if refused:
+                    # delivered to the other recipients only, not retried to avoid duplicates
+                    umt.count('messenger.partial')
+                    umt.count('messenger.refused', len(refused))
+                    status.update(status='partial', error=None,
+                                  refused={address: (code, response.decode(errors='replace'))
+                                           for address, (code, response) in refused.items()})
+                    return status
+                umt.count('messenger.sent')
+                status.update(status='sent', error=None)
+                return status
+
+    def send_bulk(self, emails):
+        """
+        Sends many emails concurrently over the pool of connections.
+
+        :param list[tuple] emails: (recipient, message, attachments) triples
+        :returns: status of every email (see send), in the order of emails
+        :rtype: list[dict]
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+                return list(pool.map(lambda email: self.send(*email), emails))
+        finally:
+            self.close()
 
-        smtp.sendmail(self.send_from, send_to, msg.as_string())
-        smtp.quit()
+    def __call__(self, send_to, message, files):
+        """
+        Sends an email with an attachment.
+
+        :param str or list[str] send_to: email address of the recipient
+        :param str message: content of the email
+        :param str or list[str] files: list of attachments
+        """
+        try:
+            status = self.send(send_to, message, files)
+        finally:
+            self.close()
+        if status['status'] == 'partial':
+            raise smtplib.SMTPRecipientsRefused(status['refused'])
+        if status['status'] != 'sent':
+            raise smtplib.SMTPException(f"Sending to {status['recipient']} failed: {status['error']}")
 
 
 if __name__ == '__main__':
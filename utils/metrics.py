@@ -0,0 +1,153 @@
+import io
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_profiles = {}
+_profiling = {'enabled': False, 'active': False}
+
+
+@contextmanager
+def timer(name):
+    """
+    Accumulates the wall time and the number of calls of the wrapped block under the given name.
+
+    :param str name: timer name, e.g. 'similarity.parse'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            total = _timers.setdefault(name, [0., 0])
+            total[0] += elapsed
+            total[1] += 1
+
+
+def timed(name):
+    """
+    Decorator version of timer.
+
+    :param str name: timer name
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Increments the counter with the given name.
+
+    :param str name: counter name, e.g. 'similarity.pairs_evaluated'
+    :param int value: increment
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def enable_profiling(enabled=True):
+    """Turns the cProfile capture of the profile blocks on or off."""
+    _profiling['enabled'] = enabled
+
+
+@contextmanager
+def profile(name, top=30):
+    """
+    Captures a cProfile of the wrapped block if profiling is enabled,
+    nested or concurrent blocks are not profiled separately.
+
+    :param str name: profile name
+    :param int top: number of the most expensive functions to keep
+    """
+    with _lock:
+        run = _profiling['enabled'] and not _profiling['active']
+        if run:
+            _profiling['active'] = True
+    if not run:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        with _lock:
+            _profiles[name] = stream.getvalue()
+            _profiling['active'] = False
+
+
+def get_metrics():
+    """
+    :returns: timers (total seconds and calls), counters and captured profiles
+    :rtype: dict
+    """
+    with _lock:
+        return {
+            'timers': {name: {'total': total, 'calls': calls} for name, (total, calls) in _timers.items()},
+            'counters': dict(_counters),
+            'profiles': dict(_profiles),
+        }
+
+
+def get_time(name):
+    """Total seconds spent in the timer with the given name."""
+    with _lock:
+        return _timers.get(name, [0., 0])[0]
+
+
+def reset():
+    """Forgets all the collected timers, counters and profiles."""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _profiles.clear()
+
+
+def dump(file_name):
+    """
+    Writes the collected metrics into a JSON file.
+
+    :param str file_name: .json file name
+    """
+    with open(file_name, 'w') as f:
+        json.dump(get_metrics(), f, indent=2)
+
+
+def display_metrics():
+    """
+    Shows the collected metrics in a collapsed panel of the streamlit sidebar. They are the metrics of
+    the server process, added up over the reruns of all the sessions until the Reset button is clicked.
+    """
+    import streamlit as st
+
+    metrics = get_metrics()
+    with st.sidebar.expander('Metrics'):
+        st.button('Reset', key='reset_metrics', on_click=reset)
+        for name, timing in sorted(metrics['timers'].items()):
+            st.text(f"{name}: {timing['total']:.3f}s / {timing['calls']}")
+        for name, value in sorted(metrics['counters'].items()):
+            st.text(f'{name}: {value}')
+        for name, stats in metrics['profiles'].items():
+            st.caption(name)
+            st.code(stats)
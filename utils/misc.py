@@ -1,7 +1,10 @@
+import io
 import os
-import glob
+import numpy as np
 import pandas as pd
 
+import utils.submissions as us
+
 
 def remove_difference(dict_before, dict_after):
     # TODO: remove keys that are in dict_after, but not in dict_before
@@ -24,9 +27,12 @@ def grades2dict(path, file_name='results.txt', to_csv=False):
     file = os.path.join(path, file_name)
     if not os.path.exists(file):
         raise FileNotFoundError(file)
-    grades = pd.read_csv(os.path.join(path, file_name),
+    with open(file, encoding='utf8') as f:
+        # the two-space separator needs the slow python engine, a one-character one works with the C engine
+        text = f.read().replace('  ', '\x1f')
+    grades = pd.read_csv(io.StringIO(text),
                          header=None,
-                         sep='  ')
+                         sep='\x1f')
     if to_csv:
         import warnings
         warnings.filterwarnings('ignore')
@@ -59,20 +65,19 @@ def get_student_info(students, emails=False):
         return dict(zip(student_data[1], student_data[0]))
 
 
-def get_files(path, file_type='ipynb'):
+def get_files(path, file_type='ipynb', manifest_path=None):
     """
-    Reads all the file paths of given extension.
+    Reads all the file paths of given extension, the latest submitted version of every student
+    (see utils.submissions.scan, which also returns the other versions and the changes since an earlier scan).
 
     :param str path: directory of interest where the submission folders are stored
     :param str file_type: the type of files we want to get paths for
+    :param str manifest_path: the manifest of the submissions, next to the folders by default
     :returns: dictionary of student name and file path pairs
     :rtype: dict
     """
-    student2file = {}
-    for folder in os.listdir(path):
-        student_name = folder.split('_')[0]
-        student2file[student_name] = glob.glob(os.path.join(path, folder, f'*{file_type}'))[0]
-    return student2file
+    scan = us.scan(path, file_type=file_type, manifest_path=manifest_path)
+    return {student: version.path for student, version in scan.latest.items()}
 
 
 def normalize_dict(some_dict, values_sum=100):
@@ -117,17 +122,96 @@ def read_txt(path, file_name):
         return f.read()
 
 
+def _encode(strings, fill):
+    """Code points of the strings as a padded 2d array."""
+    lengths = np.array([len(string) for string in strings], dtype=np.int64)
+    codes = np.full((len(strings), max(lengths.max(initial=0), 1)), fill, dtype=np.uint32)
+    for num, string in enumerate(strings):
+        codes[num, :len(string)] = np.frombuffer(string.encode('utf-32-le'), dtype=np.uint32)
+    return codes, lengths
+
+
 def hamming_dist(str1, str2):
     """
     Calculates the hamming distance between two strings
     :param str1:
-    :param str2:
+    :param str2: at least as long as str1
     :return: float
     """
-    dist = 0
-    for i in range(len(str1)):
-        dist += (str2[i] != str1[i]) * 1
-    return dist
+    if len(str2) < len(str1):
+        raise IndexError('string index out of range')
+    (a, b), _ = _encode([str1, str2[:len(str1)]], fill=0)
+    return int(np.count_nonzero(a != b))
+
+
+def edit_distance(strings1, strings2, substring=False):
+    """
+    Levenshtein distances of many string pairs at once, every dynamic programming row
+    is computed for all the pairs with a few numpy operations.
+
+    :param list[str] strings1: first strings of the pairs
+    :param list[str] strings2: second strings of the pairs
+    :param bool substring: if True, the distance of strings1 to the best matching substring of strings2
+    :returns: distance of every pair
+    :rtype: numpy.ndarray
+    """
+    a, len_a = _encode(strings1, fill=0)
+    b, len_b = _encode(strings2, fill=2 ** 32 - 1)
+    nr_pairs, nr_columns = len(strings1), b.shape[1] + 1
+    columns = np.arange(nr_columns)
+
+    # columns beyond the length of the second string are not part of the pair
+    valid = columns[None, :] <= len_b[:, None]
+    if substring:
+        previous = np.zeros((nr_pairs, nr_columns), dtype=np.int64)
+    else:
+        previous = np.broadcast_to(columns, (nr_pairs, nr_columns)).copy()
+
+    result = np.zeros(nr_pairs, dtype=np.int64)
+    if nr_pairs == 0:
+        return result
+    result[len_a == 0] = 0 if substring else len_b[len_a == 0]
+    for i in range(1, a.shape[1] + 1):
+        cost = a[:, i - 1, None] != b
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        current[:, 1:] = np.minimum(previous[:, 1:] + 1, previous[:, :-1] + cost)
+        # insertions: current[j] = min over k <= j of current[k] + (j - k)
+        current = np.minimum.accumulate(current - columns, axis=1) + columns
+        done = len_a == i
+        if done.any():
+            if substring:
+                result[done] = np.where(valid[done], current[done], np.iinfo(np.int64).max).min(axis=1)
+            else:
+                result[done] = current[done, len_b[done]]
+        previous = current
+    return result
+
+
+def get_file(files, file_name, letter_tolerance=0):
+    """
+    Finds the file whose name contains the given name, allowing a few wrong letters.
+
+    :param list[str] files: file paths
+    :param str file_name: name to search for, e.g. the student name
+    :param int letter_tolerance: number of letters that may differ
+    :returns: the best matching file, None if there is none or it is ambiguous
+    :rtype: str or None
+    """
+    if file_name in files:
+        return file_name
+    same_name = [file for file in files if os.path.basename(file) == os.path.basename(file_name)]
+    if len(same_name) == 1:
+        return same_name[0]
+    key = keep_letters(os.path.splitext(os.path.basename(file_name))[0]).lower()
+    stems = [keep_letters(os.path.splitext(os.path.basename(file))[0]).lower() for file in files]
+    if not key or not files:
+        return None
+    distances = edit_distance([key] * len(files), stems, substring=True)
+    best = distances.min()
+    if best > letter_tolerance or (distances == best).sum() > 1:
+        return None
+    return files[int(distances.argmin())]
 
 
 def find_in_dict(some_dict, key):
@@ -152,3 +236,21 @@ def find_in_dict(some_dict, key):
 def keep_letters(some_str):
     """Keeps only the letters in a string."""
     return ''.join(filter(str.isalpha, some_str))
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process.
+
+    :returns: peak RSS in megabytes, None if the platform does not provide it
+    :rtype: float or None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
@@ -1,7 +1,13 @@
 import os
+import re
 import json
+import mmap
+import threading
+
+from collections import OrderedDict
 
 import utils.misc as um
+import utils.metrics as umt
 
 
 def join(text):
@@ -15,6 +21,11 @@ def join(text):
     return ''.join(text)
 
 
+def text_size(text):
+    """Number of characters of an output stored as a string or as a list of lines."""
+    return sum(map(len, text)) if isinstance(text, list) else len(text)
+
+
 def notebook_to_dict(file_name):
     """
     Function for loading the jupyter notebook as a dict
@@ -22,9 +33,206 @@ def notebook_to_dict(file_name):
     :param str file_name: .ipynb file name
     :return: dict
     """
-    if isinstance(file_name, str):
-        file_name = open(file_name, mode='r', encoding="utf8")
-    return json.load(file_name)
+    with umt.timer('notebook.load'):
+        if isinstance(file_name, str):
+            with open(file_name, mode='r', encoding="utf8") as f:
+                return json.load(f)
+        return json.load(file_name)
+
+
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_SCALAR = re.compile(rb'[^,}\]\s]+')
+_SEPARATORS = re.compile(rb'[\s,:]*')
+
+
+def _string_end(data, pos):
+    """Returns the position right after the json string starting at pos, long strings are skipped with find."""
+    end = pos
+    while True:
+        end = data.find(b'"', end + 1)
+        if end < 0:
+            raise ValueError('Unterminated json string at {}'.format(pos))
+        backslash = end - 1
+        while data[backslash] == 92:  # ord('\\')
+            backslash -= 1
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
+
+
+def _value_end(data, pos):
+    """Returns the position right after the json value starting at pos, without decoding it."""
+    first = data[pos:pos + 1]
+    if first == b'"':
+        return _string_end(data, pos)
+    if first not in (b'[', b'{'):
+        return _SCALAR.match(data, pos).end()
+    depth = 0
+    while True:
+        m = _STRUCTURE.search(data, pos)
+        if m is None:
+            raise ValueError('Unterminated json value at {}'.format(pos))
+        char = data[m.start()]
+        if char == 34:  # ord('"')
+            pos = _string_end(data, m.start())
+            continue
+        pos = m.end()
+        if char in (91, 123):  # ord('['), ord('{')
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def _iter_items(data, pos):
+    """Yields (key, value start, value end) of the json object starting at pos."""
+    pos += 1
+    while True:
+        pos = _SEPARATORS.match(data, pos).end()
+        if data[pos:pos + 1] == b'}':
+            return
+        key_end = _string_end(data, pos)
+        key = json.loads(data[pos:key_end])
+        start = _SEPARATORS.match(data, key_end).end()
+        pos = _value_end(data, start)
+        yield key, start, pos
+
+
+def _iter_elements(data, pos):
+    """Yields the start positions of the elements of the json array starting at pos."""
+    pos += 1
+    while True:
+        pos = _SEPARATORS.match(data, pos).end()
+        if data[pos:pos + 1] == b']':
+            return
+        yield pos
+        pos = _value_end(data, pos)
+
+
+class LazyNotebook:
+    """
+    Jupyter notebook read without decoding the cell outputs.
+
+    Only the cell types and sources are decoded, the outputs (mostly base64 images)
+    are skipped and only their byte spans are kept, so that they can be decoded
+    when a full cell is needed for display.
+    Iterating or indexing gives the full cells, like notebook_to_dict(...)['cells'].
+
+    :param str file_name: .ipynb file name, an object with read_bytes that is re-read on demand
+        (e.g. utils.ingest.ZipMember or pathlib.Path) or a binary file object (e.g. streamlit upload)
+    """
+
+    lazy_keys = ('outputs', 'attachments')
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._data = None
+        if not isinstance(file_name, str) and not hasattr(file_name, 'read_bytes'):
+            self.file_name = None
+            self._data = file_name.read()
+        self.cell_types = []
+        self.sources = []
+        self._cells = []
+        with umt.timer('notebook.lazy_load'):
+            self._scan()
+
+    def _open(self):
+        if self._data is not None:
+            return self._data
+        if not isinstance(self.file_name, str):
+            return self.file_name.read_bytes()
+        with open(self.file_name, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scan(self):
+        data = self._open()
+        try:
+            top = _SEPARATORS.match(data, 0).end()
+            for key, start, end in _iter_items(data, top):
+                if key != 'cells':
+                    continue
+                for cell_start in _iter_elements(data, start):
+                    cell, spans = {}, {}
+                    for cell_key, value_start, value_end in _iter_items(data, cell_start):
+                        if cell_key in self.lazy_keys:
+                            spans[cell_key] = (value_start, value_end)
+                        else:
+                            cell[cell_key] = json.loads(data[value_start:value_end])
+                    self.cell_types.append(cell.get('cell_type'))
+                    self.sources.append(join(cell.get('source', '')))
+                    self._cells.append((cell, spans))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __getitem__(self, idx):
+        return self.cell(idx)
+
+    def __iter__(self):
+        data = self._open() if any(spans for _, spans in self._cells) else b''
+        try:
+            for idx in range(len(self)):
+                yield self._decode(idx, data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def cell(self, idx):
+        """
+        Decodes the full cell including its outputs.
+
+        :param int idx: cell index
+        :rtype: dict
+        """
+        data = self._open() if self._cells[idx][1] else b''
+        try:
+            return self._decode(idx, data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def _decode(self, idx, data):
+        cell, spans = self._cells[idx]
+        cell = dict(cell)
+        for key, (start, end) in spans.items():
+            cell[key] = json.loads(data[start:end])
+        return cell
+
+    def code_cells(self):
+        """
+        :returns: sources of the code cells
+        :rtype: list[str]
+        """
+        return [source for cell_type, source in zip(self.cell_types, self.sources) if cell_type == 'code']
+
+
+def extract_code(notebook, skip_commands=()):
+    """
+    Joins the code cells of the notebook, once a cell contains one of the skip commands
+    (e.g. shell commands) it and all the following code cells are left out.
+
+    :param LazyNotebook notebook: notebook to extract the code from
+    :param list[str] skip_commands: commands that invalidate the python code
+    :returns: code of the notebook
+    :rtype: str
+    """
+    code = []
+    skip = False
+    for cell_type, source in zip(notebook.cell_types, notebook.sources):
+        if cell_type == 'code':
+            for skip_command in skip_commands:
+                if skip_command in source:
+                    skip = True
+            if skip:
+                continue
+            code.append(source)
+
+    return '\n'.join(code)
 
 
 def dict_to_notebook(some_dict, file_name):
@@ -50,8 +258,10 @@ def get_cell_id(cells, some_text):
     :param str some_text: text of interest
     :return: int of the cell index containing the requested problem
     """
-    return [num for num in range(len(cells)) if cell_startswith(cell=cells[num],
-                                                                some_text=some_text)][0]
+    for num in range(len(cells)):
+        if cell_startswith(cell=cells[num], some_text=some_text):
+            return num
+    raise IndexError(some_text)
 
 
 def cell_startswith(cell, some_text):
@@ -89,7 +299,91 @@ def save_notebook(save_dir, file_name, file_dict, update=False, files=None):
     return files
 
 
-def find_cell_id_per_notebook(files, file_name, some_text=None):
+class NotebookIndex:
+    """
+    Loads every notebook once and maps the problem markers to cell indices in a single pass
+    over its cells, the last used notebooks are kept in memory.
+
+    :param list[str] markers: texts the problem cells start with, e.g. ['## Problem 1', '## Problem 2'],
+        markers that are searched later are added to the list
+    :param int maxsize: number of notebooks to keep
+    """
+
+    def __init__(self, markers=None, maxsize=32):
+        self.markers = list(markers or [])
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(file_name):
+        stat = os.stat(file_name)
+        return file_name, stat.st_mtime_ns, stat.st_size
+
+    def _build(self, file_name):
+        notebook = notebook_to_dict(file_name)
+        cells = [join(cell['source']) for cell in notebook['cells']]
+        positions = {}
+        for num, cell in enumerate(cells):
+            cell = cell.strip()
+            if not cell:
+                continue
+            for marker in self.markers:
+                if marker not in positions and cell.startswith(marker):
+                    positions[marker] = num
+        umt.count('notebook.index_builds')
+        return {'notebook': notebook, 'cells': cells, 'positions': positions}
+
+    def get(self, file_name):
+        """
+        :param str file_name: .ipynb file name
+        :returns: the notebook dict, the cell sources and the marker positions,
+            the notebook is shared between the callers, copy it before modifying
+        :rtype: dict
+        """
+        key = self._key(file_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                umt.count('notebook.index_hits')
+                return entry
+        entry = self._build(file_name)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def find(self, file_name, some_text):
+        """
+        Finds the cell id that starts with the given text.
+
+        :param str file_name: .ipynb file name
+        :param str some_text: text of interest
+        :returns: the notebook dict, the cell sources and the index of the cell
+        :rtype: tuple
+        """
+        entry = self.get(file_name)
+        positions = entry['positions']
+        if some_text not in positions:
+            with self._lock:
+                if some_text not in self.markers:
+                    # found in the single pass of the notebooks loaded from now on
+                    self.markers.append(some_text)
+            positions[some_text] = get_cell_id(cells=entry['cells'], some_text=some_text)
+        return entry['notebook'], entry['cells'], positions[some_text]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+notebook_index = NotebookIndex()
+
+
+@umt.timed('notebook.find_cell')
+def find_cell_id_per_notebook(files, file_name, some_text=None, index=None):
     """
     Processes the notebook file and returns the id of the cell
     that starts with the given condition.
@@ -97,8 +391,9 @@ def find_cell_id_per_notebook(files, file_name, some_text=None):
     :param list[str] files: file paths
     :param str file_name: name of the .ipynb file
     :param str some_text: text of interest
+    :param NotebookIndex index: index to look the problems up in, defaults to the shared one
     :returns: hw - file name
-            notebook - dict of the notebook read from json
+            notebook - dict of the notebook read from json (shared by the index, copy before modifying)
             cells - list of str containing the necessary parts of the notebook
             idx - int of the index of the problem code in the notebook
     :rtype: tuple
@@ -108,46 +403,141 @@ def find_cell_id_per_notebook(files, file_name, some_text=None):
     if file_name is None:
         return [None] * 4
 
-    notebook = notebook_to_dict(file_name)
-
-    cells = notebook['cells'].copy()
-    nr_cells = len(cells)
-
     if some_text is None:
-        # get all code cells
-        return '\n'.join([join(cells[idx]['source']) for idx in range(nr_cells) if cells[idx]['cell_type'] == 'code'])
-    else:
-        # get all the cells in str format
-        cells = [join(cells[idx]['source']) for idx in range(nr_cells)]
+        # get all code cells, the outputs are not needed
+        return '\n'.join(LazyNotebook(file_name).code_cells())
 
     # get the index of the cell containing the i-th problem
     try:
-        idx = get_cell_id(cells=cells, some_text=some_text)
+        notebook, cells, idx = (index or notebook_index).find(file_name, some_text)
     except IndexError:
+        umt.count('notebook.problem_not_found')
         raise Exception(f'{some_text} was not found.\
          Make sure you search the correct text.')
     return file_name, notebook, cells, idx
 
 
-def display_notebook_cell(cell):
-    import streamlit as st
+class RenderCache:
+    """
+    Size-bounded LRU cache of rendered outputs (decoded images, trimmed html),
+    keyed by the hash of the output content, so that reruns do not decode them again.
+
+    :param int max_bytes: total size of the cached values
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nr_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        :param tuple key: content key
+        :param build: callable that renders the value if it is not cached
+        :returns: the cached or the rendered value (bytes or str)
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                umt.count('notebook.render_hits')
+                return self._entries[key]
+        value = build()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self.nr_bytes += len(value)
+            while self.nr_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.nr_bytes -= len(evicted)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nr_bytes = 0
+
+
+render_cache = RenderCache()
+
+
+def content_key(kind, content, *params):
+    """Cheap key of an output, the hash of a str is computed in C without copying it."""
+    if not isinstance(content, str):
+        content = join(content)
+    return (kind, hash(content), len(content)) + params
+
+
+def decode_image(data, max_width=None):
+    """
+    Decodes a base64 png output and optionally downscales it to a thumbnail.
+
+    :param str data: base64 encoded image
+    :param int max_width: maximal width of the thumbnail, None keeps the original
+    :rtype: bytes
+    """
     import base64
 
+    image = base64.b64decode(data)
+    if max_width is None:
+        return image
+    try:
+        from PIL import Image
+    except ImportError:
+        return image
+    import io
+
+    with Image.open(io.BytesIO(image)) as thumbnail:
+        if thumbnail.width <= max_width:
+            return image
+        thumbnail.thumbnail((max_width, max_width * thumbnail.height // thumbnail.width))
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def trim_html(table):
+    """Removes the colab buttons from an html table output."""
+    idx = len(table)
+    if '    <div class="colab-df-buttons">\n' in table:
+        idx = table.index('    <div class="colab-df-buttons">\n')
+    return join(table[:idx])
+
+
+def display_notebook_cell(cell, key='', max_width=None, collapse_kb=512):
+    """
+    Displays a notebook cell, the decoded images and the trimmed tables are taken from render_cache.
+
+    :param dict cell: notebook cell
+    :param str key: unique key of the cell on the page, e.g. student name and cell index
+    :param int max_width: downscale the images wider than this, None keeps them as they are
+    :param int collapse_kb: outputs larger than this are decoded only after they are toggled on
+    """
+    import streamlit as st
+
     if cell['cell_type'] == 'code':
         st.code(join(cell['source']))
-        for output in cell['outputs']:
+        for num, output in enumerate(cell['outputs']):
             if 'text' in output:
                 st.info(join(output['text']))
             elif 'data' in output:
                 if 'image/png' in output['data']:
-                    st.image(base64.b64decode(output['data']['image/png']))
+                    data = output['data']['image/png']
+                    size = text_size(data)
+                    if size > collapse_kb * 1024 and not st.toggle(
+                            f'Show image ({size // 1024} KB)', key=f'{key}-output-{num}'):
+                        continue
+                    st.image(render_cache.get(content_key('png', data, max_width),
+                                              lambda: decode_image(data, max_width)))
                 else:
                     if 'text/html' in output['data']:
                         table = output['data']['text/html']
-                        idx = len(table)
-                        if '    <div class="colab-df-buttons">\n' in table:
-                            idx = table.index('    <div class="colab-df-buttons">\n')
-                        st.markdown(join(table[:idx]), unsafe_allow_html=True)
+                        size = text_size(table)
+                        if size > collapse_kb * 1024 and not st.toggle(
+                                f'Show table ({size // 1024} KB)', key=f'{key}-output-{num}'):
+                            continue
+                        st.markdown(render_cache.get(content_key('html', table), lambda: trim_html(table)),
+                                    unsafe_allow_html=True)
 
     else:
         st.markdown(join(cell['source']), unsafe_allow_html=True)
@@ -0,0 +1,197 @@
+import io
+import re
+import base64
+import hashlib
+import itertools
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import utils.notebook as un
+import utils.metrics as umt
+
+OutputFingerprints = namedtuple('OutputFingerprints', ['texts', 'images'])
+
+_ADDRESS = re.compile(r'0x[0-9a-fA-F]+')
+_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+_SPACES = re.compile(r'\s+')
+
+# bands of the 64 bit image hashes, two images within BANDS - 1 differing bits share a band
+BANDS = 4
+BAND_BITS = 64 // BANDS
+
+
+def normalize_text(text):
+    """Removes what differs between two runs of the same code: memory addresses, colors and spacing."""
+    return _SPACES.sub(' ', _ANSI.sub('', _ADDRESS.sub('0x', text))).strip()
+
+
+def text_hash(text):
+    """64 bit hash of the normalized text."""
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode('utf8'), digest_size=8).digest(), 'big')
+
+
+def image_hash(data, size=8):
+    """
+    Difference hash of a png output: the image is reduced to (size + 1) x size gray pixels and
+    every bit tells whether a pixel is brighter than its right neighbour, so re-encoded, rescaled
+    or slightly changed plots get the same or a close hash.
+
+    :param str data: base64 encoded png
+    :param int size: side of the hash, size * size bits
+    :returns: the hash, None if the image cannot be decoded
+    :rtype: int or None
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(un.join(data)))) as image:
+            image.draft('L', (size * 4, size * 4))
+            pixels = np.asarray(image.convert('L').resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    except (OSError, ValueError):
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+@umt.timed('outputs.fingerprint')
+def fingerprint_outputs(notebook, min_length=16):
+    """
+    Hashes the outputs of the code cells once: the text outputs (streams, results, tables,
+    tracebacks) and the png images.
+
+    :param un.LazyNotebook notebook: the notebook
+    :param int min_length: shorter texts (e.g. True, 42) are too common to tell anything
+    :rtype: OutputFingerprints
+    """
+    texts, images = set(), set()
+    for cell in notebook:
+        for output in cell.get('outputs', ()):
+            output_type = output.get('output_type')
+            if output_type == 'stream':
+                candidates = [un.join(output.get('text', ''))]
+            elif output_type == 'error':
+                candidates = [f"{output.get('ename')}: {output.get('evalue')}"]
+            else:
+                data = output.get('data', {})
+                if 'image/png' in data:
+                    digest = image_hash(data['image/png'])
+                    if digest is not None:
+                        images.add(digest)
+                    # the text of a figure is the same for every figure
+                    continue
+                candidates = [un.join(data[key]) for key in ('text/html', 'text/plain') if key in data][:1]
+            texts.update(text_hash(text) for text in candidates if len(text.strip()) >= min_length)
+    return OutputFingerprints(texts, images)
+
+
+def popcount(values):
+    """Number of set bits of every uint64."""
+    values = np.asarray(values, dtype=np.uint64)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class OutputIndex:
+    """
+    Hash index of the output fingerprints of a cohort.
+
+    Notebooks sharing a fingerprint are found through the index instead of comparing all pairs.
+    Fingerprints shared by more than max_share of the cohort (correct answers that everyone prints)
+    are ignored. Near-identical images are found through the bands of their hashes and confirmed
+    by the number of differing bits.
+
+    :param float max_share: fingerprints of more notebooks than this fraction are not evidence
+    :param int max_bits: maximal number of differing bits of near-identical images, below BANDS
+    :param int max_band_size: images sharing a band with more images are not compared, bounds the time
+    """
+
+    def __init__(self, max_share=0.05, max_bits=3, max_band_size=256):
+        self.max_share = max_share
+        self.max_bits = max_bits
+        self.max_band_size = max_band_size
+        self.fingerprints = {}
+
+    def add(self, name, fingerprints):
+        """
+        :param str name: student name
+        :param OutputFingerprints fingerprints: output of fingerprint_outputs
+        """
+        self.fingerprints[name] = fingerprints
+
+    @classmethod
+    def from_notebooks(cls, names, notebooks, workers=None, **kwargs):
+        """Fingerprints the notebooks in a thread pool and indexes them."""
+        index = cls(**kwargs)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, fingerprints in zip(names, pool.map(fingerprint_outputs, notebooks)):
+                index.add(name, fingerprints)
+        return index
+
+    def _max_df(self):
+        return max(2, int(self.max_share * len(self.fingerprints)))
+
+    def _buckets(self):
+        """Names per exact text or image hash, and (name, hash) per image band."""
+        exact, bands = {}, {}
+        for name, fingerprints in self.fingerprints.items():
+            for digest in fingerprints.texts:
+                exact.setdefault(('text', digest), []).append(name)
+            for digest in fingerprints.images:
+                exact.setdefault(('image', digest), []).append(name)
+                for band in range(BANDS):
+                    key = (band, (digest >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1))
+                    bands.setdefault(key, []).append((name, digest))
+        return exact, bands
+
+    @umt.timed('outputs.match')
+    def scores(self):
+        """
+        :returns: score of every pair of notebooks sharing outputs, the number of shared
+            fingerprints divided by the number of fingerprints of the notebook with fewer of them
+        :rtype: dict[frozenset[str], float]
+        """
+        max_df = self._max_df()
+        exact, bands = self._buckets()
+        shared = {}
+        for names in exact.values():
+            if 2 <= len(names) <= max_df:
+                for pair in itertools.combinations(sorted(set(names)), 2):
+                    shared[frozenset(pair)] = shared.get(frozenset(pair), 0) + 1
+
+        # near-identical images, a band bucket may also hold unrelated images sharing 16 bits
+        near, neighbours = set(), {}
+        for members in bands.values():
+            if len(members) < 2 or len(members) > self.max_band_size:
+                continue
+            pairs = [(a, b) for a, b in itertools.combinations(members, 2) if a[0] != b[0] and a[1] != b[1]]
+            if not pairs:
+                continue
+            distances = popcount([a[1] ^ b[1] for a, b in pairs])
+            for (a, b), distance in zip(pairs, distances):
+                if distance <= self.max_bits:
+                    near.add((frozenset((a[0], b[0])), frozenset((a[1], b[1]))))
+                    neighbours.setdefault(a[1], set()).add(b[0])
+                    neighbours.setdefault(b[1], set()).add(a[0])
+        for pair, digests in near:
+            # images close to the ones of many notebooks are as common as exact duplicates
+            if all(len(set(exact[('image', digest)]) | neighbours[digest]) <= max_df for digest in digests):
+                shared[pair] = shared.get(pair, 0) + 1
+
+        sizes = {name: len(f.texts) + len(f.images) for name, f in self.fingerprints.items()}
+        umt.count('outputs.pairs_matched', len(shared))
+        return {pair: min(1., count / max(min(sizes[name] for name in pair), 1)) for pair, count in shared.items()}
+
+
+def combine_scores(ast_score, output_score, weight=0.5):
+    """
+    Adds the output similarity to the score of summarize as an extra, weaker evidence:
+    1 - (1 - ast_score) * (1 - weight * output_score).
+
+    :param float ast_score: plagiarism percent of code_similarity.summarize
+    :param float output_score: score of OutputIndex.scores
+    :param float weight: between 0 (outputs ignored) and 1
+    :rtype: float
+    """
+    return 1 - (1 - ast_score) * (1 - weight * output_score)
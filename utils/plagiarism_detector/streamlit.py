@@ -1,17 +1,44 @@
 import streamlit as st
 import os
+import json
+import types
+import heapq
+import getpass
+
+from collections import namedtuple
 
 import utils.notebook as un
-import utils.misc as um
+import utils.metrics as umt
+import utils.ingest as ui
+import utils.output_similarity as uos
+import utils.score_stats as uss
+import utils.grade_store as ugs
+import utils.shared as ush
+
+from utils.code_similarity import fingerprint, compare, summarize, token_fingerprint, token_similarity
 
-from utils.code_similarity import detect, summarize
+Candidate = namedtuple('Candidate', ['name1', 'name2', 'notebook1', 'notebook2', 'code1', 'code2',
+                                     'score', 'ast_score', 'output_score'])
 
 
 class PlagiarismDetectorStreamlit:
     skip_commands = ['pip', 'unzip', 'wget']
     """
-    :param str path: defines the directory where the notebooks are
+    :param str path: defines the directory where the notebooks are, or a zip export of them
     :param float tol_level: the sensitivity/confidence of the detection
+    :param str metrics_file: optional .json file to write the timers and counters into
+    :param bool profile: specifies whether to capture a cProfile of the detection
+    :param int workers: number of threads decoding the notebooks, defaults to the number of cores
+    :param float output_weight: weight of the shared cell outputs added to the code similarity,
+        0 to ignore the outputs (see utils.output_similarity.combine_scores)
+    :param str threshold: 'fixed' to flag the pairs above tol_level, 'top' or 'zscore' to derive the
+        threshold from the cohort's score distribution (see utils.score_stats.ScoreSketch.threshold)
+    :param float top_share: share of the pairs flagged by the 'top' threshold
+    :param float z_score: standard deviations above the mean of the 'zscore' threshold
+    :param int max_candidates: number of the highest scoring pairs kept for the review
+    :param str decisions_db: .sqlite file the review decisions are written into as they are made,
+        defaults to grades.sqlite next to the submissions, shared by all the reviewer sessions
+    :param str reviewer: name recorded with the decisions, defaults to the user name
     """
     files = None
     students = None
@@ -19,51 +46,68 @@ class PlagiarismDetectorStreamlit:
     def __init__(self,
                  path,
                  tol_level=0.9,
+                 metrics_file=None,
+                 profile=False,
+                 workers=None,
+                 output_weight=0.5,
+                 threshold='fixed',
+                 top_share=0.01,
+                 z_score=3.,
+                 max_candidates=1000,
+                 decisions_db=None,
+                 reviewer=None,
                  ):
         self.path = path
         self.tol_level = tol_level
+        self.metrics_file = metrics_file
+        self.profile = profile
+        self.workers = workers
+        self.output_weight = output_weight
+        self.threshold = threshold
+        self.top_share = top_share
+        self.z_score = z_score
+        self.max_candidates = max_candidates
+        self.store = ugs.DecisionStore(decisions_db or ugs.default_db_path(ui.output_dir(path)))
+        self.reviewer = reviewer or getpass.getuser()
 
     def detect(self):
-        student2file = um.get_files(path=self.path, file_type='ipynb')
-        # students = [um.get_student_name(file) for file in files]
-        self.run(student2file)
+        self.run()
 
-    def run(self, student2file):
+    def run(self, corpus=None):
         """
         Goes over all the problems for each student
         searches for potential plagiarism, asks the user to double check the detection
-        and penalizes if needed
-        :return:
+        and penalizes if needed.
+        The detection is shared by all the sessions, only the position and the decisions
+        of the reviewer are kept per session.
+
+        :param utils.ingest.Corpus corpus: the submissions, loaded from path if None (see utils.shared.corpus)
         """
         st.set_page_config(layout="wide", page_icon="", page_title="Plagiarism Detector", )
 
         st.title("Plagiarism Detector")
 
-        pycode_list, cells, names = self.get_codes_names(student2file)
+        # the metrics are shared by the sessions of the server, reset only from the Metrics panel
+        umt.enable_profiling(self.profile)
 
-        nr_codes = len(pycode_list)
-        candidates = []
-        for i in range(nr_codes):
-            try:
-                results = detect(pycode_list[i:], keep_prints=True, module_level=True)
-            except SyntaxError as e:
-                print(e, 'Check the code, maybe there are bash commands.')
-                continue
-            for index, func_ast_diff_list in results:
-                sum_plagiarism_percent, _, _ = summarize(func_ast_diff_list)
-                if sum_plagiarism_percent > self.tol_level:
-                    candidates.append({
-                        'code1': pycode_list[i],
-                        'notebook1': cells[i],
-                        'notebook2': cells[i + index],
-                        'code2': pycode_list[i + index],
-                        'name1': names[i],
-                        'name2': names[i + index],
-                        'score': sum_plagiarism_percent,
-                    })
+        if corpus is None:
+            with umt.timer('detector.load'):
+                corpus = ush.corpus(self.path, skip_commands=self.skip_commands, workers=self.workers)
+
+        key = (corpus.key, self.tol_level, self.output_weight, self.threshold, self.top_share, self.z_score,
+               self.max_candidates)
+        candidates, score_stats = ush.result('detection', key, lambda: self.find_candidates(corpus))
+        self.display_score_stats(score_stats)
+
+        umt.display_metrics()
+        if self.metrics_file:
+            umt.dump(self.metrics_file)
 
         if 'idx' not in st.session_state:
-            st.session_state.idx = 0
+            # resume from the first pair no reviewer decided on, e.g. after a browser refresh
+            decided = self.store.decisions()
+            st.session_state.idx = next((num for num, pair in enumerate(candidates)
+                                         if (pair.name1, pair.name2) not in decided), max(len(candidates) - 1, 0))
             st.session_state.cheaters = []
 
         if len(candidates) == 0:
@@ -72,78 +116,189 @@ class PlagiarismDetectorStreamlit:
 
         c1, c2 = st.columns(2)
         pair = candidates[st.session_state.idx]
+        st.caption(f"Similarity {pair.score:.2f}: code {pair.ast_score:.2f}, "
+                   f"shared outputs {pair.output_score:.2f}")
 
         if st.button('Display'):
+            # kept displayed on the reruns of the output toggles, cleared when moving on
+            st.session_state.displayed = st.session_state.idx
+
+        if st.session_state.get('displayed') == st.session_state.idx:
             with c1:
-                st.info(pair['name1'])
-                for cell in pair['notebook1']:
-                    un.display_notebook_cell(cell)
+                st.info(pair.name1)
+                for num, cell in enumerate(pair.notebook1):
+                    un.display_notebook_cell(cell, key=f'1-{pair.name1}-{num}')
 
             with c2:
-                st.info(pair['name2'])
-                for cell in pair['notebook2']:
-                    un.display_notebook_cell(cell)
+                st.info(pair.name2)
+                for num, cell in enumerate(pair.notebook2):
+                    un.display_notebook_cell(cell, key=f'2-{pair.name2}-{num}')
 
         if st.session_state.idx == len(candidates) - 1:
 
-            if st.button("Penalize", key="penalize2"):
-                st.session_state.cheaters.append([pair['name1'], pair['name2']])
+            if st.button("Penalize", key="penalize2", on_click=self.hide_notebook):
+                self.decide(pair, ugs.PENALIZE)
 
-            if st.button("Finish", key="finish"):
+            if st.button("Finish", key="finish", on_click=self.hide_notebook):
+                # the decisions of all the reviewers
+                cheaters = self.store.cheaters()
                 st.success('The job is completed.')
-                st.info(f'{st.session_state.cheaters}')
+                st.info(f'{cheaters}')
 
-                with open(os.path.join(self.path, 'cheaters.txt'), 'w') as f:
-                    f.write(f'{st.session_state.cheaters}')
+                with open(os.path.join(ui.output_dir(self.path), 'cheaters.txt'), 'w') as f:
+                    f.write(f'{cheaters}')
+                with open(os.path.join(ui.output_dir(self.path), 'score_stats.json'), 'w') as f:
+                    json.dump(dict(score_stats), f, indent=2)
 
                 st.stop()
 
-        if st.button("Penalize", key="penalize"):
-            st.session_state.cheaters.append([pair['name1'], pair['name2']])
+        if st.button("Penalize", key="penalize", on_click=self.hide_notebook):
+            self.decide(pair, ugs.PENALIZE)
 
             if st.session_state.idx < len(candidates) - 1:
                 st.session_state.idx += 1
 
-        if st.button("Skip", key="skip"):
+        if st.button("Skip", key="skip", on_click=self.hide_notebook):
+            self.decide(pair, ugs.SKIP)
             if st.session_state.idx < len(candidates) - 1:
                 st.session_state.idx += 1
 
+    def decide(self, pair, decision):
+        """Records the decision of the reviewer, shared with the other sessions through the store."""
+        self.store.set(pair.name1, pair.name2, decision, reviewer=self.reviewer)
+        if decision == ugs.PENALIZE:
+            st.session_state.cheaters.append([pair.name1, pair.name2])
+
+    def find_candidates(self, corpus, func_infos=None):
+        """
+        Scores all the pairs of submissions.
+
+        :param utils.ingest.Corpus corpus: the submissions
+        :param list func_infos: fingerprint_codes of the codes of get_codes_names, if already computed
+        :returns: the pairs above the threshold and the statistics of the scores
+        :rtype: tuple[tuple[Candidate], types.MappingProxyType]
+        """
+        pycode_list, cells, names = self.get_codes_names(corpus)
+
+        output_scores = {}
+        if self.output_weight:
+            with umt.timer('detector.outputs'):
+                output_scores = uos.OutputIndex.from_notebooks(names, cells, workers=self.workers).scores()
+
+        nr_codes = len(pycode_list)
+        sketch = uss.ScoreSketch()
+        # the highest scoring pairs, the threshold is known only once all the pairs are scored
+        best = []
+        # the highest score of the pairs that did not fit into best
+        max_dropped = -1.
+        with umt.profile('detector.detect'), umt.timer('detector.detect'):
+            if func_infos is None:
+                func_infos = self.fingerprint_codes(pycode_list)
+            token_prints = self.token_fingerprints(pycode_list)
+            for i in range(nr_codes):
+                scores = []
+                for j in range(i + 1, nr_codes):
+                    if func_infos[i] is not None and func_infos[j] is not None:
+                        ast_score, _, _ = summarize(compare(func_infos[i], func_infos[j]))
+                    else:
+                        # at least one of the codes is not valid python
+                        ast_score = token_similarity(token_prints(i), token_prints(j))
+                    output_score = output_scores.get(frozenset((names[i], names[j])), 0.)
+                    sum_plagiarism_percent = uos.combine_scores(ast_score, output_score, self.output_weight)
+                    scores.append(sum_plagiarism_percent)
+                    item = (sum_plagiarism_percent, i, j, ast_score, output_score)
+                    if len(best) < self.max_candidates:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        max_dropped = max(max_dropped, heapq.heapreplace(best, item)[0])
+                    else:
+                        max_dropped = max(max_dropped, sum_plagiarism_percent)
+                sketch.update(scores)
+
+        threshold = uss.select_threshold(sketch, self.threshold, tol_level=self.tol_level,
+                                         top_share=self.top_share, z_score=self.z_score)
+        candidates = tuple(Candidate(names[i], names[j], cells[i], cells[j], pycode_list[i], pycode_list[j],
+                                     score, ast_score, output_score)
+                           for score, i, j, ast_score, output_score in sorted(best, key=lambda item: item[1:3])
+                           if score > threshold)
+        umt.count('detector.candidates', len(candidates))
+        # pairs above the threshold that did not fit into max_candidates, their number is estimated by the sketch
+        truncated = max(sketch.count_above(threshold) - len(candidates), 1) if max_dropped > threshold else 0
+        umt.count('detector.truncated_candidates', truncated)
+        score_stats = dict(sketch.summary(top_share=self.top_share, z_score=self.z_score),
+                           method=self.threshold, threshold=threshold, truncated=truncated)
+        return candidates, types.MappingProxyType(score_stats)
+
     @staticmethod
-    def get_code_per_problem(file_name, skip_commands):
+    def fingerprint_codes(pycode_list):
+        """
+        Fingerprints every code once, the codes that ast.parse rejects are compared
+        by their tokens instead (see utils.code_similarity.token_fingerprint).
+
+        :returns: the function records of every code, None for the invalid ones
+        :rtype: list[list[utils.code_similarity.FuncInfo] or None]
+        """
+        token_ids = {}
+        func_infos = []
+        for code in pycode_list:
+            try:
+                func_infos.append(fingerprint(code, token_ids, keep_prints=True, module_level=True))
+            except SyntaxError as e:
+                print(e, 'Check the code, maybe there are bash commands. Compared by its tokens.')
+                umt.count('detector.token_fallbacks')
+                func_infos.append(None)
+        return func_infos
+
+    @staticmethod
+    def token_fingerprints(pycode_list):
+        """
+        :returns: a function returning the token fingerprint of a code by its index, computed when first needed
+        :rtype: collections.abc.Callable[[int], frozenset[int]]
+        """
+        token_prints = {}
 
-        notebook = un.notebook_to_dict(file_name)
+        def token_print(index):
+            if index not in token_prints:
+                token_prints[index] = token_fingerprint(pycode_list[index], keep_prints=True)
+            return token_prints[index]
 
-        cells = notebook['cells'].copy()
-        nr_cells = len(cells)
+        return token_print
 
-        code = []
-        skip = False
-        for idx in range(nr_cells):
-            if cells[idx]['cell_type'] == 'code':
-                for skip_command in skip_commands:
-                    if any([skip_command in c for c in cells[idx]['source']]):
-                        skip = True
-                if skip:
-                    continue
-                code.append(un.join(cells[idx]['source']))
+    @staticmethod
+    def display_score_stats(score_stats):
+        """Shows the score distribution of the cohort and the threshold in the sidebar."""
+        with st.sidebar.expander('Scores', expanded=True):
+            st.text(f"Threshold {score_stats['threshold']:.3f} ({score_stats['method']})")
+            st.text(f"Suggested: top {score_stats['top']:.3f}, z-score {score_stats['zscore']:.3f}")
+            st.text(f"{score_stats['pairs']} pairs, mean {score_stats['mean']:.3f}, std {score_stats['std']:.3f}, "
+                     f"p50 {score_stats['p50']:.3f}, p90 {score_stats['p90']:.3f}, p99 {score_stats['p99']:.3f}")
+        if score_stats.get('truncated'):
+            st.warning(f"About {score_stats['truncated']} pairs above the threshold are not listed, only the highest "
+                       f"scoring ones are kept (see --max_candidates).")
 
-        code = '\n'.join(code)
+    @staticmethod
+    def hide_notebook():
+        st.session_state.displayed = None
 
-        return code, cells
+    @staticmethod
+    def get_code_per_problem(file_name, skip_commands):
 
-    def get_codes_names(self, student2file):
+        # outputs are not decoded until a cell is displayed
+        notebook = un.LazyNotebook(file_name)
+
+        return un.extract_code(notebook, skip_commands), notebook
+
+    @staticmethod
+    def get_codes_names(corpus):
         codes = []
         names = []
         cells = []
 
-        for student in student2file:
-            code, cell = self.get_code_per_problem(file_name=student2file[student],
-                                                   skip_commands=self.skip_commands)
-
+        for student, code, notebook in zip(corpus.students, corpus.codes, corpus.notebooks):
             if code is None:
                 continue
 
             codes.append(code)
-            cells.append(cell)
+            cells.append(notebook)
             names.append(student)
         return codes, cells, names
@@ -0,0 +1,177 @@
+import re
+import unicodedata
+
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import utils.misc as um
+
+# Armenian letters to the common latin spellings, applied after lowercasing
+ARMENIAN_TO_LATIN = {
+    'ու': 'u', 'և': 'ev',
+    'ա': 'a', 'բ': 'b', 'գ': 'g', 'դ': 'd', 'ե': 'e', 'զ': 'z', 'է': 'e', 'ը': 'y', 'թ': 't',
+    'ժ': 'zh', 'ի': 'i', 'լ': 'l', 'խ': 'kh', 'ծ': 'ts', 'կ': 'k', 'հ': 'h', 'ձ': 'dz', 'ղ': 'gh',
+    'ճ': 'ch', 'մ': 'm', 'յ': 'y', 'ն': 'n', 'շ': 'sh', 'ո': 'o', 'չ': 'ch', 'պ': 'p', 'ջ': 'j',
+    'ռ': 'r', 'ս': 's', 'վ': 'v', 'տ': 't', 'ր': 'r', 'ց': 'ts', 'ւ': 'v', 'փ': 'p', 'ք': 'k',
+    'օ': 'o', 'ֆ': 'f',
+}
+
+# spelling variants that are reduced to one form, e.g. Harutyunyan / Harutiunian / Haroutyounyan
+LATIN_VARIANTS = (
+    ('tch', 'c'), ('ch', 'c'), ('ts', 'c'), ('tz', 'c'), ('kh', 'x'), ('gh', 'g'), ('zh', 'j'),
+    ('sh', 's'), ('dz', 'z'), ('ou', 'u'), ('iu', 'yu'), ('ia', 'ya'), ('w', 'v'), ('q', 'k'), ('x', 'ks'),
+    ('ye', 'e'), ('h', ''),
+)
+
+_ARMENIAN = re.compile('|'.join(sorted(ARMENIAN_TO_LATIN, key=len, reverse=True)))
+_VARIANTS = re.compile('|'.join(old for old, _ in LATIN_VARIANTS))
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def normalize_name(name):
+    """
+    Transliterates the name into latin letters and reduces the spelling variants,
+    so that 'Ալեքս Հարությունյան', 'Alex Harutyunyan' and 'alex harutiunian' get the same tokens.
+
+    :param str name: full name or nickname
+    :returns: normalized name tokens
+    :rtype: list[str]
+    """
+    name = _ARMENIAN.sub(lambda match: ARMENIAN_TO_LATIN[match.group()], str(name).lower())
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    tokens = []
+    for token in re.split(r'[^a-z]+', name):
+        token = _REPEATS.sub(r'\1', _VARIANTS.sub(lambda match: dict(LATIN_VARIANTS)[match.group()], token))
+        if token:
+            tokens.append(token)
+    return tokens
+
+
+def ngrams(text, n=3):
+    """Character n-grams of the text padded with spaces."""
+    text = f' {text} '
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+
+
+class Roster:
+    """
+    Index of the student names for resolving the misspelled, transliterated or partial names
+    (e.g. Kahoot nicknames) in one batch.
+
+    Every name is normalized once (see normalize_name) and indexed by its character n-grams,
+    a query is compared only to the names sharing most n-grams with it, all the edit distances of
+    a batch are computed at once by utils.misc.edit_distance.
+
+    :param dict or list or str students: names (dict keys if a dict) or path to a csv file with the names
+        in the first column, e.g. files/ds_students_2024.csv
+    :param int n: length of the indexed n-grams
+    """
+
+    def __init__(self, students, n=3):
+        if isinstance(students, str):
+            students = pd.read_csv(students).iloc[:, 0].dropna().astype(str).tolist()
+        self.names = list(students)
+        self.n = n
+        self.keys = []
+        self.lookup = {}
+        self.tokens = {}
+        self.index = {}
+        for num, name in enumerate(self.names):
+            tokens = normalize_name(name)
+            # both the given and the reversed order, nicknames are often 'Surname Name'
+            keys = {''.join(tokens), ''.join(reversed(tokens))}
+            self.keys.append(keys)
+            for token in tokens:
+                self.tokens.setdefault(token, set()).add(num)
+            for key in keys:
+                self.lookup.setdefault(key, set()).add(num)
+                for gram in ngrams(key, n):
+                    self.index.setdefault(gram, set()).add(num)
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, key, top=10):
+        """
+        :param str key: normalized query
+        :param int top: maximum number of candidates, None for all the names sharing an n-gram
+        :returns: indices of the names sharing most n-grams with the query
+        :rtype: list[int]
+        """
+        shared = Counter()
+        for gram in ngrams(key, self.n):
+            shared.update(self.index.get(gram, ()))
+        return [num for num, _ in shared.most_common(top)]
+
+    def resolve(self, queries, max_distance=0.25, margin=0.1, top=10):
+        """
+        Matches the queries to the roster names.
+
+        A query is resolved if its normalized form equals a name, its words are the words
+        (e.g. the first name) of only one name, it is a part of only one name (like utils.misc.find_in_dict) or is closest to one name by the relative edit distance,
+        which must be at most max_distance and better than the second best by margin.
+
+        :param list[str] queries: names to resolve
+        :param float max_distance: edit distance divided by the length of the longer string
+        :param float margin: required distance difference to the second best name
+        :param int top: number of n-gram candidates compared by the edit distance
+        :returns: resolved query to roster name mapping and unresolved query to
+            closest roster names mapping
+        :rtype: tuple[dict[str, str], dict[str, list[str]]]
+        """
+        resolved, unresolved = {}, {}
+        pairs = []
+        for query in dict.fromkeys(queries):
+            tokens = normalize_name(query)
+            key = ''.join(tokens)
+            if not key:
+                unresolved[query] = []
+                continue
+            exact = self.lookup.get(key, ())
+            if len(exact) != 1:
+                exact = set.intersection(*(self.tokens.get(token, set()) for token in tokens))
+            if len(exact) == 1:
+                resolved[query] = self.names[next(iter(exact))]
+                continue
+            if not exact and len(key) >= self.n:
+                # a part of the name shares its inner n-grams with it
+                partial = [num for num in self.candidates(key, top=None) if any(key in k for k in self.keys[num])]
+                if len(partial) == 1:
+                    resolved[query] = self.names[partial[0]]
+                    continue
+            pairs.extend((query, key, num, name_key) for num in self.candidates(key, top)
+                         for name_key in self.keys[num])
+            unresolved[query] = []
+
+        if pairs:
+            queries_, keys, nums, name_keys = zip(*pairs)
+            distances = um.edit_distance(list(keys), list(name_keys))
+            lengths = np.maximum([len(k) for k in keys], [len(k) for k in name_keys])
+            frame = pd.DataFrame({'query': queries_, 'num': nums, 'distance': distances / lengths})
+            frame = frame.groupby(['query', 'num'], sort=False).distance.min().reset_index()
+            frame.sort_values(['query', 'distance'], inplace=True, kind='stable')
+            for query, group in frame.groupby('query', sort=False):
+                distances, nums = group.distance.to_numpy(), group.num.to_numpy()
+                if distances[0] <= max_distance and (len(distances) == 1 or distances[1] - distances[0] >= margin):
+                    resolved[query] = self.names[nums[0]]
+                    del unresolved[query]
+                else:
+                    unresolved[query] = [self.names[num] for num in nums[:3]]
+        return resolved, unresolved
+
+
+def write_report(unresolved, file_name):
+    """
+    Writes the unresolved names with their closest roster names into a csv file,
+    to be fixed by hand and passed back e.g. as the name_mapping of utils.kahoot.KahootParser.
+
+    :param dict[str, list[str]] unresolved: output of Roster.resolve
+    :param str file_name: .csv file name
+    """
+    pd.DataFrame({
+        'name': list(unresolved),
+        'resolved_name': '',
+        'closest_names': ['; '.join(names) for names in unresolved.values()],
+    }).to_csv(file_name, index=False)
@@ -0,0 +1,383 @@
+"""
+Runs the detection and the grading of all the assignments of one or several courses as one batch.
+
+    python -m utils.scheduler course1.json course2.json --workers 4 --state_dir .schedule
+
+The course files are the ones of utils.gradebook, an assignment may also give the autograder settings
+and a course the detection settings (see utils.plagiarism_detector.PlagiarismDetectorStreamlit):
+
+    {
+        "name": "ds2024",
+        "students": "students.csv",
+        "weights": {"homework": 40, "midterm": 60},
+        "assignments": [
+            {"name": "hw1", "path": "submissions/hw1", "group": "homework",
+             "assertions": "assertions/hw1.py", "timeout": 60, "memory_mb": 2048, "data_dir": "data"}
+        ],
+        "detection": {"tol_level": 0.9, "threshold": "zscore"},
+        "cache_dir": "execution_cache",
+        "output": "gradebook.csv"
+    }
+
+Every assignment goes through ingest -> fingerprint -> detect and ingest -> autograde, the gradebook of a
+course waits for the autograding of all its assignments. The jobs run in a bounded process pool as soon
+as the jobs they depend on are done. The result of every job is kept in the state directory with a key of
+its inputs (the submission and data hashes, the settings and the keys of the jobs it depends on), so an interrupted
+or repeated run only runs the jobs whose inputs changed. The execution cache of the autograder is shared
+by all the assignments of a course.
+"""
+import os
+import csv
+import json
+import time
+import pickle
+import hashlib
+import argparse
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import utils.ingest as ui
+import utils.gradebook as ug
+import utils.autograder as ua
+import utils.grade_store as ugs
+import utils.submissions as us
+
+from utils.plagiarism_detector import PlagiarismDetectorStreamlit
+
+STAGES = ('ingest', 'fingerprint', 'detect', 'autograde', 'gradebook')
+
+Job = namedtuple('Job', ['name', 'stage', 'config_file', 'assignment', 'deps'])
+
+
+def read_config(config_file):
+    with open(config_file, encoding='utf8') as f:
+        return json.load(f)
+
+
+def course_name(config_file, config):
+    return config.get('name') or os.path.splitext(os.path.basename(config_file))[0]
+
+
+def build_jobs(config_files):
+    """
+    :param list[str] config_files: course .json files
+    :returns: the jobs of all the courses, every job after the ones it depends on
+    :rtype: list[Job]
+    """
+    jobs = []
+    for config_file in config_files:
+        config = read_config(config_file)
+        course = course_name(config_file, config)
+        autograde_jobs = []
+        for assignment in config.get('assignments', []):
+            prefix = f"{course}/{assignment['name']}"
+            jobs.append(Job(f'{prefix}/ingest', 'ingest', config_file, assignment['name'], ()))
+            jobs.append(Job(f'{prefix}/fingerprint', 'fingerprint', config_file, assignment['name'],
+                            (f'{prefix}/ingest',)))
+            jobs.append(Job(f'{prefix}/detect', 'detect', config_file, assignment['name'],
+                            (f'{prefix}/ingest', f'{prefix}/fingerprint')))
+            jobs.append(Job(f'{prefix}/autograde', 'autograde', config_file, assignment['name'],
+                            (f'{prefix}/ingest',)))
+            autograde_jobs.append(f'{prefix}/autograde')
+        jobs.append(Job(f'{course}/gradebook', 'gradebook', config_file, None, tuple(autograde_jobs)))
+    return jobs
+
+
+def _assignment(config, name):
+    return next(assignment for assignment in config['assignments'] if assignment['name'] == name)
+
+
+def _path(config_file, path):
+    return path if path is None else os.path.join(os.path.dirname(os.path.abspath(config_file)), path)
+
+
+def data_hash(data_dir):
+    """
+    :param str data_dir: data directory or zip archive of an assignment, None for no data
+    :returns: content hash of the data files
+    :rtype: str or None
+    """
+    if data_dir is None or os.path.isfile(data_dir):
+        return data_dir and us.file_hash(data_dir)
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(data_dir, followlinks=True)
+                   for name in names)
+    content = json.dumps([(os.path.relpath(file, data_dir), us.file_hash(file)) for file in files])
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+def job_key(job, dep_keys):
+    """
+    Key of the inputs of a job, None for the jobs that always run.
+
+    :param Job job: the job
+    :param list[str] dep_keys: keys of the jobs it depends on
+    :rtype: str or None
+    """
+    config = read_config(job.config_file)
+    if job.stage == 'gradebook':
+        # the grades entered in the apps are read too
+        return None
+    assignment = _assignment(config, job.assignment)
+    if job.stage == 'ingest':
+        inputs = ui.corpus_key(_path(job.config_file, assignment['path']),
+                              skip_commands=PlagiarismDetectorStreamlit.skip_commands)
+    elif job.stage == 'detect':
+        inputs = config.get('detection', {})
+    elif job.stage == 'autograde':
+        assertions = _path(job.config_file, assignment.get('assertions'))
+        inputs = [{key: value for key, value in assignment.items() if key not in ('name', 'path', 'group')},
+                  assertions and us.file_hash(assertions), config.get('cache_dir'),
+                  data_hash(_path(job.config_file, assignment.get('data_dir')))]
+    else:
+        inputs = None
+    content = json.dumps([job.stage, inputs, list(dep_keys)], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+def state_files(state_dir, job):
+    """The result of a job and its key, the key file is written last and marks the job as done."""
+    base = os.path.join(state_dir, job.name.replace('/', '__'))
+    return base + '.pkl', base + '.json'
+
+
+def load_state(state_dir, job):
+    """
+    :returns: key and seconds of the last run of the job, None if it did not finish
+    :rtype: dict or None
+    """
+    try:
+        with open(state_files(state_dir, job)[1], encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_result(state_dir, job_name):
+    with open(os.path.join(state_dir, job_name.replace('/', '__') + '.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def _ingest(job, config, results, workers):
+    path = _path(job.config_file, _assignment(config, job.assignment)['path'])
+    return ui.load_corpus(path, skip_commands=PlagiarismDetectorStreamlit.skip_commands, workers=workers)
+
+
+def _fingerprint(job, config, results, workers):
+    corpus = results[job.deps[0]]
+    return PlagiarismDetectorStreamlit.fingerprint_codes(PlagiarismDetectorStreamlit.get_codes_names(corpus)[0])
+
+
+def _detect(job, config, results, workers):
+    """Scores the pairs and writes the candidates next to the submissions, to be reviewed in the app."""
+    path = _path(job.config_file, _assignment(config, job.assignment)['path'])
+    corpus, func_infos = results[job.deps[0]], results[job.deps[1]]
+    detector = PlagiarismDetectorStreamlit(path, workers=workers, **config.get('detection', {}))
+    candidates, score_stats = detector.find_candidates(corpus, func_infos)
+    candidates = [(pair.name1, pair.name2, pair.score, pair.ast_score, pair.output_score) for pair in candidates]
+
+    output_dir = ui.output_dir(path)
+    with open(os.path.join(output_dir, 'candidates.csv'), 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name1', 'name2', 'score', 'ast_score', 'output_score'])
+        writer.writerows(candidates)
+    with open(os.path.join(output_dir, 'score_stats.json'), 'w') as f:
+        json.dump(dict(score_stats), f, indent=2)
+    return {'candidates': candidates, 'score_stats': dict(score_stats)}
+
+
+def _autograde(job, config, results, workers):
+    """Runs the assertions and stores the grades like the grader app, without replacing the ones entered by hand."""
+    assignment = _assignment(config, job.assignment)
+    if not assignment.get('assertions'):
+        return {}
+    corpus = results[job.deps[0]]
+    path = _path(job.config_file, assignment['path'])
+    assertions = ua.load_assertions(_path(job.config_file, assignment['assertions']))
+    student_results = ua.autograde(dict(zip(corpus.students, corpus.files)), assertions, workers=workers,
+                                   timeout=assignment.get('timeout', 60), memory_mb=assignment.get('memory_mb'),
+                                   data_dir=_path(job.config_file, assignment.get('data_dir')),
+                                   cache_dir=_path(job.config_file, config.get('cache_dir')))
+    grades = {student: assignment.get('max_grade', 100) * ua.score(result) for student, result in student_results}
+    ugs.GradeStore(ugs.default_db_path(ui.output_dir(path))).set_many(grades, grader='autograder', overwrite=False)
+    return grades
+
+
+def _gradebook(job, config, results, workers):
+    return ug.run_course(job.config_file)
+
+
+def job_warnings(job, result):
+    """What the report should tell about a finished job: the assignments without grades, the names missing
+    from the roster and the candidates that did not fit into max_candidates."""
+    if job.stage == 'gradebook':
+        _, _, unresolved, ungraded = result
+        return ([f'not graded yet: {", ".join(ungraded)}'] if ungraded else []) + \
+            ([f'not in the roster: {", ".join(unresolved)}'] if unresolved else [])
+    if job.stage == 'detect' and result['score_stats'].get('truncated'):
+        return [f"about {result['score_stats']['truncated']} pairs above the threshold not in candidates.csv"]
+    return []
+
+
+STAGE_FUNCTIONS = {
+    'ingest': _ingest,
+    'fingerprint': _fingerprint,
+    'detect': _detect,
+    'autograde': _autograde,
+    'gradebook': _gradebook,
+}
+
+
+def run_job(job, key, state_dir, workers=None):
+    """
+    Runs one job in a worker process, the results of the jobs it depends on are read from the state directory.
+
+    :returns: seconds the job took and its warnings
+    :rtype: tuple[float, list[str]]
+    """
+    start = time.perf_counter()
+    results = {name: load_result(state_dir, name) for name in job.deps}
+    result = STAGE_FUNCTIONS[job.stage](job, read_config(job.config_file), results, workers)
+    seconds = time.perf_counter() - start
+    warnings = job_warnings(job, result)
+
+    result_file, key_file = state_files(state_dir, job)
+    with open(result_file + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(result_file + '.tmp', result_file)
+    with open(key_file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump({'key': key, 'seconds': seconds, 'warnings': warnings}, f)
+    os.replace(key_file + '.tmp', key_file)
+    return seconds, warnings
+
+
+class Scheduler:
+    """
+    Runs the jobs in a bounded process pool in the order of their dependencies.
+
+    :param list[Job] jobs: output of build_jobs
+    :param str state_dir: directory of the results and the keys of the jobs
+    :param int workers: number of jobs running at once, defaults to the number of cores
+    :param int job_workers: threads (or interpreters when autograding) of a job, defaults to the cores shared
+        by the jobs running at once, so the batch does not start workers * cores interpreters
+    """
+
+    def __init__(self, jobs, state_dir='.schedule', workers=None, job_workers=None):
+        self.jobs = {job.name: job for job in jobs}
+        self.state_dir = state_dir
+        self.workers = workers or os.cpu_count()
+        self.job_workers = job_workers or max(1, os.cpu_count() // self.workers)
+        self.keys = {}
+        self.seconds = {}
+        self.warnings = {}
+        self.resumed = set()
+        self.failed = {}
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _ready(self, done, running):
+        for name, job in self.jobs.items():
+            if name in done or name in running or name in self.failed:
+                continue
+            if any(dep in self.failed for dep in job.deps):
+                self.failed[name] = 'a job it depends on failed'
+                continue
+            if all(dep in done for dep in job.deps):
+                yield job
+
+    def run(self):
+        """
+        :returns: the report, see report
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        done, running = set(), {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while True:
+                    for job in list(self._ready(done, running)):
+                        key = job_key(job, [self.keys[dep] for dep in job.deps])
+                        self.keys[job.name] = key
+                        state = load_state(self.state_dir, job)
+                        if key is not None and state is not None and state['key'] == key:
+                            # finished in a previous run with the same inputs
+                            self.resumed.add(job.name)
+                            self.seconds[job.name] = state['seconds']
+                            self.warnings[job.name] = state.get('warnings', [])
+                            done.add(job.name)
+                            continue
+                        running[job.name] = pool.submit(run_job, job, key, self.state_dir, self.job_workers)
+                    if not running:
+                        if not any(True for _ in self._ready(done, running)):
+                            break
+                        continue
+                    finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                    for name, future in list(running.items()):
+                        if future not in finished:
+                            continue
+                        del running[name]
+                        try:
+                            self.seconds[name], self.warnings[name] = future.result()
+                            done.add(name)
+                        except Exception as e:
+                            self.failed[name] = repr(e)
+            except KeyboardInterrupt:
+                # the finished jobs are kept in the state directory, the next run resumes from them
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        return self.report(time.perf_counter() - start)
+
+    def report(self, wall_time):
+        """
+        :param float wall_time: seconds of the whole run
+        :returns: the wall time of the run, the seconds and the warnings of every job and the seconds per stage
+        :rtype: dict
+        """
+        stages = {stage: {'jobs': 0, 'seconds': 0., 'resumed': 0, 'failed': 0} for stage in STAGES}
+        for name, job in self.jobs.items():
+            stage = stages[job.stage]
+            stage['jobs'] += 1
+            stage['failed'] += name in self.failed
+            if name in self.resumed:
+                stage['resumed'] += 1
+            else:
+                stage['seconds'] += self.seconds.get(name, 0.)
+        report = {
+            'wall_time': wall_time,
+            'stages': stages,
+            'jobs': {name: {'seconds': self.seconds.get(name), 'resumed': name in self.resumed,
+                            'error': self.failed.get(name), 'warnings': self.warnings.get(name, [])}
+                     for name in self.jobs},
+        }
+        with open(os.path.join(self.state_dir, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def print_report(report):
+    print(f"wall time {report['wall_time']:.1f}s")
+    for stage, summary in report['stages'].items():
+        print(f"  {stage:<12} {summary['seconds']:9.2f}s  {summary['jobs']} jobs, "
+              f"{summary['resumed']} resumed, {summary['failed']} failed")
+    for name, job in report['jobs'].items():
+        if job['error']:
+            print(f"  {name}: {job['error']}")
+        for warning in job['warnings']:
+            print(f"  {name}: {warning}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the detection and the grading of all the assignments.")
+
+    parser.add_argument('courses', nargs='+',
+                        help="Course .json files, see utils/scheduler.py.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of jobs running at once, defaults to the number of cores.")
+    parser.add_argument('--job_workers', type=int, default=None,
+                        help="Threads or interpreters used by one job, defaults to the cores divided by --workers.")
+    parser.add_argument('--state_dir', default='.schedule',
+                        help="Directory of the job results, a rerun only runs the jobs whose inputs changed.")
+
+    args = parser.parse_args()
+
+    print_report(Scheduler(build_jobs(args.courses), state_dir=args.state_dir,
+                           workers=args.workers, job_workers=args.job_workers).run())
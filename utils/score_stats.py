@@ -0,0 +1,119 @@
+import numpy as np
+
+THRESHOLDS = ('fixed', 'top', 'zscore')
+
+
+class ScoreSketch:
+    """
+    Streaming statistics of the pair similarity scores of a cohort.
+
+    The scores are between 0 and 1, so the quantiles are kept in a fixed-bin histogram:
+    the memory does not grow with the number of pairs, the quantiles are exact up to the
+    bin width and the sketches of separately scored parts (pruned or sampled pairs,
+    parallel workers) are merged by adding them up. The mean and the standard deviation
+    come from the running sums.
+
+    :param int bins: number of histogram bins, the precision of the quantiles is 1 / bins
+    """
+
+    def __init__(self, bins=1000):
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.total = 0.
+        self.total_squares = 0.
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def update(self, scores):
+        """
+        :param scores: scores between 0 and 1, a float or an iterable of floats
+        """
+        scores = np.clip(np.atleast_1d(np.asarray(scores, dtype=np.float64)), 0., 1.)
+        self.counts += np.bincount(np.minimum((scores * self.bins).astype(np.int64), self.bins - 1),
+                                   minlength=self.bins)
+        self.total += float(scores.sum())
+        self.total_squares += float(np.square(scores).sum())
+
+    def merge(self, other):
+        """Adds the scores of another sketch with the same number of bins."""
+        if other.bins != self.bins:
+            raise ValueError(f'Cannot merge sketches of {self.bins} and {other.bins} bins.')
+        self.counts += other.counts
+        self.total += other.total
+        self.total_squares += other.total_squares
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def std(self):
+        if not self.count:
+            return 0.
+        return float(np.sqrt(max(self.total_squares / self.count - self.mean() ** 2, 0.)))
+
+    def quantile(self, q):
+        """
+        :param float q: between 0 and 1
+        :returns: the score below which q of the scores are, interpolated inside the bin
+        :rtype: float
+        """
+        count = self.count
+        if not count:
+            return 0.
+        cumulative = np.cumsum(self.counts)
+        rank = q * count
+        index = min(int(np.searchsorted(cumulative, rank)), self.bins - 1)
+        before = cumulative[index - 1] if index else 0
+        inside = (rank - before) / self.counts[index] if self.counts[index] else 0.
+        return float((index + min(max(inside, 0.), 1.)) / self.bins)
+
+    def count_above(self, score):
+        """
+        :param float score: between 0 and 1
+        :returns: number of the scores above score, interpolated inside its bin
+        :rtype: int
+        """
+        position = min(max(score, 0.), 1.) * self.bins
+        index = min(int(position), self.bins - 1)
+        inside = self.counts[index] * max(1 - (position - index), 0.)
+        return int(round(self.counts[index + 1:].sum() + inside))
+
+    def threshold(self, method='top', top_share=0.01, z_score=3.):
+        """
+        Threshold from the cohort's own score distribution.
+
+        :param str method: 'top' flags the top_share highest scores, 'zscore' the scores
+            z_score standard deviations above the mean
+        :param float top_share: share of the pairs to flag
+        :param float z_score: number of standard deviations
+        :rtype: float
+        """
+        if method == 'top':
+            return self.quantile(1 - top_share)
+        if method == 'zscore':
+            return min(self.mean() + z_score * self.std(), 1.)
+        raise ValueError(f'Unknown threshold method {method!r}, expected one of {THRESHOLDS[1:]}.')
+
+    def summary(self, top_share=0.01, z_score=3., percentiles=(50, 90, 99)):
+        """
+        :returns: number of pairs, mean, std, percentiles and the suggested thresholds
+        :rtype: dict
+        """
+        return dict({'pairs': self.count, 'mean': self.mean(), 'std': self.std()},
+                    **{f'p{q}': self.quantile(q / 100) for q in percentiles},
+                    top=self.threshold('top', top_share=top_share),
+                    zscore=self.threshold('zscore', z_score=z_score))
+
+
+def select_threshold(sketch, method='fixed', tol_level=0.9, top_share=0.01, z_score=3.):
+    """
+    :param ScoreSketch sketch: scores of the cohort
+    :param str method: 'fixed' to keep tol_level, 'top' or 'zscore' (see ScoreSketch.threshold)
+    :param float tol_level: the fixed threshold
+    :rtype: float
+    """
+    if method == 'fixed':
+        return tol_level
+    return sketch.threshold(method, top_share=top_share, z_score=z_score)
@@ -8,54 +8,137 @@ import argparse
 import os
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import utils.notebook as un
+import utils.ingest as ui
+import utils.metrics as umt
+
+SKIP_LINES_STARTWITH = ('Image(filename=',
+                        '# In[',
+                        '# <hr>',
+                        'from IPython.display import Image',
+                        'get_ipython()',
+                        '# <br>',
+                        '#')
+
 
 def convert(input_path, output_path):
     subprocess.call(['jupyter', 'nbconvert', '--to', 'script',
                      input_path, '--output', output_path])
 
 
-def cleanup(path):
-    skip_lines_startwith = ('Image(filename=',
-                            '# In[',
-                            '# <hr>',
-                            'from IPython.display import Image',
-                            'get_ipython()',
-                            '# <br>',
-                            '#')
+def clean_lines(lines):
+    """
+    Drops the comments and the notebook-only lines and moves the imports to the top.
 
+    :param collections.abc.Iterable[str] lines: lines of the script without the two header lines
+    :returns: the cleaned script
+    :rtype: str
+    """
     clean_content = []
     imports = []
     existing_imports = set()
+    for line in lines:
+        line = line.rstrip(' ')
+        if line.startswith(SKIP_LINES_STARTWITH):
+            continue
+        if line.startswith('import ') or (
+                'from ' in line and 'import ' in line):
+            if 'from __future__ import print_function' in line:
+                if not imports or line != imports[0]:
+                    imports.insert(0, line)
+            else:
+                if line.strip() not in existing_imports:
+                    imports.append(line)
+                    existing_imports.add(line.strip())
+        else:
+            clean_content.append(line)
+
+    return ''.join(['# coding: utf-8\n\n\n'] + imports + clean_content)
+
+
+def cleanup(path):
     with open(path, 'r', encoding="utf8") as f:
         next(f)
         next(f)
-        for line in f:
-            line = line.rstrip(' ')
-            if line.startswith(skip_lines_startwith):
-                continue
-            if line.startswith('import ') or (
-                    'from ' in line and 'import ' in line):
-                if 'from __future__ import print_function' in line:
-                    if line != imports[0]:
-                        imports.insert(0, line)
-                else:
-                    if line.strip() not in existing_imports:
-                        imports.append(line)
-                        existing_imports.add(line.strip())
-            else:
-                clean_content.append(line)
-
-    clean_content = ['# coding: utf-8\n\n\n'] + imports + clean_content
+        clean_content = clean_lines(f)
 
     with open(path, 'w', encoding="utf8") as f:
-        for line in clean_content:
-            f.write(line)
+        f.write(clean_content)
+
+
+def script_lines(notebook):
+    """
+    Lines of the code cells laid out like the output of nbconvert --to script,
+    the magics and shell commands become get_ipython() lines.
+
+    :param un.LazyNotebook notebook: the notebook
+    :rtype: collections.abc.Iterator[str]
+    """
+    for cell_type, source in zip(notebook.cell_types, notebook.sources):
+        if cell_type != 'code':
+            continue
+        yield from ('\n', '# In[ ]:\n', '\n', '\n')
+        if source.lstrip().startswith('%%'):
+            # the whole cell is passed to the cell magic
+            yield 'get_ipython().run_cell_magic()\n'
+        else:
+            for line in source.splitlines(True):
+                stripped = line.lstrip()
+                if stripped.startswith(('%', '!')):
+                    line = line[:len(line) - len(stripped)] + 'get_ipython()\n'
+                yield line if line.endswith('\n') else line + '\n'
+        yield '\n'
+
+
+def notebook_to_script(file_name):
+    """
+    Builds the cleaned script (see cleanup) directly from the notebook, without nbconvert.
+
+    :param file_name: .ipynb file name, or anything utils.notebook.LazyNotebook accepts
+    :returns: the script
+    :rtype: str
+    """
+    return clean_lines(script_lines(un.LazyNotebook(file_name)))
+
+
+def _convert_one(file_name, output_path):
+    script = notebook_to_script(file_name)
+    if output_path is not None:
+        with open(output_path, 'w', encoding="utf8") as f:
+            f.write(script)
+    return script
+
+
+def convert_all(path, output_dir=None, workers=None, executor='process'):
+    """
+    Converts all the submissions of a directory or zip export in parallel.
+
+    :param str path: directory of the submission folders or a .zip file (see utils.ingest.get_submissions)
+    :param str output_dir: directory to write <student>.py files into, None to only return the scripts
+    :param int workers: size of the pool, defaults to the number of cores
+    :param str executor: 'thread' or 'process'
+    :returns: student name to script mapping
+    :rtype: dict[str, str]
+    """
+    student2file = ui.get_submissions(path)
+    students = list(student2file)
+    output_paths = [None] * len(students)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        output_paths = [os.path.join(output_dir, f'{student}.py') for student in students]
+
+    pool_class = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor]
+    with umt.timer('script_converter.convert_all'), pool_class(max_workers=workers or os.cpu_count()) as pool:
+        scripts = pool.map(_convert_one, [student2file[s] for s in students], output_paths,
+                           chunksize=8 if executor == 'process' else 1)
+        return dict(zip(students, scripts))
 
 
 def convert2script(notebook_path, script_name):
-    convert(input_path=notebook_path, output_path=script_name)
     script_path = os.path.join(os.path.dirname(notebook_path), f'{script_name}.py')
-    cleanup(path=script_path)
+    _convert_one(notebook_path, script_path)
 
 
 if __name__ == '__main__':
@@ -65,18 +148,25 @@ if __name__ == '__main__':
 
     parser.add_argument('-i', '--input',
                         required=True,
-                        help='Path to the Jupyter Notebook file')
+                        help='Path to the Jupyter Notebook file,\n'
+                             'or to a directory or zip export of submissions')
 
     parser.add_argument('-o', '--output',
                         required=True,
-                        help='Path to the Python script file')
+                        help='Path to the Python script file,\n'
+                             'or to the output directory for submissions')
+
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        help='Number of processes converting the submissions')
 
     parser.add_argument('-v', '--version',
                         action='version',
-                        version='v. 0.1')
+                        version='v. 0.2')
 
     args = parser.parse_args()
-    convert(input_path=args.input,
-            output_path=os.path.splitext(args.output)[0])
-
-    cleanup(args.output)
+    if args.input.endswith('.ipynb'):
+        _convert_one(args.input, args.output)
+    else:
+        convert_all(args.input, output_dir=args.output, workers=args.workers)
@@ -0,0 +1,47 @@
+"""
+Process-wide caches of the streamlit apps: all the browser sessions of a server (e.g. several TAs
+reviewing the same cohort) share one copy of the submissions and of the results computed from them.
+The cached objects are shared, they must not be modified, the per-session state stays in st.session_state.
+"""
+import streamlit as st
+
+import utils.ingest as ui
+import utils.metrics as umt
+
+
+@st.cache_resource(show_spinner='Loading the submissions', max_entries=8)
+def _corpus(key, path, file_type, skip_commands, _workers):
+    umt.count('shared.corpus_loads')
+    return ui.load_corpus(path, file_type=file_type, skip_commands=skip_commands, workers=_workers, key=key)
+
+
+def corpus(path, file_type='ipynb', skip_commands=(), workers=None):
+    """
+    The submissions, loaded once per process and again only when a submission changes.
+
+    :param str path: directory of the submission folders or a .zip file
+    :param str file_type: the type of files
+    :param list[str] skip_commands: commands that invalidate the python code
+    :param int workers: size of the loading pool, defaults to the number of cores
+    :rtype: utils.ingest.Corpus
+    """
+    skip_commands = tuple(skip_commands)
+    return _corpus(ui.corpus_key(path, file_type, skip_commands), path, file_type, skip_commands, workers)
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _result(name, key, _compute):
+    umt.count(f'shared.{name}_computed')
+    return _compute()
+
+
+def result(name, key, compute):
+    """
+    Result computed once per process for the given key, the sessions asking for it
+    at the same time wait for the first one to compute it.
+
+    :param str name: name of the result, e.g. 'detection'
+    :param tuple key: everything the result depends on, e.g. the corpus key and the parameters
+    :param compute: function without arguments computing the result
+    """
+    return _result(name, key, compute)
@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import utils.metrics as umt
+
+MANIFEST_VERSION = 1
+
+SubmissionVersion = namedtuple('SubmissionVersion', ['student', 'path', 'size', 'mtime_ns', 'sha256'])
+Changes = namedtuple('Changes', ['added', 'modified', 'removed'])
+Scan = namedtuple('Scan', ['versions', 'latest', 'changes'])
+
+
+def student_name(folder):
+    """The student name of a submission folder, e.g. 'Aram Aramyan' of 'Aram Aramyan_1234_assignsubmission_file_'."""
+    return folder.split('_')[0]
+
+
+def file_hash(file_name):
+    """sha256 of the file content, None if the file disappeared."""
+    digest = hashlib.sha256()
+    try:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def default_manifest_path(path, file_type='ipynb'):
+    """The manifest next to the submission folders, one per file type."""
+    return os.path.join(path, f'.submissions_{file_type}.json')
+
+
+def load_manifest(manifest_path, file_type='ipynb'):
+    """
+    :returns: the manifest of the previous scan, empty if there is none or it is of another version
+    :rtype: dict
+    """
+    try:
+        with open(manifest_path, encoding='utf8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('file_type') != file_type:
+        return {}
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    """Replaces the manifest atomically, a read-only submissions directory is not an error."""
+    try:
+        with open(manifest_path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    except OSError:
+        umt.count('submissions.manifest_not_saved')
+
+
+def _scan_folder(folder_path, file_type, previous_files):
+    """
+    :returns: file name to [size, mtime_ns, sha256] of the files of the folder, the hash is None
+        for the files that are new or changed since the previous scan
+    :rtype: dict[str, list]
+    """
+    files = {}
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.name.endswith(file_type) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            record = previous_files.get(entry.name)
+            if record is not None and record[:2] == [stat.st_size, stat.st_mtime_ns]:
+                files[entry.name] = record
+            else:
+                files[entry.name] = [stat.st_size, stat.st_mtime_ns, None]
+    return files
+
+
+def scan(path, file_type='ipynb', manifest_path=None, check_files=True, previous=None, workers=8):
+    """
+    Discovers every submitted version in the submission folders of a directory.
+
+    Every file is recorded in a manifest with its size, modification time and content hash,
+    on a rescan only the new or changed files are hashed. The manifest is shared by all the
+    callers, so the changes are computed against the scan the caller passes as previous.
+    A student may have several folders and several files, the latest version is the one
+    modified last, ties broken by the path.
+
+    :param str path: directory of interest where the submission folders are stored
+    :param str file_type: the type of files we want to get paths for
+    :param str manifest_path: the manifest file, see default_manifest_path
+    :param bool check_files: whether to also stat the files of the folders whose modification time
+        did not change, False skips them but misses the files overwritten in place
+    :param Scan previous: an earlier scan of the caller, None to report every student as added
+    :param int workers: number of threads hashing the files
+    :returns: the versions of every student oldest first, the latest version of every student and
+        the students whose latest version was added, modified or removed since the previous scan
+    :rtype: Scan
+    """
+    manifest_path = manifest_path or default_manifest_path(path, file_type)
+    previous_folders = load_manifest(manifest_path, file_type).get('folders', {})
+
+    folders = {}
+    with umt.timer('submissions.scan'), os.scandir(path) as entries:
+        for entry in entries:
+            # skips the outputs written next to the submission folders, e.g. grades.json
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            mtime_ns = entry.stat().st_mtime_ns
+            record = previous_folders.get(entry.name)
+            if record is not None and record['mtime_ns'] == mtime_ns and not check_files:
+                umt.count('submissions.folders_skipped')
+                folders[entry.name] = record
+                continue
+            folders[entry.name] = {
+                'mtime_ns': mtime_ns,
+                'files': _scan_folder(entry.path, file_type, record['files'] if record else {}),
+            }
+
+    to_hash = [(folder, name) for folder, record in folders.items()
+               for name, (_, _, digest) in record['files'].items() if digest is None]
+    with umt.timer('submissions.hash'), ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(file_hash, [os.path.join(path, folder, name) for folder, name in to_hash])
+        for (folder, name), digest in zip(to_hash, digests):
+            if digest is None:
+                del folders[folder]['files'][name]
+            else:
+                folders[folder]['files'][name][2] = digest
+    umt.count('submissions.files_hashed', len(to_hash))
+
+    versions = {}
+    for folder, record in folders.items():
+        student = student_name(folder)
+        for name, (size, mtime_ns, digest) in record['files'].items():
+            versions.setdefault(student, []).append(
+                SubmissionVersion(student, os.path.join(path, folder, name), size, mtime_ns, digest))
+    versions = {student: sorted(versions[student], key=lambda version: (version.mtime_ns, version.path))
+                for student in sorted(versions)}
+    latest = {student: student_versions[-1] for student, student_versions in versions.items()}
+
+    previous_latest = {} if previous is None else {student: version.sha256
+                                                   for student, version in previous.latest.items()}
+    digests = {student: version.sha256 for student, version in latest.items()}
+    changes = Changes(added=sorted(digests.keys() - previous_latest.keys()),
+                      modified=sorted(student for student in digests.keys() & previous_latest.keys()
+                                      if digests[student] != previous_latest[student]),
+                      removed=sorted(previous_latest.keys() - digests.keys()))
+    for kind, students in changes._asdict().items():
+        umt.count(f'submissions.{kind}', len(students))
+
+    if folders != previous_folders:
+        save_manifest(manifest_path, {'version': MANIFEST_VERSION, 'file_type': file_type, 'folders': folders})
+    return Scan(versions, latest, changes)